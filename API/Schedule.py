@@ -10,19 +10,26 @@ class Schedule:
 	@staticmethod
 	def view_scrape_schedule(pg, path: str, recursive: bool = False, order_by: str = '', row_limit: int = 100) -> list:
 		with pg.cursor() as cur:
-			# Make the input path searchable with wildcards
-			path = Util.sql_path_parse_wildcard_search(path)
-
-			# Add wildcard to directory path to make it recursive, unless user has already added it
-			if recursive and not path[-1:] == '%':
-				path += "%"
+			if Util.path_has_wildcards(path):
+				# Make the input path searchable with wildcards
+				path = Util.sql_path_parse_wildcard_search(path)
+
+				# Add wildcard to directory path to make it recursive, unless user has already added it
+				if recursive and not path[-1:] == '%':
+					path += "%"
+				path_filter = "dir_path ilike %s"
+			else:
+				# Look up the dir (or its subtree) case-insensitively (like ilike), with the lower(dir_path) index
+				path = Util.sql_path_parse_exact_search(path)
+				path_filter = "path_in_subtree(lower(dir_path), lower(%s))" if recursive else "lower(dir_path) = lower(%s)"
 
 			# Sanitize the order by
 			valid_order_cols = [
 				'dir_path', 'file_count', 'subdir_count', 'next_crawl',
 				'crawl_frequency', 'last_crawled', 'last_active', 'inserted_on'
 			]
-			if order_by := Util.sanitize_order_by(order_by, valid_order_cols) == "":
+			order_by = Util.sql_sanitize_order_by(order_by, valid_order_cols)
+			if order_by == "":
 				order_by = "dir_path asc"
 
 			# Sanitize the row_limit
@@ -36,7 +43,7 @@ class Schedule:
 					dir_path, dir_id, file_count, subdir_count, next_crawl, crawl_frequency,
 					process_assigned_on, last_crawled, last_active, inserted_on
 				from directory_control
-				where dir_path ilike %s
+				where {path_filter}
 				order by {order_by}
 				limit %s
 				""",
@@ -13,12 +13,19 @@ class Scrape:
 		pass
 
 	@staticmethod
-	def schedule_scrape_dir(pg, path: str, next_crawl: str) -> bool:
-		path = Util.sql_path_parse_wildcard_search(path)
+	def schedule_scrape_dir(pg, path: str, next_crawl: str, recursive: bool = False) -> bool:
+		if Util.path_has_wildcards(path):
+			path = Util.sql_path_parse_wildcard_search(path)
+			path_filter = "dir_path ilike %s"
+		else:
+			# Look up the dir (or its subtree) case-insensitively (like ilike), with the lower(dir_path) index
+			path = Util.sql_path_parse_exact_search(path)
+			path_filter = "path_in_subtree(lower(dir_path), lower(%s))" if recursive else "lower(dir_path) = lower(%s)"
+
 		# Expects next_crawl to be a string in a datetime format (eg: 1900-01-01 00:00:00)
 		with pg.cursor() as cur:
 			cur.execute(
-				"update directory_control set next_crawl=%s where dir_path ilike %s",
+				f"update directory_control set next_crawl=%s where {path_filter}",
 				(next_crawl, path)
 			)
 		return True
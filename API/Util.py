@@ -47,6 +47,11 @@ class Util:
 		path = path.replace("?", "_")
 		return path
 
+	# Does the user-supplied path contain operating system wildcards (* and ?)
+	@staticmethod
+	def path_has_wildcards(path: str) -> bool:
+		return '*' in path or '?' in path
+
 	@staticmethod
 	def sql_path_parse_exact_search(path: str) -> str:
 		# !! Important: Update the DB function as well (SQLUtil.py)
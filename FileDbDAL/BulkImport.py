@@ -0,0 +1,427 @@
+from FileDbDAL.DirectoryCrawl import DirectoryCrawl
+from FileDbDAL.CrawlPool import CrawlPool
+import psycopg2.extras
+import os
+
+
+class BulkImport:
+	# Import a new directory tree in one pass, instead of one level per crawl cycle.
+	# A single worker walks the entire subtree (with a pool of threads), and streams the directories and files
+	# directly into the directory and file tables in large batches. Once the walk is done, the whole subtree is
+	# registered in directory_control in one statement, to be crawled on the regular schedule from then on.
+
+	def __init__(
+			self, pg, dir_id: int, dir_path: str, pool_size: int = 1, batch_size: int = 50000, exclusion=None,
+			throttle=None
+	):
+		self.pg = pg
+		self.dir_id = dir_id  # The root of the subtree. Also identifies this import's staged rows.
+		self.dir_path = dir_path
+		self.pool_size = pool_size
+		self.batch_size = batch_size  # Number of entries (files + dirs) to write to the DB at a time
+		self.exclusion = exclusion  # CrawlExclusion rules
+		self.throttle = throttle  # Paces the stat calls to stay inside of the I/O budget
+
+		self.dir_ids = {dir_path: dir_id}  # {dir_path: dir_id} for the dirs that were inserted, but not yet crawled
+		self.dir_count = 0
+		self.file_count = 0
+
+	def run(self) -> None:
+		batch = []
+		batch_entries = 0
+		for dc in self.iter_crawl_subtree():
+			batch.append(dc)
+			batch_entries += dc.file_count + dc.subdir_count + 1
+
+			# Write the batch to the DB
+			if batch_entries >= self.batch_size:
+				self.flush(batch)
+				batch = []
+				batch_entries = 0
+
+		self.flush(batch)
+
+		# Register the whole subtree in directory_control
+		with self.pg.cursor() as cur:
+			cur.execute("select register_bulk_import(%s);", (self.dir_id,))
+
+	def iter_crawl_subtree(self):
+		# Walk the subtree, and yield each crawled directory (DirectoryCrawl object)
+		pending = [self.dir_path]
+		with CrawlPool(self.pool_size, exclusion=self.exclusion, throttle=self.throttle) as crawl_pool:
+			while pending or crawl_pool.dir_count():
+				# Keep the threads busy
+				while pending and crawl_pool.dir_count() < self.pool_size * 2:
+					dc = DirectoryCrawl()
+					dc.dir_path = pending.pop()
+					crawl_pool.submit(dc)
+
+				for dc in crawl_pool.iter_crawled(timeout=0.2):
+					# Walk into the subdirs. Symlinked dirs are left to the regular crawl, to avoid walking in a loop.
+					pending.extend(
+						subdir[0] for subdir in dc.iter_content_subdirs(include_symlinks=False)
+					)
+					self.dir_count += 1
+					self.file_count += dc.file_count
+					yield dc
+
+	def flush(self, crawled_dirs: list) -> None:
+		if not crawled_dirs:
+			return
+
+		# The crawled dirs whose parent was in an earlier batch already have an ID
+		for dc in crawled_dirs:
+			dc.dir_id = self.dir_ids.get(dc.dir_path)
+
+		with self.pg.cursor() as cur:
+			# Insert the subdirs, and get their IDs (their files get inserted once they're crawled)
+			rows = psycopg2.extras.execute_values(
+				cur,
+				"""
+				insert into directory as t
+					(dir_path, parent_id, ctime, mtime, dev, ino)
+				values
+					%s
+				on conflict on constraint directory_dir_path_key do
+					update set  -- Always update, so that the existing dirs return their ID
+						updated_on = case
+							when t.ctime is distinct from excluded.ctime or t.mtime is distinct from excluded.mtime then now()
+							else t.updated_on
+						end,
+						parent_id = coalesce(excluded.parent_id, t.parent_id),
+						ctime = excluded.ctime,
+						mtime = excluded.mtime,
+						dev = excluded.dev,
+						ino = excluded.ino
+				returning
+					id, dir_path;
+				""",
+				DirectoryCrawl.iter_multiple_subdirs(crawled_dirs),
+				page_size=1000,
+				fetch=True
+			)
+			self.dir_ids.update({row['dir_path']: row['id'] for row in rows})
+
+			# Every crawled dir now has an ID, since its parent was either in this batch or an earlier one.
+			# The subdirs of the dirs that were only inserted in this batch get linked to them afterwards.
+			parent_ids = []
+			for dc in crawled_dirs:
+				if dc.dir_id is None:
+					dc.dir_id = self.dir_ids.get(dc.dir_path)
+					parent_ids.extend(
+						(self.dir_ids[subdir[0]], dc.dir_id)
+						for subdir in dc.iter_content_subdirs()
+						if subdir[0] in self.dir_ids
+					)
+				self.dir_ids.pop(dc.dir_path, None)
+
+			psycopg2.extras.execute_values(
+				cur,
+				"""
+				update directory d
+				set parent_id = v.parent_id
+				from (values %s) v (id, parent_id)
+				where d.id = v.id;
+				""",
+				parent_ids,
+				page_size=1000
+			)
+
+			# Insert the files, and schedule them for hashing
+			scheduled = psycopg2.extras.execute_values(
+				cur,
+				"""
+				with file_ins as (
+					insert into file as f
+						(name, dir_id, size, ctime, mtime, atime, dev, ino)
+					values
+						%s
+					on conflict on constraint file_pkey do
+						update set
+							updated_on = now(),
+							size = excluded.size,
+							ctime = excluded.ctime,
+							mtime = excluded.mtime,
+							atime = excluded.atime,
+							dev = excluded.dev,
+							ino = excluded.ino
+						where  -- Don't do empty updates
+							f.size <> excluded.size
+							or f.ctime <> excluded.ctime
+							or f.mtime <> excluded.mtime
+							or f.atime <> excluded.atime
+							or f.dev is distinct from excluded.dev
+							or f.ino is distinct from excluded.ino
+					returning
+						f.id, f.mtime, f.size
+				)
+				-- Schedule the new files for hashing (same as process_staged_files())
+				insert into hash_control as t
+					(file_id, mtime, file_size)
+				select fi.id, fi.mtime, fi.size
+				from file_ins fi
+				where
+					not exists (
+						select from hash h
+						where h.file_id=fi.id
+					)
+				on conflict on constraint hash_control_pkey do
+					update set
+						mtime = excluded.mtime
+					where
+						t.mtime <> excluded.mtime
+				returning
+					t.file_id;
+				""",
+				DirectoryCrawl.iter_insert_dir_contents_files_queue(
+					[dc for dc in crawled_dirs if dc.dir_id is not None]
+				),
+				page_size=1000,
+				fetch=True
+			)
+
+			# The files that were moved in from elsewhere keep their hash, instead of getting hashed again
+			cur.execute("select carry_over_hashes(%s);", ([row['file_id'] for row in scheduled],))
+
+			# Queue the crawled dirs to have their stats refreshed
+			cur.execute(
+				"""
+				insert into directory_stats_queue (dir_id)
+				select unnest(%s::int[])
+				on conflict on constraint directory_stats_queue_pkey do nothing;
+				""",
+				([dc.dir_id for dc in crawled_dirs if dc.dir_id is not None],)
+			)
+
+			# Stage the crawled dirs to be registered in directory_control once the walk is done
+			psycopg2.extras.execute_values(
+				cur,
+				"""
+				insert into directory_control_bulk_stage
+					(
+						import_dir_id, dir_id, dir_path, crawled_on, file_count, subdir_count, dir_not_found,
+						crawl_started_on, mtime, ctime
+					)
+				values
+					%s
+				on conflict on constraint directory_control_bulk_stage_pkey do nothing;
+				""",
+				self.iter_control_stage(crawled_dirs),
+				page_size=1000
+			)
+
+	def iter_control_stage(self, crawled_dirs):
+		for stage in DirectoryCrawl.iter_insert_dir_control_stage_queue(crawled_dirs):
+			if stage['dir_id'] is None:  # The dir's path could not be inserted (eg: it can't be encoded to UTF-8)
+				continue
+			yield (
+				self.dir_id, stage['dir_id'], stage['dir_path'], stage['crawled_on'], stage['file_count'],
+				stage['subdir_count'], stage['dir_not_found'], stage['crawl_started_on'], stage['mtime'], stage['ctime']
+			)
+
+		# The symlinked subdirs are not walked, so they get registered to be crawled on the regular schedule
+		for dc in crawled_dirs:
+			for name, ctime, mtime, is_symlink, dev, ino in dc.subdirs:
+				dir_path = os.path.join(dc.dir_path, name)
+				if is_symlink and dir_path in self.dir_ids:
+					yield self.dir_id, self.dir_ids.pop(dir_path), dir_path, None, 0, 0, False, None, None, None
+
+	@staticmethod
+	def schedule(pg, dir_path: str) -> int:
+		# Add a new dir to be bulk imported by the server. Returns the dir_id
+		with pg.cursor() as cur:
+			cur.execute("select schedule_bulk_import(%s);", (dir_path,))
+			return cur.fetchone()[0]
+
+	@staticmethod
+	def get_dir_to_import(pg):
+		# Claim the next dir to be bulk imported. Returns (dir_id, dir_path), or None if there are none to import
+		with pg.cursor() as cur:
+			cur.execute("select dir_id, dir_path from get_dir_to_bulk_import();")
+			row = cur.fetchone()
+			return (row['dir_id'], row['dir_path']) if row else None
+
+	@staticmethod
+	def install_tables(pg, drop_tables):
+		cur = pg.cursor()
+
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists directory_control_bulk_stage cascade;")
+
+		# Holds the crawled dirs of an import, until the import is done (note: this is an unlogged table)
+		cur.execute("""
+			create unlogged table if not exists directory_control_bulk_stage
+			(
+				import_dir_id	int not null,	-- dir_id of the root dir being imported
+				dir_id 			int not null,
+				dir_path		text not null,
+				crawled_on 		timestamp,		-- null = not crawled (eg: symlinked dirs)
+				file_count		int default 0,
+				subdir_count	int default 0,
+				dir_not_found	boolean default false,
+				crawl_started_on	timestamp,
+				mtime			timestamp,
+				ctime			timestamp,
+				primary key(dir_id)
+			);
+		""")
+
+		pg.commit()
+		cur.close()
+
+	@staticmethod
+	def install_indexes(pg):
+		with pg.cursor() as cur:
+			cur.execute("""
+				create index if not exists directory_control_bulk_stage_import_dir_id
+					on directory_control_bulk_stage (import_dir_id);
+				create index if not exists directory_control_bulk_import
+					on directory_control (dir_id) where bulk_import = true;
+			""")
+
+	@staticmethod
+	def install_pg_functions(pg):
+		with pg.cursor() as cur:
+			# schedule_bulk_import
+			cur.execute("""
+				create or replace function schedule_bulk_import
+				(
+					_dir_path text
+				)
+				returns int
+				as $$
+				declare
+					_dir_id int;
+				begin
+					-- Add the dir, if it is not already in the DB
+					insert into directory (dir_path)
+					values (_dir_path)
+					on conflict on constraint directory_dir_path_key do nothing;
+
+					select id into _dir_id
+					from directory
+					where dir_path = _dir_path;
+
+					-- Schedule the bulk import (unless the dir has already been crawled)
+					insert into directory_control as t
+						(dir_id, dir_path, bulk_import)
+					values
+						(_dir_id, _dir_path, true)
+					on conflict on constraint directory_control_pkey do
+						update set
+							dir_id = excluded.dir_id,
+							bulk_import = true
+						where
+							t.last_crawled is null;
+
+					return _dir_id;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+			# get_dir_to_bulk_import
+			cur.execute("""
+				create or replace function get_dir_to_bulk_import()
+				returns table
+				(
+					dir_id int,
+					dir_path text
+				)
+				as $$
+				begin
+					return query
+					with dir_list as (  -- Get the next dir to import. Skip the dirs claimed by other processes.
+						select d.dir_id
+						from directory_control d
+						where
+							d.bulk_import = true
+							and d.process_assigned_on is null
+						order by d.inserted_on
+						limit 1
+						for update skip locked
+					)
+					-- Claim the dir
+					update directory_control dc
+					set process_assigned_on = now()
+					from dir_list dl
+					where dc.dir_id=dl.dir_id
+					returning dc.dir_id, dc.dir_path;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+			# register_bulk_import
+			cur.execute("""
+				create or replace function register_bulk_import
+				(
+					_import_dir_id int
+				)
+				returns int
+				as $$
+				declare
+					_row_count int;
+				begin
+					with stg as (  -- Move the import's dirs out of the staging table
+						delete from directory_control_bulk_stage s
+						where s.import_dir_id = _import_dir_id
+						returning
+							s.dir_id, s.dir_path, s.crawled_on, s.file_count, s.subdir_count, s.dir_not_found,
+							s.crawl_started_on, s.mtime, s.ctime
+					),
+					dir_upd as (  -- Keep the crawled dirs' own metadata up to date (same as mark_dirs_crawled())
+						update directory d
+						set
+							updated_on = now(),
+							ctime = coalesce(stg.ctime, d.ctime),
+							mtime = stg.mtime
+						from stg
+						where
+							d.id = stg.dir_id
+							and stg.mtime is not null
+							and (d.mtime is distinct from stg.mtime or d.ctime is distinct from coalesce(stg.ctime, d.ctime))
+					)
+					-- Register the whole subtree as crawled, to be recrawled on the regular schedule
+					insert into directory_control as t
+						(
+							dir_id, dir_path, file_count, subdir_count, next_crawl, last_crawled, dir_missing,
+							crawled_mtime, crawled_ctime, last_crawl_started, last_full_crawl, bulk_import
+						)
+					select
+						stg.dir_id, stg.dir_path, stg.file_count, stg.subdir_count,
+						coalesce(stg.crawled_on + interval '1 day', now()),  -- Not crawled = crawl now
+						stg.crawled_on, stg.dir_not_found,
+						stg.mtime, stg.ctime, stg.crawl_started_on, stg.crawled_on, false
+					from stg
+					on conflict on constraint directory_control_pkey do
+						update set
+							dir_id = excluded.dir_id,
+							file_count = excluded.file_count,
+							subdir_count = excluded.subdir_count,
+							next_crawl = excluded.next_crawl,
+							last_crawled = excluded.last_crawled,
+							dir_missing = excluded.dir_missing,
+							crawled_mtime = excluded.crawled_mtime,
+							crawled_ctime = excluded.crawled_ctime,
+							last_crawl_started = excluded.last_crawl_started,
+							last_full_crawl = excluded.last_full_crawl,
+							bulk_import = false,
+							process_assigned_on = null;
+
+					get diagnostics _row_count = row_count;
+
+					-- Release the root dir, in case it was not staged (eg: its path could not be inserted)
+					update directory_control
+					set
+						bulk_import = false,
+						process_assigned_on = null
+					where dir_id = _import_dir_id and bulk_import = true;
+
+					return _row_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+	@staticmethod
+	def install_foreign_keys(pg):
+		pass
@@ -0,0 +1,374 @@
+from FileDbDAL.SQLUtil import SQLUtil
+from FileDbDAL.CopyWriter import CopyWriter
+from datetime import datetime
+import json
+import os
+
+
+class CatalogImport:
+	# Load an existing listing of a tree (eg: from find, an rsync log, or another catalog) straight into the directory,
+	# file, and hash tables, instead of walking the disk. The listing is streamed into a staging table with COPY in large
+	# batches, and each batch is merged in one DB call. Every imported dir is scheduled to be crawled, which verifies
+	# the listing against the disk (and removes what is no longer there).
+	#
+	# Listing formats:
+	# 	ndjson: One JSON object per line, eg:
+	# 		{"path": "/data/a.txt", "type": "f", "size": 10, "mtime": 1700000000.5, "dev": 2049, "ino": 1234, "md5": "..."}
+	# 		Only the path is required. type is "f" (default) or "d". The times are epoch seconds or ISO 8601 strings.
+	# 		The optional md5/sha1 hashes are loaded into the hash table (the files then won't be hashed again).
+	# 	find: The output of: find /data -printf '%y\t%s\t%T@\t%A@\t%D\t%i\t%p\n'
+	# 		Symlinks and special files are left for the verifying crawl.
+	#
+	# The listed dirs and the dirs that contain the listed files are added. Their own parent dirs are not, so a listing
+	# of /data does not add (and crawl) all of /.
+
+	FORMATS = ('ndjson', 'find')
+	FIND_PRINTF = r'%y\t%s\t%T@\t%A@\t%D\t%i\t%p\n'
+
+	# Columns of catalog_import_stage, in the order of the COPY rows
+	STAGE_COLUMNS = (
+		'import_id', 'is_dir', 'dir_path', 'name', 'size', 'ctime', 'mtime', 'atime', 'dev', 'ino', 'md5_hash',
+		'sha1_hash'
+	)
+
+	def __init__(self, pg, listing_file: str, listing_format: str = 'ndjson', batch_size: int = 100000):
+		if listing_format not in CatalogImport.FORMATS:
+			raise ValueError(f"Unknown listing format: {listing_format}. Expected one of: {', '.join(self.FORMATS)}")
+
+		self.pg = pg
+		self.listing_file = listing_file
+		self.listing_format = listing_format
+		self.batch_size = batch_size  # Number of listing entries to COPY and merge at a time
+		self.import_id = None  # Identifies this import's staged rows (the DB connection's backend PID)
+
+		self.dir_count = 0
+		self.file_count = 0
+		self.hash_count = 0
+		self.skipped_count = 0  # Lines that could not be parsed
+
+	def run(self) -> None:
+		with self.pg.cursor() as cur:
+			cur.execute("select pg_backend_pid();")
+			self.import_id = cur.fetchone()[0]
+			# Clear out the rows left behind by an earlier import that failed on a connection with the same PID
+			cur.execute("delete from catalog_import_stage where import_id = %s;", (self.import_id,))
+
+		batch = []
+		for row in self.iter_listing():
+			batch.append(row)
+			if len(batch) >= self.batch_size:
+				self.flush(batch)
+				batch = []
+
+		self.flush(batch)
+
+		# The listing is in no particular order, so the dirs get linked to their parent dirs once they are all in
+		with self.pg.cursor() as cur:
+			cur.execute("select link_orphan_dirs();")
+
+	def iter_listing(self):
+		# Yield the staging rows of the listing's entries
+		parse_line = self.parse_ndjson_line if self.listing_format == 'ndjson' else self.parse_find_line
+		with open(self.listing_file, 'rb') as f:
+			for line in f:
+				try:
+					row = parse_line(line.decode('utf-8').rstrip('\r\n'))
+				except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+					# The path can't be stored as UTF-8, or the line is malformed. The verifying crawl will find the entry.
+					self.skipped_count += 1
+					continue
+
+				if row is not None:
+					yield row
+
+	@staticmethod
+	def parse_ndjson_line(line: str):
+		if not line.strip():
+			return None
+
+		entry = json.loads(line)
+		return CatalogImport.build_row(
+			entry['path'],
+			str(entry.get('type', 'f')).lower() in ('d', 'dir', 'directory'),
+			entry.get('size'),
+			entry.get('ctime'),
+			entry.get('mtime'),
+			entry.get('atime'),
+			entry.get('dev'),
+			entry.get('ino'),
+			entry.get('md5'),
+			entry.get('sha1'),
+		)
+
+	@staticmethod
+	def parse_find_line(line: str):
+		if not line:
+			return None
+
+		# The path is last, so any tabs in it are kept
+		file_type, size, mtime, atime, dev, ino, path = line.split('\t', 6)
+		if file_type not in ('f', 'd'):  # Skip the symlinks, sockets, etc
+			return None
+
+		return CatalogImport.build_row(path, file_type == 'd', int(size), None, mtime, atime, int(dev), int(ino))
+
+	@staticmethod
+	def build_row(
+			path: str, is_dir: bool, size=None, ctime=None, mtime=None, atime=None, dev=None, ino=None, md5_hash=None,
+			sha1_hash=None
+	) -> tuple:
+		# Build the staging row (without the import_id). Files are split into their dir's path and their name.
+		path = os.path.normpath(path)
+		if is_dir:
+			dir_path, name = path, None
+		else:
+			dir_path, name = os.path.split(path)
+
+		has_identity = bool(ino)  # Same as the crawl: no identity without an inode number
+		return (
+			is_dir, dir_path, name,
+			None if is_dir or size is None else int(size),
+			CatalogImport.to_timestamp(ctime),
+			CatalogImport.to_timestamp(mtime),
+			None if is_dir else CatalogImport.to_timestamp(atime),
+			SQLUtil.to_bigint(int(dev)) if has_identity and dev is not None else None,
+			SQLUtil.to_bigint(int(ino)) if has_identity else None,
+			None if is_dir else md5_hash,
+			None if is_dir else sha1_hash,
+		)
+
+	@staticmethod
+	def to_timestamp(value):
+		# Epoch seconds (number or numeric string), or an ISO 8601 string -> datetime
+		if value is None or value == '':
+			return None
+		try:
+			return datetime.fromtimestamp(float(value))
+		except ValueError:
+			return datetime.fromisoformat(value)
+
+	def flush(self, rows: list) -> None:
+		if not rows:
+			return
+
+		with self.pg.cursor() as cur:
+			CopyWriter('catalog_import_stage', self.STAGE_COLUMNS).copy(
+				cur, ((self.import_id,) + row for row in rows)
+			)
+
+			# Merge the batch into the directory, file, and hash tables
+			cur.execute("select * from process_catalog_import_stage(%s);", (self.import_id,))
+			counts = cur.fetchone()
+			self.dir_count += counts['dir_count']
+			self.file_count += counts['file_count']
+			self.hash_count += counts['hash_count']
+
+	@staticmethod
+	def install_tables(pg, drop_tables):
+		cur = pg.cursor()
+
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists catalog_import_stage cascade;")
+
+		# Holds a batch of the listing, until it gets merged (note: this is an unlogged table)
+		cur.execute("""
+			create unlogged table if not exists catalog_import_stage
+			(
+				import_id		int not null,		-- Backend PID of the importing connection
+				is_dir			boolean not null,
+				dir_path		text not null,		-- The dir's path, or the path of the dir that contains the file
+				name			text,				-- The file's name (null for dirs)
+				size 			bigint,				-- In bytes
+				ctime			timestamp,
+				mtime			timestamp,
+				atime			timestamp,
+				dev				bigint,
+				ino				bigint,
+				md5_hash		text,
+				sha1_hash		text
+			);
+		""")
+
+		pg.commit()
+		cur.close()
+
+	@staticmethod
+	def install_indexes(pg):
+		with pg.cursor() as cur:
+			cur.execute("""
+				create index if not exists catalog_import_stage_import_id on catalog_import_stage (import_id);
+			""")
+
+	@staticmethod
+	def install_pg_functions(pg):
+		with pg.cursor() as cur:
+			# process_catalog_import_stage
+			cur.execute("""
+				create or replace function process_catalog_import_stage
+				(
+					_import_id int
+				)
+				returns table
+				(
+					dir_count int,
+					file_count int,
+					hash_count int
+				)
+				as $$
+				declare
+					_dir_count int;
+					_file_count int;
+					_hash_count int;
+					_scheduled_file_ids int[];
+				begin
+					with stg as (  -- Move the batch out of the staging table
+						delete from catalog_import_stage s
+						where s.import_id = _import_id
+						returning
+							s.is_dir, s.dir_path, s.name, s.size, s.ctime, s.mtime, s.atime, s.dev, s.ino,
+							s.md5_hash, s.sha1_hash
+					),
+					dirs as (  -- The listed dirs, and the dirs of the listed files (one row per path)
+						select distinct on (d.dir_path)
+							d.dir_path, d.ctime, d.mtime, d.dev, d.ino
+						from (
+							select s.dir_path, s.ctime, s.mtime, s.dev, s.ino, 0 as listed_order
+							from stg s
+							where s.is_dir
+							union all
+							select distinct s.dir_path, null::timestamp, null::timestamp, null::bigint, null::bigint, 1
+							from stg s
+							where not s.is_dir
+						) d
+						order by d.dir_path, d.listed_order  -- Prefer the dir's own entry, with its metadata
+					),
+					dir_ins as (
+						insert into directory as t
+							(dir_path, ctime, mtime, dev, ino)
+						select dir_path, ctime, mtime, dev, ino
+						from dirs
+						on conflict on constraint directory_dir_path_key do
+							update set  -- Always update, so that the existing dirs return their ID
+								updated_on = case
+									when t.mtime is distinct from coalesce(excluded.mtime, t.mtime) then now()
+									else t.updated_on
+								end,
+								ctime = coalesce(excluded.ctime, t.ctime),
+								mtime = coalesce(excluded.mtime, t.mtime),
+								dev = coalesce(excluded.dev, t.dev),
+								ino = coalesce(excluded.ino, t.ino)
+						returning
+							t.id, t.dir_path, (t.xmax = 0) as inserted  -- xmax is 0 for the new rows
+					),
+					files as (  -- One row per file
+						select distinct on (di.id, s.name)
+							s.name, di.id as dir_id, s.size, s.ctime, s.mtime, s.atime, s.dev, s.ino,
+							s.md5_hash, s.sha1_hash
+						from
+							stg s
+							join dir_ins di
+								on (di.dir_path=s.dir_path)
+						where not s.is_dir
+						order by di.id, s.name
+					),
+					file_ins as (
+						insert into file as f
+							(name, dir_id, size, ctime, mtime, atime, dev, ino)
+						select name, dir_id, size, ctime, mtime, atime, dev, ino
+						from files
+						on conflict on constraint file_pkey do
+							update set
+								updated_on = now(),
+								size = excluded.size,
+								ctime = excluded.ctime,
+								mtime = excluded.mtime,
+								atime = excluded.atime,
+								dev = excluded.dev,
+								ino = excluded.ino
+							where  -- Don't do empty updates
+								f.size is distinct from excluded.size
+								or f.ctime is distinct from excluded.ctime
+								or f.mtime is distinct from excluded.mtime
+								or f.atime is distinct from excluded.atime
+								or f.dev is distinct from excluded.dev
+								or f.ino is distinct from excluded.ino
+						returning
+							f.id, f.name, f.dir_id, f.mtime, f.size
+					),
+					hash_ins as (  -- Load the hashes from the listing
+						insert into hash
+							(file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time)
+						select
+							fi.id,
+							fl.md5_hash, case when fl.md5_hash is not null then now() end,
+							fl.sha1_hash, case when fl.sha1_hash is not null then now() end
+						from
+							file_ins fi
+							join files fl
+								on (fl.dir_id=fi.dir_id and fl.name=fi.name)
+						where
+							fl.md5_hash is not null or fl.sha1_hash is not null
+						on conflict on constraint hash_file_id_key do nothing
+						returning file_id
+					),
+					hc_ins as (  -- Schedule the rest of the new files for hashing (same as process_staged_files())
+						insert into hash_control as t
+							(file_id, mtime, file_size)
+						select fi.id, fi.mtime, fi.size
+						from file_ins fi
+						where
+							not exists (
+								select from hash h
+								where h.file_id=fi.id
+							)
+							and not exists (
+								select from hash_ins hi
+								where hi.file_id=fi.id
+							)
+						on conflict on constraint hash_control_pkey do
+							update set
+								mtime = excluded.mtime
+							where
+								t.mtime <> excluded.mtime
+						returning
+							t.file_id
+					),
+					ctl_ins as (  -- Schedule all of the dirs to be crawled, to verify the listing
+						insert into directory_control as t
+							(dir_id, dir_path, next_crawl)
+						select di.id, di.dir_path, now()
+						from dir_ins di
+						on conflict on constraint directory_control_pkey do
+							update set
+								next_crawl = excluded.next_crawl
+							where
+								t.next_crawl > excluded.next_crawl
+								and t.process_assigned_on is null
+					),
+					stats_queue as (  -- Refresh the dirs' stats (without waiting for the verifying crawl)
+						insert into directory_stats_queue (dir_id)
+						select di.id
+						from dir_ins di
+						on conflict on constraint directory_stats_queue_pkey do nothing
+					)
+					select
+						(select count(*) from dir_ins where inserted),
+						(select count(*) from file_ins),
+						(select count(*) from hash_ins),
+						(select array_agg(hc.file_id) from hc_ins hc)
+					into
+						_dir_count, _file_count, _hash_count, _scheduled_file_ids;
+
+					-- The listed files that were moved in from elsewhere keep their hash, instead of getting hashed again
+					perform carry_over_hashes(_scheduled_file_ids);
+
+					return query
+					select _dir_count, _file_count, _hash_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+	@staticmethod
+	def install_foreign_keys(pg):
+		pass
@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+import struct
+import io
+
+
+class CopyWriter:
+	# Stream rows into a table with COPY ... FROM STDIN, instead of INSERT statements. The rows are sent as one stream,
+	# with no SQL text to build and parse, which is much faster for the big staging flushes.
+	# COPY has no "on conflict do nothing", so those tables get the rows COPY'd into a session temp table first, and
+	# then moved into the target table with a single "insert ... select ... on conflict do nothing".
+	#
+	# The rows can be sent in the text or the binary format. Binary skips the text parsing of the values on the server,
+	# and can carry the raw bytes of bytea values.
+	#
+	# Usage:
+	# 	writer = CopyWriter('file_stage', ('name', 'dir_id', ...), on_conflict_do_nothing=True)
+	# 	CopyWriter.write(cur, [(writer, rows), ...])
+
+	FORMATS = ('text', 'binary')
+
+	BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)  # Signature, flags, and header extension length
+	BINARY_TRAILER = struct.pack('!h', -1)
+	PG_EPOCH = datetime(2000, 1, 1)  # Binary timestamps are microseconds since the Postgres epoch
+	MICROSECOND = timedelta(microseconds=1)
+
+	# {table: {column: type}}, looked up once per process (for the binary format)
+	column_types = {}
+
+	def __init__(self, table: str, columns: tuple, copy_format: str = 'text', on_conflict_do_nothing: bool = False):
+		if copy_format not in CopyWriter.FORMATS:
+			raise ValueError(f"Unknown COPY format: {copy_format}. Expected one of: {', '.join(self.FORMATS)}")
+
+		self.table = table
+		self.columns = columns
+		self.copy_format = copy_format
+		self.on_conflict_do_nothing = on_conflict_do_nothing
+		# The table that the rows are COPY'd into
+		self.copy_table = f"{table}_copy" if on_conflict_do_nothing else table
+
+	@staticmethod
+	def write(cur, batches: list) -> int:
+		# Write each writer's rows: [(writer, rows), ...]. Returns the number of rows sent.
+		# The temp tables are prepared in one call, and the rows are moved into the target tables in one call.
+		prepare_sql = ''.join(writer.prepare_sql() for writer, rows in batches)
+		if prepare_sql:
+			cur.execute(prepare_sql)
+
+		row_count = 0
+		for writer, rows in batches:
+			row_count += writer.copy(cur, rows)
+
+		merge_sql = ''.join(writer.merge_sql() for writer, rows in batches)
+		if merge_sql:
+			cur.execute(merge_sql)
+
+		return row_count
+
+	def prepare_sql(self) -> str:
+		# Create the session's temp table (once), and clear out anything left behind by a failed flush
+		if not self.on_conflict_do_nothing:
+			return ''
+		return f"""
+			create temp table if not exists {self.copy_table} as
+				select {', '.join(self.columns)} from {self.table} with no data;
+			truncate {self.copy_table};
+		"""
+
+	def merge_sql(self) -> str:
+		# Move the rows out of the temp table
+		if not self.on_conflict_do_nothing:
+			return ''
+		return f"""
+			insert into {self.table}
+				({', '.join(self.columns)})
+			select {', '.join(self.columns)}
+			from {self.copy_table}
+			on conflict do nothing;
+		"""
+
+	def copy(self, cur, rows) -> int:
+		# COPY the rows into the table. Returns the number of rows.
+		if self.copy_format == 'binary':
+			copy_buffer, row_count = self.build_binary(rows, self.get_column_types(cur))
+		else:
+			copy_buffer, row_count = self.build_text(rows)
+
+		if row_count:
+			cur.copy_expert(
+				f"copy {self.copy_table} ({', '.join(self.columns)}) from stdin with (format {self.copy_format});",
+				copy_buffer
+			)
+		return row_count
+
+	def get_column_types(self, cur) -> list:
+		# Get the types of the columns, in the order of the rows' values. Eg: ['text', 'integer', ...]
+		if self.table not in CopyWriter.column_types:
+			cur.execute(
+				"""
+				select a.attname, format_type(a.atttypid, null) as column_type
+				from pg_attribute a
+				where a.attrelid = %s::regclass and a.attnum > 0 and not a.attisdropped;
+				""",
+				(self.table,)
+			)
+			CopyWriter.column_types[self.table] = {row['attname']: row['column_type'] for row in cur}
+		types = CopyWriter.column_types[self.table]
+		return [types[column] for column in self.columns]
+
+	@staticmethod
+	def build_text(rows) -> tuple:
+		copy_buffer = io.StringIO()
+		text_value = CopyWriter.text_value
+		row_count = 0
+		for row in rows:
+			copy_buffer.write('\t'.join([text_value(value) for value in row]))
+			copy_buffer.write('\n')
+			row_count += 1
+		copy_buffer.seek(0)
+		return copy_buffer, row_count
+
+	@staticmethod
+	def text_value(value) -> str:
+		# Format the value for COPY's text format
+		if value is None:
+			return '\\N'
+		if isinstance(value, bool):
+			return 't' if value else 'f'
+		if isinstance(value, (bytes, bytearray, memoryview)):
+			return '\\\\x' + bytes(value).hex()  # bytea's hex format (with its backslash escaped)
+		return (
+			str(value)
+			.replace('\\', '\\\\')
+			.replace('\t', '\\t')
+			.replace('\n', '\\n')
+			.replace('\r', '\\r')
+		)
+
+	@staticmethod
+	def build_binary(rows, column_types: list) -> tuple:
+		# Each encoder returns the whole field: its length, followed by its value
+		encoders = [CopyWriter.BINARY_ENCODERS[column_type] for column_type in column_types]
+		field_count = struct.pack('!h', len(encoders))
+		null_field = struct.pack('!i', -1)
+		parts = [CopyWriter.BINARY_HEADER]
+		append = parts.append
+		row_count = 0
+		for row in rows:
+			append(field_count)
+			for encode, value in zip(encoders, row):
+				append(null_field if value is None else encode(value))
+			row_count += 1
+		append(CopyWriter.BINARY_TRAILER)
+		return io.BytesIO(b''.join(parts)), row_count
+
+	@staticmethod
+	def binary_text(value: str) -> bytes:
+		data = value.encode('utf-8')
+		return struct.pack('!i', len(data)) + data
+
+	@staticmethod
+	def binary_bytea(value) -> bytes:
+		data = bytes(value)
+		return struct.pack('!i', len(data)) + data
+
+	@staticmethod
+	def binary_timestamp(value) -> bytes:
+		# Accept datetimes, or the native epoch seconds (as returned by stat)
+		if not isinstance(value, datetime):
+			value = datetime.fromtimestamp(value)
+		return struct.pack('!iq', 8, (value - CopyWriter.PG_EPOCH) // CopyWriter.MICROSECOND)
+
+	# The binary formats of the column types that get COPY'd (with the length of the field in front)
+	BINARY_ENCODERS = {
+		'boolean': lambda value: b'\x00\x00\x00\x01\x01' if value else b'\x00\x00\x00\x01\x00',
+		'smallint': lambda value: struct.pack('!ih', 2, value),
+		'integer': lambda value: struct.pack('!ii', 4, value),
+		'bigint': lambda value: struct.pack('!iq', 8, value),
+		'text': binary_text.__func__,
+		'bytea': binary_bytea.__func__,
+		'timestamp without time zone': binary_timestamp.__func__,
+	}
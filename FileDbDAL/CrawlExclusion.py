@@ -0,0 +1,327 @@
+from FileDbDAL.Pg import Pg
+from Util.Mounts import Mounts
+import os
+import re
+import sys
+import time
+import traceback
+import psycopg2.extras
+
+
+class CrawlExclusion:
+	# Rules for the dirs and files that should not be crawled.
+	# The globs are compiled to regexes that work in both Python (checked while crawling, before anything is staged or
+	# stat'd) and Postgres (to purge the entries that are already in the DB). The dir patterns match the excluded dir
+	# and everything under it.
+
+	SEP = r'[/\\]'  # Path separator, for both *nix and Windows paths
+	NOT_SEP = r'[^/\\]'
+	MOUNT_REFRESH_FREQUENCY = 60  # Seconds between re-reading the mount table
+
+	def __init__(
+			self, paths: list = None, names: list = None, file_names: list = None, regex: list = None,
+			one_filesystem: bool = False, fs_types: list = None, db_config: dict = None
+	):
+		self.one_filesystem = one_filesystem  # Don't crawl into other file systems (mount points) below the crawl roots
+		self.fs_types = set(fs_types or [])  # Don't crawl into mount points of these file system types (eg: proc)
+
+		# List of (entry_type, pattern, source) tuples
+		self.rules = []
+		for glob in paths or []:  # Full path globs. Eg: "/home/*/.cache"
+			pattern = '^' + self.glob_to_regex(glob.rstrip('/\\')) + f'({self.SEP}|$)'
+			self.rules.append(('dir', pattern, f'paths: {glob}'))
+		for glob in names or []:  # Dir name globs, anywhere in the tree. Eg: "node_modules"
+			pattern = f'(^|{self.SEP})' + self.glob_to_regex(glob) + f'({self.SEP}|$)'
+			self.rules.append(('dir', pattern, f'names: {glob}'))
+		for pattern in regex or []:  # Regexes searched for in the full path (must be valid in both Python and Postgres)
+			self.rules.append(('dir', pattern, f'regex: {pattern}'))
+		for glob in file_names or []:  # File name globs. Eg: "*.tmp"
+			self.rules.append(('file', '^' + self.glob_to_regex(glob) + '$', f'file_names: {glob}'))
+
+		self.dir_regex = self.compile_rules('dir')
+		self.file_regex = self.compile_rules('file')
+
+		# The mount points to skip, from the fs_types
+		self.excluded_mounts = set()
+		self.mounts_refreshed_on = 0
+
+		# The dirs that were explicitly asked to be crawled (the drives, and the dirs without a parent). A crawl root
+		# and its subtree are never excluded, even if it is (or is inside of) an excluded mount point. A mount point
+		# that only contains a crawl root stays excluded from its parent's crawl, and the root is crawled on its own.
+		# Loaded from the DB by sync_rules(), and reloaded along with the mounts (from db_config's "POSTGRES").
+		self.crawl_roots = set()
+		self.db_config = db_config
+
+	@staticmethod
+	def from_config(config: dict, db_config: dict = None):
+		return CrawlExclusion(
+			paths=config['paths'],
+			names=config['names'],
+			file_names=config['file_names'],
+			regex=config['regex'],
+			one_filesystem=config['one_filesystem'],
+			fs_types=config['fs_types'],
+			db_config=db_config,
+		)
+
+	@staticmethod
+	def glob_to_regex(glob: str) -> str:
+		# "*" and "?" match within a single path component, "**" matches across components, and "[...]" is a char class
+		regex = ''
+		i = 0
+		while i < len(glob):
+			char = glob[i]
+			if glob.startswith('**/', i) or glob.startswith('**\\', i):  # Any number of dirs (including none)
+				regex += f'(.*{CrawlExclusion.SEP})?'
+				i += 3
+				continue
+			if glob.startswith('**', i):
+				regex += '.*'
+				i += 2
+				continue
+
+			if char == '*':
+				regex += CrawlExclusion.NOT_SEP + '*'
+			elif char == '?':
+				regex += CrawlExclusion.NOT_SEP
+			elif char in '/\\':
+				regex += CrawlExclusion.SEP
+			elif char == '[':
+				# Find the end of the class. A "]" right after the "[" (or "[!") is part of the class
+				end = i + 1
+				if end < len(glob) and glob[end] in '!^':
+					end += 1
+				if end < len(glob) and glob[end] == ']':
+					end += 1
+				end = glob.find(']', end)
+				if end == -1:  # Not a class, so match the "[" itself
+					regex += re.escape(char)
+				else:
+					chars = glob[i + 1:end].replace('\\', '\\\\')
+					if chars.startswith('!'):
+						chars = '^' + chars[1:]
+					regex += f'[{chars}]'
+					i = end
+			else:
+				regex += re.escape(char)
+			i += 1
+		return regex
+
+	def compile_rules(self, entry_type: str):
+		# Combine the rules into a single regex, so each entry is only searched once
+		patterns = [pattern for rule_type, pattern, source in self.rules if rule_type == entry_type]
+		if not patterns:
+			return None
+		return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+	def refresh_mounts(self) -> None:
+		# The mounts and the crawl roots can change while the server runs, so re-read them periodically
+		if (
+			not (self.fs_types or self.one_filesystem)
+			or time.time() - self.mounts_refreshed_on < self.MOUNT_REFRESH_FREQUENCY
+		):
+			return
+		self.mounts_refreshed_on = time.time()
+		if self.db_config is not None:
+			self.crawl_roots = self.load_crawl_roots()
+		if self.fs_types:
+			self.excluded_mounts = {
+				mount_point for mount_point, fs_type in Mounts.get_mounts().items()
+				if fs_type in self.fs_types and not self.is_crawl_root(mount_point)
+			}
+
+	def load_crawl_roots(self) -> set:
+		# Reload the crawl roots with their own connection (the crawl processes don't all have one open)
+		try:
+			with Pg(self.db_config) as pg:
+				return self.get_crawl_roots(pg)
+		except:  # Ugh
+			print("-" * 60)
+			print("Exception occurred in load_crawl_roots. Keeping the previous crawl roots")
+			print(str(sys.exc_info()))
+			traceback.print_exc(file=sys.stdout)
+			print("-" * 60)
+			return self.crawl_roots
+
+	def get_crawl_roots(self, pg) -> set:
+		# Get the dirs that were explicitly asked to be crawled
+		with pg.cursor() as cur:
+			cur.execute("""
+				select d.drive as dir_path
+				from drive d
+				where d.drive is not null
+				union
+				select d.dir_path
+				from directory d
+				where d.parent_id is null;
+			""")
+			return {row['dir_path'].rstrip('/\\') or row['dir_path'] for row in cur}
+
+	def is_crawl_root(self, path: str) -> bool:
+		# Eg: "/mnt/data", when it is crawled as its own root. Then it is not pruned, even if it is another file system.
+		return path in self.crawl_roots
+
+	@staticmethod
+	def is_in_subtree(path: str, root_path: str) -> bool:
+		return path == root_path or path.startswith(os.path.join(root_path, ''))  # Add the trailing slash
+
+	def get_mount_pattern(self, mount_point: str) -> str:
+		# Match the mount point and everything under it, except for the crawl roots inside of it and their subtrees.
+		# Eg: "/mnt/data" is purged, except for "/mnt/data/photos" when that is crawled as its own root.
+		roots = [
+			root for root in sorted(self.crawl_roots) if root != mount_point and self.is_in_subtree(root, mount_point)
+		]
+		return (
+			'^' + ''.join(f'(?!{re.escape(root)}({self.SEP}|$))' for root in roots)
+			+ re.escape(mount_point) + f'({self.SEP}|$)'
+		)
+
+	def is_excluded(self, path: str, name: str, is_dir: bool) -> bool:
+		# Check the entry's path/name. This does not need a stat, so it is checked while listing.
+		if is_dir:
+			if path in self.excluded_mounts:
+				return True
+			return self.dir_regex is not None and self.dir_regex.search(path) is not None
+		return self.file_regex is not None and self.file_regex.search(name) is not None
+
+	def is_other_filesystem(self, parent_dev: int, dev: int, path: str = None) -> bool:
+		# Is the subdir on a different file system than its parent? (st_dev is 0 when it is unknown, eg: on Windows)
+		# A crawl root is never treated as another file system, because it was explicitly asked to be crawled.
+		return (
+			self.one_filesystem and bool(parent_dev) and bool(dev) and parent_dev != dev
+			and not (path is not None and self.is_crawl_root(path))
+		)
+
+	def get_mount_rules(self, pg) -> list:
+		# Build the rules for the mount points that are currently excluded, to purge them from the DB
+		# The crawl roots (and their subtrees) are left out of the rules, so that a root is never purged.
+		rules = []
+		mounts = Mounts.get_mounts()
+
+		for mount_point, fs_type in mounts.items():
+			if fs_type in self.fs_types and not self.is_crawl_root(mount_point):
+				rules.append(('dir', self.get_mount_pattern(mount_point), f'fs_types: {fs_type}'))
+
+		if self.one_filesystem and mounts:
+			# Exclude the other file systems below the crawl roots
+			for root in sorted(self.crawl_roots):
+				try:
+					root_dev = os.stat(root).st_dev
+				except OSError:
+					continue
+				for mount_point in Mounts.get_mount_points_under(root, mounts):
+					try:
+						mount_dev = os.stat(mount_point).st_dev
+					except OSError:
+						continue
+					if self.is_other_filesystem(root_dev, mount_dev, mount_point):
+						rules.append(('dir', self.get_mount_pattern(mount_point), f'one_filesystem: {root}'))
+
+		return rules
+
+	def sync_rules(self, pg) -> int:
+		# Replace the rules in the DB, and queue the entries that are now excluded to be removed.
+		# Returns the number of dirs and files queued for removal.
+		self.crawl_roots = self.get_crawl_roots(pg)
+		self.mounts_refreshed_on = 0  # Re-read the mounts, to leave out the crawl roots
+		with pg.cursor() as cur:
+			cur.execute("delete from crawl_exclusion;")
+			psycopg2.extras.execute_values(
+				cur,
+				"""
+				insert into crawl_exclusion
+					(entry_type, pattern, source)
+				values
+					%s
+				on conflict on constraint crawl_exclusion_pkey do nothing;
+				""",
+				self.rules + self.get_mount_rules(pg)
+			)
+			cur.execute("select purge_excluded_entries();")
+			return cur.fetchone()[0]
+
+	@staticmethod
+	def install_tables(pg, drop_tables):
+		cur = pg.cursor()
+
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists crawl_exclusion cascade;")
+
+		# The rules are synced from the config when the server starts
+		cur.execute("""
+			create table if not exists crawl_exclusion
+			(
+				entry_type		text not null,	-- 'dir' (matched against the full path) or 'file' (matched against the name)
+				pattern			text not null,	-- Regex
+				source			text,			-- The config rule that generated the pattern
+				inserted_on 	timestamp not null default now(),
+				primary key(entry_type, pattern)
+			);
+		""")
+
+		pg.commit()
+		cur.close()
+
+	@staticmethod
+	def install_indexes(pg):
+		pass
+
+	@staticmethod
+	def install_pg_functions(pg):
+		with pg.cursor() as cur:
+			# purge_excluded_entries
+			cur.execute("""
+				create or replace function purge_excluded_entries()
+				returns int
+				as $$
+				declare
+					_dir_count int;
+					_file_count int;
+				begin
+					-- Stop crawling the excluded dirs
+					delete from directory_control dc
+					where exists (
+						select from crawl_exclusion e
+						where
+							e.entry_type = 'dir'
+							and dc.dir_path ~ e.pattern
+					);
+
+					-- Queue the excluded dirs to be removed (along with their files).
+					-- The dir patterns match the whole subtree, so each subdir gets queued directly.
+					insert into db_removal_directory_staging (dir_id, delete_subdirs)
+					select d.id, false
+					from directory d
+					where exists (
+						select from crawl_exclusion e
+						where
+							e.entry_type = 'dir'
+							and d.dir_path ~ e.pattern
+					)
+					on conflict on constraint db_removal_directory_staging_pkey do nothing;
+
+					get diagnostics _dir_count = row_count;
+
+					-- Queue the excluded files to be removed
+					insert into db_removal_file_staging (file_id)
+					select f.id
+					from file f
+					where exists (
+						select from crawl_exclusion e
+						where
+							e.entry_type = 'file'
+							and f.name ~ e.pattern
+					)
+					on conflict on constraint db_removal_file_staging_pkey do nothing;
+
+					get diagnostics _file_count = row_count;
+
+					return _dir_count + _file_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+	@staticmethod
+	def install_foreign_keys(pg):
+		pass
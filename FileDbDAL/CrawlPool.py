@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+
+class CrawlPool:
+	# Crawl multiple directories at once with a bounded pool of threads.
+	# Listing and stat calls spend most of their time waiting on the disk (or the network, for NFS/SMB mounts), so the
+	# threads overlap those waits across the queued directories, and across the entries of large directories.
+	# Only the calling thread submits work to the pool, so a thread never waits on work queued behind it.
+
+	def __init__(self, pool_size: int, entry_chunk_size: int = 500, exclusion=None, throttle=None):
+		self.pool_size = pool_size
+		self.entry_chunk_size = entry_chunk_size  # Number of entries each thread stats at a time
+		self.exclusion = exclusion  # CrawlExclusion rules to apply to the entries (None = crawl everything)
+		self.throttle = throttle  # Optional function that is passed the number of I/O ops, and sleeps to pace them
+		self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+		self.listing = {}  # {future: DirectoryCrawl} Directories being listed
+		self.scraping = {}  # {future: DirectoryCrawl} Chunks of entries being stat'd
+		self.chunks_remaining = {}  # {id(DirectoryCrawl): int} Number of unfinished chunks for each directory
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.executor.shutdown(wait=True)
+
+	def dir_count(self) -> int:
+		# Number of directories currently being crawled
+		return len(self.listing) + len(self.chunks_remaining)
+
+	def submit(self, dc) -> None:
+		# Start listing the directory. Its entries are scraped once the listing is done.
+		self.listing[self.executor.submit(self.run_throttled, 1, dc.list_dir_contents, self.exclusion)] = dc
+
+	def iter_crawled(self, timeout: float = 0.2):
+		# Yield the directories (DirectoryCrawl objects) that are finished being crawled
+		futures = list(self.listing) + list(self.scraping)
+		if not futures:  # Nothing to wait on
+			time.sleep(timeout)
+			return
+
+		done, not_done = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+		for future in done:
+			# Was this a listing of a directory?
+			if future in self.listing:
+				dc = self.listing.pop(future)
+				entries = future.result()
+
+				# Split the entries into chunks, to be stat'd by the threads
+				chunks = [
+					entries[i:i + self.entry_chunk_size] for i in range(0, len(entries), self.entry_chunk_size)
+				]
+				if not chunks:  # Empty (or missing) directory
+					dc.finish_crawl()
+					yield dc
+					continue
+
+				self.chunks_remaining[id(dc)] = len(chunks)
+				for chunk in chunks:
+					self.scraping[
+						self.executor.submit(self.run_throttled, len(chunk), dc.build_entry_objects, chunk, self.exclusion)
+					] = dc
+
+			# ...Or a chunk of entries that got stat'd?
+			else:
+				dc = self.scraping.pop(future)
+				self.chunks_remaining[id(dc)] -= 1
+				if self.chunks_remaining[id(dc)] == 0:  # Are all of the directory's entries scraped?
+					del self.chunks_remaining[id(dc)]
+					dc.finish_crawl()
+					yield dc
+
+				future.result()  # Raise any exception from the thread
+
+	def run_throttled(self, ops: int, fn, *args):
+		# Wait for the I/O budget within the pool's thread, so the calling thread keeps collecting the finished crawls
+		if self.throttle is not None:
+			self.throttle(ops)
+		return fn(*args)
@@ -2,10 +2,11 @@ import os
 import platform
 import datetime
 import FileDbDAL
-import time
 
 
 class Directory:
+	__slots__ = ('id', 'dir_path', 'ctime', 'mtime', 'inserted_on', 'deleted_on', 'name', 'is_symlink', 'dev', 'ino')
+
 	def __init__(self, dir_path, last_crawled=datetime.datetime.now()):
 		self.id = 0
 		self.dir_path = dir_path
@@ -14,23 +15,40 @@ class Directory:
 		self.inserted_on = ""
 		self.deleted_on = ""
 		self.name = ""
+		self.is_symlink = False
+		self.dev = 0  # Device (file system) ID
+		self.ino = 0  # Inode number. Together with the dev, identifies the dir across renames and moves
+
+	# Build the Directory from an os.scandir() entry, reusing the stat data that the directory listing already collected
+	@staticmethod
+	def from_dir_entry(entry: os.DirEntry):
+		directory = Directory(entry.path)
+		try:
+			directory.is_symlink = entry.is_symlink()
+			directory.populate_from_stat(entry.stat())
+		except:
+			print(f"Unable to collect metadata from {directory.dir_path}")
+		return directory
 
 	# Get the metadata for the directory
 	def scrape_metadata(self):
-		# Only Windows has the ctime stored for a directory
 		try:
-			if platform.system() == "Windows":
-				self.ctime = time.ctime(os.path.getctime(self.dir_path))
-			self.mtime = time.ctime(os.path.getmtime(self.dir_path))
+			self.populate_from_stat(os.stat(self.dir_path))
 		except:
 			print(f"Unable to collect metadata from {self.dir_path}")
 
-	def staging_table_dict(self):
-		return {
-			'dir_path': self.dir_path,
-			'ctime': self.ctime,
-			'mtime': self.mtime,
-		}
+	def populate_from_stat(self, stat: os.stat_result):
+		# Only Windows has the ctime stored for a directory
+		if platform.system() == "Windows":
+			self.ctime = stat.st_ctime
+		self.mtime = stat.st_mtime  # Epoch (see File.populate_from_stat())
+		self.dev = stat.st_dev
+		self.ino = stat.st_ino  # 0 on Windows, from a DirEntry's stat
+
+	def staging_table_row(self) -> tuple:
+		# Packed row for the crawl payload (the path is rebuilt from the crawled dir's path):
+		# (name, ctime, mtime, is_symlink, dev, ino)
+		return os.path.basename(self.dir_path), self.ctime, self.mtime, self.is_symlink, self.dev, self.ino
 
 	# Insert the directory into the database
 	def insert_new_directory(self, pg):
@@ -92,12 +110,20 @@ class Directory:
 			(
 				id 				int generated by default as identity,
 				dir_path		text not null unique,		-- Eg: "C:/windows/system32"
+				name			text generated always as (basename(dir_path)) stored,  -- Eg: "system32"
+				parent_id		int null,			-- ID of the parent dir (null for the crawl roots)
 				ctime			timestamp null,
 				mtime			timestamp null,
+				dev				bigint null,		-- Device (file system) ID and inode number, to detect renamed/moved dirs
+				ino				bigint null,
 				inserted_on 	timestamp not null default now(),
 				updated_on	 	timestamp not null default now(),
 				primary key (id)
 			);
+			alter table directory add column if not exists dev bigint null;
+			alter table directory add column if not exists ino bigint null;
+			alter table directory add column if not exists parent_id int null;
+			alter table directory add column if not exists name text generated always as (basename(dir_path)) stored;
 		""")
 
 		# Install the table for deleted directories
@@ -129,11 +155,17 @@ class Directory:
 			create unlogged table if not exists directory_stage
 			(
 				dir_path		text not null,		-- Eg: "C:/windows/system32"
+				parent_id		int,				-- ID of the crawled dir that the subdir was found in
 				ctime			timestamp,
 				mtime			timestamp,
+				dev				bigint,
+				ino				bigint,
 				inserted_by_process_id int not null,
 				primary key (dir_path)
 			);
+			alter table directory_stage add column if not exists dev bigint;
+			alter table directory_stage add column if not exists ino bigint;
+			alter table directory_stage add column if not exists parent_id int;
 		""")
 
 		# Install the staging process table (note: this is an unlogged table)
@@ -145,9 +177,50 @@ class Directory:
 			create unlogged table if not exists directory_stage_process
 			(
 				parent_dir_path	text not null,	-- Eg: "C:/windows/system32"
+				parent_id		int,			-- ID of the crawled dir
 				delete_missing	boolean default false,	-- 1 = delete rows in directory if missing from directory_stage
 				primary key (parent_dir_path)
 			);
+			alter table directory_stage_process add column if not exists parent_id int;
+		""")
+
+		# Install the per-directory stats table: the totals of each dir's immediate contents (files and subdirs)
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists directory_stats cascade;")
+
+		cur.execute("""
+			create table if not exists directory_stats
+			(
+				dir_id				int not null,
+				file_count			int not null default 0,
+				subdir_count		int not null default 0,
+				total_size			bigint not null default 0,	-- Size of the files, in bytes
+				first_file_ctime	timestamp,	-- The files only
+				last_file_ctime		timestamp,
+				first_file_mtime	timestamp,
+				last_file_mtime		timestamp,
+				first_ctime			timestamp,	-- The files and the subdirs (the dir's activity)
+				last_ctime			timestamp,
+				first_mtime			timestamp,
+				last_mtime			timestamp,
+				updated_on			timestamp not null default now(),
+				primary key (dir_id)
+			);
+		""")
+
+		# The dirs whose contents changed (eg: deletes, renames, imports, subdirs merged by a crawl), to have their stats refreshed
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists directory_stats_queue cascade;")
+
+		cur.execute("""
+			create table if not exists directory_stats_queue
+			(
+				dir_id			int not null,
+				inserted_on		timestamp not null default now(),
+				primary key (dir_id)
+			);
 		""")
 
 		pg.commit()
@@ -157,10 +230,15 @@ class Directory:
 	def install_indexes(pg):
 		cur = pg.cursor()
 		cur.execute("""
-			create index if not exists directory_path_dir_path on directory (basepath(dir_path));
+			drop index if exists directory_path_dir_path;  -- Replaced by parent_id
+			create index if not exists directory_parent_id on directory (parent_id);
+			create index if not exists directory_dir_path_pattern on directory (dir_path text_pattern_ops);  -- Subtrees
+			create index if not exists directory_name on directory (name text_pattern_ops);  -- Name searches
+			create index if not exists directory_no_parent on directory (id) where parent_id is null;
 			create index if not exists directory_ctime on directory (ctime);
 			create index if not exists directory_mtime on directory (mtime);
 			create index if not exists directory_inserted_on on directory (inserted_on);
+			create index if not exists directory_dev_ino on directory (dev, ino) where ino is not null;
 			
 			create index if not exists directory_archive_path_dir_path on directory_archive (basepath(dir_path));
 			create index if not exists directory_archive_ctime on directory_archive (ctime);
@@ -168,7 +246,8 @@ class Directory:
 			create index if not exists directory_archive_inserted_on on directory_archive (inserted_on);
 			create index if not exists directory_archive_original_inserted_on on directory_archive (original_inserted_on);
 			
-			create index if not exists directory_stage_basepath_dir_path on directory_stage (basepath(dir_path));
+			drop index if exists directory_stage_basepath_dir_path;  -- Replaced by parent_id
+			create index if not exists directory_stage_parent_id on directory_stage (parent_id);
 			create index if not exists directory_stage_inserted_by_process_id on directory_stage (inserted_by_process_id);
 		""")
 		pg.commit()
@@ -192,6 +271,212 @@ class Directory:
 				$$ LANGUAGE plpgsql;
 			""")
 
+			# link_orphan_dirs
+			cur.execute("""
+				-- Fill in the parent_id of the dirs that were added before their parent dir (eg: a batch of a bulk/catalog
+				-- import), or before parent_id existed. The crawl roots have no parent dir in the DB, and are left as is.
+				create or replace function link_orphan_dirs()
+				returns int
+				as $$
+				declare
+					_linked_count int;
+				begin
+					update directory d
+					set parent_id = p.id
+					from directory p
+					where
+						d.parent_id is null
+						and p.dir_path = basepath(d.dir_path)
+						and p.id <> d.id;  -- Eg: basepath('/') = '/'
+
+					get diagnostics _linked_count = row_count;
+					return _linked_count;
+				end;
+				$$ LANGUAGE plpgsql;
+
+				select link_orphan_dirs();  -- Populate the existing dirs
+			""")
+
+			# refresh_directory_stats
+			cur.execute("""
+				-- Recalculate the stats of the dirs from their immediate contents. Only the given dirs are read (through
+				-- the file.dir_id and directory.parent_id indexes), so this is cheap for the few dirs that just changed.
+				-- (The first/last times can't be kept up to date by adding/subtracting, once rows get removed.)
+				create or replace function refresh_directory_stats(_dir_ids int[])
+				returns int
+				as $$
+				declare
+					_refreshed_count int;
+				begin
+					with d as (  -- The dirs to refresh (that still exist)
+						select distinct dir.id as dir_id
+						from directory dir
+						where dir.id = any(_dir_ids)
+					),
+					dequeue as (  -- They are up to date now
+						delete from directory_stats_queue q
+						using d
+						where q.dir_id = d.dir_id
+					),
+					f as (  -- Files
+						select
+							f.dir_id, count(*) as file_count, sum(coalesce(f.size, 0)) as total_size,
+							min(f.ctime) as first_ctime, max(f.ctime) as last_ctime,
+							min(f.mtime) as first_mtime, max(f.mtime) as last_mtime
+						from
+							d
+							join file f
+								on (f.dir_id = d.dir_id)
+						group by f.dir_id
+					),
+					sd as (  -- Subdirs
+						select
+							sd.parent_id as dir_id, count(*) as subdir_count,
+							min(sd.ctime) as first_ctime, max(sd.ctime) as last_ctime,
+							min(sd.mtime) as first_mtime, max(sd.mtime) as last_mtime
+						from
+							d
+							join directory sd
+								on (sd.parent_id = d.dir_id)
+						group by sd.parent_id
+					),
+					stats_ins as (
+						insert into directory_stats as t
+							(
+								dir_id, file_count, subdir_count, total_size,
+								first_file_ctime, last_file_ctime, first_file_mtime, last_file_mtime,
+								first_ctime, last_ctime, first_mtime, last_mtime
+							)
+						select
+							d.dir_id, coalesce(f.file_count, 0), coalesce(sd.subdir_count, 0), coalesce(f.total_size, 0),
+							f.first_ctime, f.last_ctime, f.first_mtime, f.last_mtime,
+							least(f.first_ctime, sd.first_ctime), greatest(f.last_ctime, sd.last_ctime),  -- (these skip nulls)
+							least(f.first_mtime, sd.first_mtime), greatest(f.last_mtime, sd.last_mtime)
+						from
+							d
+							left join f
+								on (f.dir_id = d.dir_id)
+							left join sd
+								on (sd.dir_id = d.dir_id)
+						on conflict on constraint directory_stats_pkey do
+							update set
+								updated_on = now(),
+								file_count = excluded.file_count,
+								subdir_count = excluded.subdir_count,
+								total_size = excluded.total_size,
+								first_file_ctime = excluded.first_file_ctime,
+								last_file_ctime = excluded.last_file_ctime,
+								first_file_mtime = excluded.first_file_mtime,
+								last_file_mtime = excluded.last_file_mtime,
+								first_ctime = excluded.first_ctime,
+								last_ctime = excluded.last_ctime,
+								first_mtime = excluded.first_mtime,
+								last_mtime = excluded.last_mtime
+							where  -- Don't do empty updates
+								(
+									t.file_count, t.subdir_count, t.total_size,
+									t.first_file_ctime, t.last_file_ctime, t.first_file_mtime, t.last_file_mtime,
+									t.first_ctime, t.last_ctime, t.first_mtime, t.last_mtime
+								) is distinct from (
+									excluded.file_count, excluded.subdir_count, excluded.total_size,
+									excluded.first_file_ctime, excluded.last_file_ctime,
+									excluded.first_file_mtime, excluded.last_file_mtime,
+									excluded.first_ctime, excluded.last_ctime, excluded.first_mtime, excluded.last_mtime
+								)
+					)
+					select count(*) into _refreshed_count
+					from d;
+
+					return _refreshed_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+			# process_directory_stats_queue
+			cur.execute("""
+				-- Refresh the stats of up to _dir_limit queued dirs. Returns the number of dirs refreshed (0 = caught up).
+				create or replace function process_directory_stats_queue(_dir_limit int = 10000)
+				returns int
+				as $$
+				declare
+					_dir_ids int[];
+				begin
+					with q as (
+						delete from directory_stats_queue q
+						where q.dir_id in (
+							select c.dir_id
+							from directory_stats_queue c
+							limit _dir_limit
+							for update skip locked
+						)
+						returning q.dir_id
+					)
+					select array_agg(q.dir_id) into _dir_ids
+					from q;
+
+					if _dir_ids is null then
+						return 0;
+					end if;
+
+					perform refresh_directory_stats(_dir_ids);
+					return cardinality(_dir_ids);
+				end;
+				$$ LANGUAGE plpgsql;
+
+				-- Queue up the dirs that have no stats yet (eg: the existing dirs, when the stats table is first added)
+				insert into directory_stats_queue (dir_id)
+				select d.id
+				from directory d
+				where not exists (
+					select from directory_stats s
+					where s.dir_id = d.id
+				)
+				on conflict on constraint directory_stats_queue_pkey do nothing;
+			""")
+
+			# subtree_dirs, and its overload
+			cur.execute("""
+				-- List the dir and all of the dirs under it. The subtree is read with a range scan of the dir_path
+				-- text_pattern_ops index (see path_in_subtree()), rather than walking down the tree a level at a time.
+				create or replace function subtree_dirs(_dir_id int)
+				returns table (dir_id int, dir_path text)
+				as $$
+					select d.id, d.dir_path
+					from
+						directory root
+						join directory d
+							on (path_in_subtree(d.dir_path, root.dir_path))
+					where root.id = _dir_id;
+				$$ LANGUAGE sql
+				stable;
+
+				-- Accepts the root dir's path (which doesn't have to be in the DB itself)
+				create or replace function subtree_dirs(_dir_path text)
+				returns table (dir_id int, dir_path text)
+				as $$
+					select d.id, d.dir_path
+					from directory d
+					where path_in_subtree(d.dir_path, _dir_path);
+				$$ LANGUAGE sql
+				stable;
+			""")
+
+			# subtree_stats
+			cur.execute("""
+				-- Roll up the stats of the dir and everything under it (from directory_stats)
+				create or replace function subtree_stats(_dir_id int)
+				returns table (dir_count bigint, file_count bigint, total_size numeric, last_ctime timestamp, last_mtime timestamp)
+				as $$
+					select
+						count(*), sum(s.file_count), sum(s.total_size), max(s.last_ctime), max(s.last_mtime)
+					from
+						subtree_dirs(_dir_id) d
+						left join directory_stats s
+							on (s.dir_id = d.dir_id);
+				$$ LANGUAGE sql
+				stable;
+			""")
+
 			# delete_directory, and its overloads
 			cur.execute("""
 				-- Base function. Accepts an array of dir ID ints
@@ -214,14 +499,13 @@ class Directory:
 
 					-- Delete subdirs
 					subdirs as (  -- Get the list of subdirs to delete (if subdirs are meant to be deleted)
-						select subdir.id as dir_id
+						select distinct sd.dir_id
 						from
-							directory parent
-							join dirs inp
-								on (parent.id=inp.dir_id)
-							join directory subdir
-								on (subdir.dir_path like sql_path_parse_wildcard_search(parent.dir_path) || '_%')
-						where _delete_subdirs = true
+							dirs inp
+							cross join lateral subtree_dirs(inp.dir_id) sd
+						where
+							_delete_subdirs = true
+							and sd.dir_id <> inp.dir_id
 					),
 					del_subdirs_now as (  -- Delete the subdirs immediately
 						select t.id, t."type"
@@ -241,7 +525,7 @@ class Directory:
 						insert into db_removal_directory_staging (dir_id, delete_subdirs)
 						select sd.dir_id, false -- Don't enable delete_subdirs, since this already inserts the CURRENT list of subdirs
 						from subdirs sd
-						where _delete_children_immediately = true
+						where _delete_children_immediately = false
 						on conflict on constraint db_removal_directory_staging_pkey do nothing
 						returning dir_id as id
 					),
@@ -286,7 +570,19 @@ class Directory:
 						delete from directory t
 						using dirs d
 						where t.id=d.dir_id
-						returning t.id, t.dir_path, t.ctime, t.mtime, t.inserted_on, t.updated_on
+						returning t.id, t.parent_id, t.dir_path, t.ctime, t.mtime, t.inserted_on, t.updated_on
+					),
+					del_stats as (  -- Delete the dir's stats
+						delete from directory_stats t
+						using dirs d
+						where t.dir_id=d.dir_id
+					),
+					stats_queue as (  -- The parent dirs lost a subdir
+						insert into directory_stats_queue (dir_id)
+						select distinct t.parent_id
+						from del_dir t
+						where t.parent_id is not null
+						on conflict on constraint directory_stats_queue_pkey do nothing
 					),
 					archive as (  -- Copy the deleted row to the archive table
 						insert into directory_archive
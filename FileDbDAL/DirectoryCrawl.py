@@ -1,8 +1,10 @@
 from FileDbDAL.Directory import Directory
 from FileDbDAL.File import File
 from FileDbDAL.Hash import Hash
+from FileDbDAL.SQLUtil import SQLUtil
+from FileDbDAL.CopyWriter import CopyWriter
 import os
-import psycopg2.extras
+import platform
 import traceback
 import sys
 import time
@@ -11,6 +13,18 @@ import multiprocessing as MP
 
 
 class DirectoryCrawl:
+	# Crawled dirs get pickled through the multiprocessing queues, so keep them compact: no per-instance dict, and the
+	# contents are packed into tuples (see File.staging_table_row() and Directory.staging_table_row())
+	__slots__ = (
+		'next_crawl_seconds', 'id', 'dir_id', 'dir_path', 'file_count', 'subdir_count', 'next_crawl', 'crawl_frequency',
+		'process_assigned_on', 'last_crawled', 'last_active', 'inserted_on', 'updated_on', 'crawled_mtime',
+		'crawled_ctime', 'last_crawl_started', 'last_full_crawl', 'delete_missing', 'crawl_started_on', 'crawled_on',
+		'dir_not_found', 'mtime', 'ctime', 'dev', 'full_crawl', 'incremental', 'files', 'subdirs',
+	)
+
+	# Number of seconds to allow for coarse file system timestamps, when comparing them to the last crawl
+	CHANGE_TIME_RESOLUTION = 2
+
 	def __init__(self, db_row: dict = None):
 		self.next_crawl_seconds = None  # next_crawl_seconds == None: default crawl_frequency
 
@@ -27,6 +41,10 @@ class DirectoryCrawl:
 		self.last_active = None
 		self.inserted_on = None
 		self.updated_on = None
+		self.crawled_mtime = None  # The dir's mtime, as of the last crawl
+		self.crawled_ctime = None  # The dir's ctime, as of the last crawl
+		self.last_crawl_started = None
+		self.last_full_crawl = None
 
 		# Populate from the DB row
 		if db_row:
@@ -36,14 +54,28 @@ class DirectoryCrawl:
 		self.delete_missing = True
 
 		# Data for the scraping queue
+		self.crawl_started_on = None
 		self.crawled_on = None
 		self.dir_not_found = False
+		self.mtime = None  # The dir's own mtime/ctime, collected during the crawl
+		self.ctime = None
+		self.dev = 0  # The dir's device (file system) ID, collected during the crawl
+
+		# Incremental crawls only stage the files that changed since the last crawl, when the dir's listing is unchanged
+		self.full_crawl = True  # Set to False to allow an incremental crawl
+		self.incremental = False  # Set during the crawl: True if the dir is unchanged, and only changed files get staged
 
 		# Vars to hold scraping content
-		self.subdir_names = []  # Name only
-		self.file_names = []  # Name only
-		self.files = {}  # Full File() instance
-		self.subdirs = {}  # Full Directory instance
+		self.files = []  # Packed rows: (name, size, ctime, mtime, atime, dev, ino). Sizes in bytes, timestamps in epoch seconds
+		self.subdirs = []  # Packed rows: (name, ctime, mtime, is_symlink, dev, ino). Timestamps in epoch seconds
+
+	def __getstate__(self):
+		# Pickle the values only, without repeating the attribute names
+		return tuple(getattr(self, attr) for attr in self.__slots__)
+
+	def __setstate__(self, state):
+		for attr, value in zip(self.__slots__, state):
+			setattr(self, attr, value)
 
 	def populate_from_db_row(self, db_row: dict) -> bool:
 		self.id = db_row['id'] if 'id' in db_row else None
@@ -58,61 +90,154 @@ class DirectoryCrawl:
 		self.last_active = db_row['last_active'] if 'last_active' in db_row else None
 		self.inserted_on = db_row['inserted_on'] if 'inserted_on' in db_row else None
 		self.updated_on = db_row['updated_on'] if 'updated_on' in db_row else None
-
-	def scrape_dir_contents(self, build_objects: bool = False) -> None:
+		self.crawled_mtime = db_row['crawled_mtime'] if 'crawled_mtime' in db_row else None
+		self.crawled_ctime = db_row['crawled_ctime'] if 'crawled_ctime' in db_row else None
+		self.last_crawl_started = db_row['last_crawl_started'] if 'last_crawl_started' in db_row else None
+		self.last_full_crawl = db_row['last_full_crawl'] if 'last_full_crawl' in db_row else None
+
+	def full_crawl_due(self, full_crawl_frequency: int = None) -> bool:
+		# Is a full crawl (re-list and re-stage everything) required, instead of an incremental crawl?
+		if not full_crawl_frequency:  # Incremental crawls are disabled
+			return True
+		if self.last_full_crawl is None or self.crawled_mtime is None or self.last_crawl_started is None:
+			return True  # Never fully crawled, so there's nothing to compare against
+		# Periodically perform a full crawl as a safety net
+		return (datetime.now() - self.last_full_crawl).total_seconds() >= full_crawl_frequency
+
+	def check_unchanged(self) -> bool:
+		# Check if the dir's listing is unchanged since the last crawl, by comparing its mtime (and ctime on Windows).
+		# Creating, deleting, or renaming an entry in the dir updates the dir's mtime.
 		try:
-			# Get the list of file and subdir names
-			root, self.subdir_names, self.file_names = next(os.walk(self.dir_path))
-
-			# Build the File and Directory objects, if necessary:
-			if build_objects:
-				for file_name in self.file_names:
-					self.files[file_name] = File(file_name, self.dir_path)
-					self.files[file_name].scrape_metadata()
-					self.files[file_name].dir_id = self.dir_id
-
-				for subdir_name in self.subdir_names:
-					self.subdirs[subdir_name] = Directory(os.path.join(self.dir_path, subdir_name))
-					self.subdirs[subdir_name].scrape_metadata()
-		except StopIteration:  # If os.walk fails (unreadable dir)
+			stat = os.stat(self.dir_path)
+		except OSError:  # Let the listing handle the missing/unreadable dir
+			return False
+
+		self.mtime = datetime.fromtimestamp(stat.st_mtime)
+		self.dev = stat.st_dev
+		# Only Windows has the ctime stored for a directory
+		if platform.system() == "Windows":
+			self.ctime = datetime.fromtimestamp(stat.st_ctime)
+
+		if self.full_crawl:
+			return False
+
+		# The mtime resolution can be coarse (eg: 2 seconds on FAT). If the dir changed at nearly the same time as the
+		# last crawl started, then a later change might not have moved the mtime, so don't trust it.
+		if (self.last_crawl_started - self.crawled_mtime).total_seconds() < self.CHANGE_TIME_RESOLUTION:
+			return False
+
+		return self.mtime == self.crawled_mtime and self.ctime == self.crawled_ctime
+
+	def scrape_dir_contents(self, build_objects: bool = False, exclusion=None) -> None:
+		# List the directory, then build the File and Directory objects from the listing's entries, if necessary
+		entries = self.list_dir_contents(exclusion)
+		if build_objects:
+			self.build_entry_objects(entries, exclusion)
+		self.finish_crawl()
+
+	def list_dir_contents(self, exclusion=None) -> list:
+		# Returns the list of (DirEntry, is_dir) tuples, to have their metadata scraped by build_entry_objects().
+		# The entries excluded by the CrawlExclusion rules are skipped, so they are never counted, stat'd, or staged.
+		entries = []
+		if exclusion is not None:
+			exclusion.refresh_mounts()
+		self.crawl_started_on = datetime.now()
+		self.file_count = 0
+		self.subdir_count = 0
+
+		# If the dir's listing has not changed, then only the files need to be checked for changes
+		self.incremental = self.check_unchanged()
+		self.delete_missing = not self.incremental  # An incremental crawl does not stage every file
+		try:
+			# List the directory with scandir, so the entry type (and on Windows, the stat) comes back with the listing
+			with os.scandir(self.dir_path) as dir_entries:
+				for entry in dir_entries:
+					try:
+						is_dir = entry.is_dir()
+					except OSError:  # Same as os.walk(): if the type cannot be determined, then treat it as a file
+						is_dir = False
+
+					if exclusion is not None and exclusion.is_excluded(entry.path, entry.name, is_dir):
+						continue
+
+					if is_dir:
+						self.subdir_count += 1
+					else:
+						self.file_count += 1
+					entries.append((entry, is_dir))
+		except OSError:  # If scandir fails (unreadable or missing dir)
 			self.dir_not_found = True
-
-		# Get the counts
-		self.subdir_count = len(self.subdir_names)  # Will default to 0
-		self.file_count = len(self.file_names)  # Will default to 0
-
-		# Mark when the crawling completed
-		self.crawled_on = datetime.now()
-
-	def iter_content_files(self):
-		for name, file in self.files.items():
-			# Make sure that the file name can be encoded to UTF-8 for DB insertion
+			# Keep the contents. The dir could have been renamed/moved, and the parent's crawl (which gets scheduled
+			# immediately) either moves the contents to the new path, or queues the dir to be removed.
+			self.delete_missing = False
+
+		return entries
+
+	def build_entry_objects(self, entries: list, exclusion=None) -> None:
+		# Build the File and Directory objects from the entries' stat data.
+		# This can be called from multiple threads at once, with each thread working on a different chunk of entries.
+		# On an incremental crawl, only the files that changed since the last crawl started are kept.
+		changed_since = None
+		if self.incremental:
+			changed_since = self.last_crawl_started.timestamp() - self.CHANGE_TIME_RESOLUTION
+
+		for entry, is_dir in entries:
+			# Make sure that the name can be encoded to UTF-8 for DB insertion. Otherwise, the entry (and a subdir's
+			# children) will not be recorded.
 			try:
-				file.name.encode('utf8')
+				entry.name.encode('utf8')
 			except UnicodeEncodeError:
-				# print(
-				# 	f"Error: File name cannot be UTF-8 encoded for database insertion. "
-				# 	f"File will not be recorded: {file.name}"
-				# )
 				continue
 
-			# Yield the file's dictionary
-			yield file.staging_table_dict()
+			if is_dir:
+				# The subdirs are unchanged on an incremental crawl, so they are not staged again
+				if not self.incremental:
+					subdir = Directory.from_dir_entry(entry)
+					# Don't cross into other file systems, if required
+					if exclusion is not None and exclusion.is_other_filesystem(self.dev, subdir.dev, entry.path):
+						continue
+					self.subdirs.append(subdir.staging_table_row())
+			else:
+				file = File.from_dir_entry(entry, self.dir_path, self.dir_id)
+				if changed_since is not None and file.change_time is not None and file.change_time < changed_since:
+					continue  # Unchanged file
+				self.files.append(file.staging_table_row())
+
+	def finish_crawl(self) -> None:
+		# Mark when the crawling completed
+		self.crawled_on = datetime.now()
 
-	def iter_content_subdirs(self):
-		for name, subdir in self.subdirs.items():
-			# Make sure that the subdir name can be encoded to UTF-8 for DB insertion
-			try:
-				subdir.dir_path.encode('utf8')
-			except UnicodeEncodeError:
-				# print(
-				# 	f"Error: Subdir name cannot be UTF-8 encoded for database insertion. The directory and its "
-				# 	f"children will not be crawled: {subdir.dir_path}"
-				# )
+	def iter_content_files(self):
+		# Yield the files' rows, with the epoch timestamps converted to datetimes:
+		# (name, dir_id, size, ctime, mtime, atime, dev, ino)
+		fromtimestamp = datetime.fromtimestamp
+		for name, size, ctime, mtime, atime, dev, ino in self.files:
+			yield (
+				name, self.dir_id, size,
+				fromtimestamp(ctime) if ctime is not None else None,
+				fromtimestamp(mtime) if mtime is not None else None,
+				fromtimestamp(atime) if atime is not None else None,
+				SQLUtil.to_bigint(dev) if ino else None,
+				SQLUtil.to_bigint(ino) if ino else None,
+			)
+
+	def iter_content_subdirs(self, include_symlinks: bool = True):
+		# Yield the subdirs' rows, with the epoch timestamps converted to datetimes:
+		# (dir_path, parent_id, ctime, mtime, dev, ino)
+		# The symlinks share their target's identity, so they get no dev/ino (and are never matched as renamed dirs).
+		fromtimestamp = datetime.fromtimestamp
+		for name, ctime, mtime, is_symlink, dev, ino in self.subdirs:
+			if is_symlink and not include_symlinks:
 				continue
-
-			# Yield the subdirectory's dictionary
-			yield subdir.staging_table_dict()
+			has_identity = ino and not is_symlink
+			yield (
+				os.path.join(self.dir_path, name),
+				self.dir_id,
+				fromtimestamp(ctime) if ctime is not None else None,
+				fromtimestamp(mtime) if mtime is not None else None,
+				SQLUtil.to_bigint(dev) if has_identity else None,
+				SQLUtil.to_bigint(ino) if has_identity else None,
+			)
 
 	@staticmethod
 	def iter_hashes_queue(load_hashes_queue):
@@ -124,7 +249,7 @@ class DirectoryCrawl:
 		while i < qsize and not load_hashes_queue.empty():
 			i += 1
 			hash = load_hashes_queue.get(True)
-			yield hash.staging_table_dict()
+			yield hash.staging_table_row()
 
 	def insert_new_drive(self, pg, drive):
 		# Populate the values
@@ -156,7 +281,9 @@ class DirectoryCrawl:
 	@staticmethod
 	def iter_insert_dir_contents_dir_finalize_queue(crawled_dirs):
 		for dc in crawled_dirs:
-			yield {'dir_path': dc.dir_path, 'delete_missing': dc.delete_missing}
+			if dc.incremental:  # The subdirs are not staged on an incremental crawl, so there's nothing to process
+				continue
+			yield {'dir_path': dc.dir_path, 'dir_id': dc.dir_id, 'delete_missing': dc.delete_missing}
 
 	@staticmethod
 	def iter_insert_dir_contents_files_queue(crawled_dirs):
@@ -179,10 +306,15 @@ class DirectoryCrawl:
 				'file_count': dc.file_count,
 				'subdir_count': dc.subdir_count,
 				'dir_not_found': dc.dir_not_found,
+				'crawl_started_on': dc.crawl_started_on,
+				'mtime': dc.mtime,
+				'ctime': dc.ctime,
+				'full_crawl': not dc.incremental,
+				'delete_missing': dc.delete_missing,
 			}
 
 	@staticmethod
-	def stage_dir_contents(pg, insert_dir_contents_queue, page_size=1000):
+	def stage_dir_contents(pg, insert_dir_contents_queue, copy_format='text', writer='copy'):
 		# Pull the objects out of the queue and into a list to get iterated over repeatedly
 		crawled_dirs = []
 		# Entries continue to get added to this queue, so only process the current items
@@ -199,141 +331,188 @@ class DirectoryCrawl:
 			except Empty:  # If the queue times out trying to pull more values, then just process what got pulled
 				continue
 
+		DirectoryCrawl.stage_crawled_dirs(pg, crawled_dirs, copy_format, writer)
+
+	@staticmethod
+	def stage_crawled_dirs(pg, crawled_dirs: list, copy_format='text', writer='copy'):
 		# Is there anything in the list of dirs?
 		if not len(crawled_dirs):
 			return
 
 		# Dump the crawled data into the staging tables
-		# Very good overview of inserting in bulk: https://hakibenita.com/fast-load-data-python-postgresql
 		try:
 			with pg.cursor() as cur:
-				# Insert the subdirs into the dir staging table
-				# TODO: Turn this into a stored proc
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-					insert into directory_stage
-						(dir_path, ctime, mtime, inserted_by_process_id) 
-					values 
-						%s
-					on conflict on constraint directory_stage_pkey do nothing;
-					""",
-					(
-						(
-							subdir['dir_path'],
-							subdir['ctime'],
-							subdir['mtime'],
-							1,  # Unneeded
-						) for subdir in DirectoryCrawl.iter_multiple_subdirs(crawled_dirs)
-					),
-					page_size=page_size
-				)
+				if writer == 'function':
+					DirectoryCrawl.call_stage_dir_contents(cur, crawled_dirs)
+				else:
+					DirectoryCrawl.copy_crawled_dirs(cur, crawled_dirs, copy_format)
 
-				# Queue the staged subdirs up to be processed
-				# TODO: Turn this into a stored proc
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-					insert into directory_stage_process
-						(parent_dir_path, delete_missing) 
-					values 
-						%s
-					on conflict on constraint directory_stage_process_pkey do nothing;
-					""",
-					(
-						(
-							stage['dir_path'],
-							stage['delete_missing'],
-						) for stage in DirectoryCrawl.iter_insert_dir_contents_dir_finalize_queue(crawled_dirs)
-					),
-					page_size=page_size
-				)
+		except:  # Ugh
+			print(str(sys.exc_info()))
+			traceback.print_exc(file=sys.stdout)
 
-				# Insert the files into the file staging table
-				# Todo: Make this a stored proc
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-						insert into file_stage
-						(name, dir_id, size, ctime, mtime, atime, inserted_by_process_id) 
-						values %s
-						on conflict on constraint file_stage_pkey do nothing;
-					""",
+	@staticmethod
+	def copy_crawled_dirs(cur, crawled_dirs: list, copy_format='text'):
+		# Stream the rows into the 5 staging tables with COPY (see CopyWriter)
+		CopyWriter.write(cur, [
+			(  # Insert the subdirs into the dir staging table
+				CopyWriter(
+					'directory_stage',
+					('dir_path', 'parent_id', 'ctime', 'mtime', 'dev', 'ino', 'inserted_by_process_id'),
+					copy_format, on_conflict_do_nothing=True
+				),
+				(
+					subdir + (1,)  # inserted_by_process_id is unneeded
+					for subdir in DirectoryCrawl.iter_multiple_subdirs(crawled_dirs)
+				)
+			),
+			(  # Queue the staged subdirs up to be processed
+				CopyWriter(
+					'directory_stage_process', ('parent_dir_path', 'parent_id', 'delete_missing'),
+					copy_format, on_conflict_do_nothing=True
+				),
+				(
 					(
-						(
-							file['name'],
-							file['dir_id'],
-							file['size'],
-							file['ctime'],
-							file['mtime'],
-							file['atime'],
-							1,  # Unneeded
-						) for file in DirectoryCrawl.iter_insert_dir_contents_files_queue(crawled_dirs)
-					),
-					page_size=page_size
+						stage['dir_path'],
+						stage['dir_id'],
+						stage['delete_missing'],
+					) for stage in DirectoryCrawl.iter_insert_dir_contents_dir_finalize_queue(crawled_dirs)
 				)
-
-				# Queue the staged files to be processed
-				# Todo: Make this a stored proc
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-						insert into file_stage_process
-						(dir_id, delete_missing) 
-						values %s
-						on conflict on constraint file_stage_process_pkey do nothing;
-					""",
+			),
+			(  # Insert the files into the file staging table
+				CopyWriter(
+					'file_stage',
+					('name', 'dir_id', 'size', 'ctime', 'mtime', 'atime', 'dev', 'ino', 'inserted_by_process_id'),
+					copy_format, on_conflict_do_nothing=True
+				),
+				(
+					file + (1,)  # inserted_by_process_id is unneeded
+					for file in DirectoryCrawl.iter_insert_dir_contents_files_queue(crawled_dirs)
+				)
+			),
+			(  # Queue the staged files to be processed
+				CopyWriter(
+					'file_stage_process', ('dir_id', 'delete_missing'),
+					copy_format, on_conflict_do_nothing=True
+				),
+				(
 					(
-						(
-							stage['dir_id'],
-							stage['delete_missing'],
-						) for stage in DirectoryCrawl.iter_insert_dir_contents_files_finalize_queue(crawled_dirs)
-					),
-					page_size=page_size
+						stage['dir_id'],
+						stage['delete_missing'],
+					) for stage in DirectoryCrawl.iter_insert_dir_contents_files_finalize_queue(crawled_dirs)
 				)
-
-				# Stage the crawled directory to be marked as crawled
-				# Todo: Make this a stored proc
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-						insert into directory_control_process
-						(dir_id, dir_path, crawled_on, file_count, subdir_count, dir_not_found) 
-						values %s
-						on conflict on constraint directory_control_process_pkey do nothing;
-					""",
+			),
+			(  # Stage the crawled directory to be marked as crawled
+				CopyWriter(
+					'directory_control_process',
 					(
-						(
-							stage['dir_id'],
-							stage['dir_path'],
-							stage['crawled_on'],
-							stage['file_count'],
-							stage['subdir_count'],
-							stage['dir_not_found'],
-						) for stage in DirectoryCrawl.iter_insert_dir_control_stage_queue(crawled_dirs)
+						'dir_id', 'dir_path', 'crawled_on', 'file_count', 'subdir_count', 'dir_not_found',
+						'crawl_started_on', 'mtime', 'ctime', 'full_crawl'
 					),
-					page_size=page_size
+					copy_format, on_conflict_do_nothing=True
+				),
+				(
+					(
+						stage['dir_id'],
+						stage['dir_path'],
+						stage['crawled_on'],
+						stage['file_count'],
+						stage['subdir_count'],
+						stage['dir_not_found'],
+						stage['crawl_started_on'],
+						stage['mtime'],
+						stage['ctime'],
+						stage['full_crawl'],
+					) for stage in DirectoryCrawl.iter_insert_dir_control_stage_queue(crawled_dirs)
 				)
+			),
+		])
 
-		except:  # Ugh
-			print(str(sys.exc_info()))
-			traceback.print_exc(file=sys.stdout)
+	@staticmethod
+	def call_stage_dir_contents(cur, crawled_dirs: list):
+		# Stage everything with a single call of the stage_dir_contents() function, with the rows passed as column
+		# arrays. The 5 staging tables are written in one round trip (and one transaction).
+		subdir_columns = DirectoryCrawl.to_column_lists(DirectoryCrawl.iter_multiple_subdirs(crawled_dirs), 6)
+		file_columns = DirectoryCrawl.to_column_lists(DirectoryCrawl.iter_insert_dir_contents_files_queue(crawled_dirs), 8)
+		dir_columns = DirectoryCrawl.to_column_lists(
+			(
+				(
+					stage['dir_id'],
+					stage['dir_path'],
+					stage['delete_missing'],
+					stage['full_crawl'],
+					stage['crawled_on'],
+					stage['file_count'],
+					stage['subdir_count'],
+					stage['dir_not_found'],
+					stage['crawl_started_on'],
+					stage['mtime'],
+					stage['ctime'],
+				) for stage in DirectoryCrawl.iter_insert_dir_control_stage_queue(crawled_dirs)
+			),
+			11
+		)
+		cur.execute(
+			"""
+			select stage_dir_contents(
+				%s::text[], %s::int[], %s::timestamp[], %s::timestamp[], %s::bigint[], %s::bigint[],
+				%s::text[], %s::int[], %s::bigint[], %s::timestamp[], %s::timestamp[], %s::timestamp[],
+				%s::bigint[], %s::bigint[],
+				%s::int[], %s::text[], %s::boolean[], %s::boolean[], %s::timestamp[], %s::int[], %s::int[],
+				%s::boolean[], %s::timestamp[], %s::timestamp[], %s::timestamp[]
+			);
+			""",
+			subdir_columns + file_columns + dir_columns
+		)
+
+	@staticmethod
+	def to_column_lists(rows, column_count: int) -> list:
+		# Turn the rows into a Postgres array literal per column (the arrays for unnest()), eg: '{"a","b",NULL}'.
+		# The literals are parsed by the server's array input in one go, which is much faster than psycopg2's
+		# ARRAY[...] of individually quoted and cast values.
+		columns = [[] for _ in range(column_count)]
+		for row in rows:
+			for column, value in zip(columns, row):
+				column.append(value)
+		return ['{' + ','.join([DirectoryCrawl.array_element(value) for value in column]) + '}' for column in columns]
+
+	@staticmethod
+	def array_element(value) -> str:
+		# Format the value as an element of a Postgres array literal
+		if value is None:
+			return 'NULL'
+		if isinstance(value, bool):
+			return 't' if value else 'f'
+		if isinstance(value, int):
+			return str(value)
+		return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
 
 	# print(f"*- Staged ({round((time.time() - start_time), 3)})): {self.dir_path}")
 
 	@staticmethod
-	def process_staged_dir_contents(pg):
+	def process_staged_dir_contents(pg, dir_limit: int = 1000) -> int:
+		# Merge one chunk (up to dir_limit crawled dirs) of the staged contents. Call it until it returns 0 to merge the
+		# whole backlog. Returns the number of crawled dirs merged (plus the number of dirs whose stats were refreshed).
+		merged_count = 0
 		with pg.cursor() as cur:
 			try:
+				# Move the renamed/moved dirs to their new paths, before the old paths get queued to be removed
+				cur.execute("select process_renamed_dirs()")
 				# Upsert into directory and schedule the crawling of the subdirs
-				cur.execute("select process_staged_dirs()")
+				cur.execute("select * from process_staged_dirs(%s)", (dir_limit,))
+				merged_count += cur.fetchone()['dir_count']
 				# Upsert into file and schedule the hashing of the files
-				cur.execute("select process_staged_files()")
+				cur.execute("select * from process_staged_files(%s)", (dir_limit,))
+				merged_count += cur.fetchone()['dir_count']
 				# Mark the directories as crawled, so that they can be rescheduled and crawled again
 				cur.execute("select mark_dirs_crawled()")
+				# Refresh the stats of the dirs that changed outside of a crawl (eg: deletes, imports)
+				cur.execute("select process_directory_stats_queue(%s)", (dir_limit,))
+				merged_count += cur.fetchone()[0]
 			except:  # Ugh
 				print(str(sys.exc_info()))
 				traceback.print_exc(file=sys.stdout)
+		return merged_count
 
 	@staticmethod
 	def process_db_removal_file(pg, row_limit: int = 10000):
@@ -356,34 +535,34 @@ class DirectoryCrawl:
 				traceback.print_exc(file=sys.stdout)
 
 	@staticmethod
-	def stage_hashes(pg, load_hashes_queue, page_size=1000):
-		# Very good overview of inserting in bulk: https://hakibenita.com/fast-load-data-python-postgresql
-
-		# Insert the hashes from the queue
+	def stage_hashes(pg, load_hashes_queue, batch_rows: int = 50000, batch_bytes: int = 8 * 1024 * 1024) -> int:
+		# Load the hashes from the queue into hash_stage with binary COPY, carrying the raw digests.
+		# The rows are sent in batches that are capped by both the row count and the size of the COPY stream.
+		# Returns the number of hashes that were staged.
+		writer = CopyWriter(
+			'hash_stage', ('file_id', 'md5_digest', 'md5_hash_time', 'sha1_digest', 'sha1_hash_time'),
+			'binary', on_conflict_do_nothing=True
+		)
+		row_bytes = 2 + 5 * 4 + 4 + 8 + 8  # Binary COPY size of a row, besides the digests: field count, lengths, values
+		staged_count = 0
 		try:
 			with pg.cursor() as cur:
-				psycopg2.extras.execute_values(
-					cur,
-					"""
-					insert into hash_stage
-					(file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time)
-					values %s
-					on conflict do nothing;
-					""",
-					(
-						(
-							hash['file_id'],
-							hash['md5_hash'],
-							hash['md5_hash_time'],
-							hash['sha1_hash'],
-							hash['sha1_hash_time']
-						) for hash in DirectoryCrawl.iter_hashes_queue(load_hashes_queue)
-					),
-					page_size=page_size
-				)
+				batch = []
+				batch_size = 0  # In bytes
+				for row in DirectoryCrawl.iter_hashes_queue(load_hashes_queue):
+					batch.append(row)
+					batch_size += row_bytes + len(row[1] or b'') + len(row[3] or b'')
+					if len(batch) >= batch_rows or batch_size >= batch_bytes:
+						staged_count += CopyWriter.write(cur, [(writer, batch)])
+						batch = []
+						batch_size = 0
+
+				if batch:
+					staged_count += CopyWriter.write(cur, [(writer, batch)])
 		except:  # Ugh
 			print(str(sys.exc_info()))
 			traceback.print_exc(file=sys.stdout)
+		return staged_count
 
 	@staticmethod
 	def process_staged_hashes(pg):
@@ -450,12 +629,19 @@ class DirectoryCrawl:
 		return dirs
 
 	@staticmethod
-	def get_dirs_to_crawl(pg, crawl_dir_queue, process_id: int, limit: int = 10) -> int:
-		# Get the dirs
+	def get_dirs_to_crawl(
+		pg, crawl_dir_queue, process_id: int, limit: int = 10, full_crawl_frequency: int = None,
+		include_paths: list = None, exclude_paths: list = None
+	) -> int:
+		# Get the dirs (optionally only the ones under include_paths, eg: the mount points of a single device)
 		try:
 			with pg.cursor() as cur:
-				cur.execute("select dir_path, last_crawled, dir_id from get_dirs_to_crawl(%s, %s);",
-							(process_id, limit))
+				cur.execute("""
+					select dir_path, last_crawled, dir_id, crawled_mtime, crawled_ctime, last_crawl_started, last_full_crawl
+					from get_dirs_to_crawl(%s, %s, %s::text[], %s::text[]);
+					""",
+					(process_id, limit, include_paths, exclude_paths or None)
+				)
 				# Populate the dirs list with the paths:
 				dirs = []
 				d = None
@@ -465,6 +651,8 @@ class DirectoryCrawl:
 
 					# Build the new directory object
 					d = DirectoryCrawl(db_row=row)
+					# Allow an incremental crawl if the dir had a full crawl recently
+					d.full_crawl = d.full_crawl_due(full_crawl_frequency)
 
 					# Add to the directories to be returned
 					crawl_dir_queue.put(d)
@@ -476,11 +664,30 @@ class DirectoryCrawl:
 			return 0
 
 	@staticmethod
-	def get_files_to_hash(pg, hash_files_queue, process_id: int, limit: int = 10) -> int:
-		# Get the dirs
+	def get_dirs_to_watch(pg, limit: int = 8192) -> dict:
+		# Get the dirs to watch for changes, within the budget of watches. Returns {dir_id: dir_path}
+		with pg.cursor() as cur:
+			cur.execute("select dir_id, dir_path from get_dirs_to_watch(%s);", (limit,))
+			return {row['dir_id']: row['dir_path'] for row in cur}
+
+	@staticmethod
+	def schedule_dirs_crawl_now(pg, dir_ids: list) -> int:
+		# Move the dirs to the front of the crawl schedule. Returns the number of dirs that got rescheduled
+		with pg.cursor() as cur:
+			cur.execute("select schedule_dirs_crawl_now(%s::int[]);", (list(dir_ids),))
+			return cur.fetchone()[0]
+
+	@staticmethod
+	def get_files_to_hash(
+		pg, hash_files_queue, process_id: int, limit: int = 10, include_paths: list = None, exclude_paths: list = None
+	) -> int:
+		# Get the files (optionally only the ones under include_paths, eg: the mount points of a single device)
 		try:
 			with pg.cursor() as cur:
-				cur.execute("select file_id, file_path from get_files_to_hash(%s, %s);", (process_id, limit))
+				cur.execute(
+					"select file_id, file_path from get_files_to_hash(%s, %s, %s::text[], %s::text[]);",
+					(process_id, limit, include_paths, exclude_paths or None)
+				)
 				# Populate the dirs list with the paths:
 				hashes = []
 				for row in cur:
@@ -539,11 +746,42 @@ class DirectoryCrawl:
 				last_crawled		timestamp default null,
 				last_active			timestamp default null,
 				dir_missing			boolean default false,  -- If dir cannot be found when trying to scrape it
+				crawled_mtime		timestamp default null,  -- The dir's mtime when it was last crawled
+				crawled_ctime		timestamp default null,  -- The dir's ctime when it was last crawled (Windows only)
+				last_crawl_started	timestamp default null,
+				last_full_crawl		timestamp default null,  -- Last crawl that staged the full listing (not incremental)
+				bulk_import			boolean not null default false,  -- Waiting for its whole subtree to be imported
+				changes_since_crawl	int not null default 0,  -- Files inserted/changed/deleted by the merges of the crawl
+				-- The change history, for the crawl frequency. See crawl_frequency_change_rate_calculate()
+				changed_crawls_ewma	real not null default 0,  -- The crawls that found changes (moving average)
+				crawled_seconds_ewma	real not null default 0,  -- The seconds between those crawls (moving average)
 				inserted_on 		timestamp not null default now(),
+				-- The order that the due dirs get claimed in (lowest first). See get_dirs_to_crawl()
+				crawl_priority		double precision generated always as (
+										round(file_count/100) + round(subdir_count/100)
+										- extract(epoch from next_crawl)/(60*60)
+									) stored,
 				primary key(dir_path)
 			);
 		""")
 
+		# Add the columns that were introduced after the table was first created
+		cur.execute("""
+			alter table directory_control 
+				add column if not exists crawled_mtime timestamp default null,
+				add column if not exists crawled_ctime timestamp default null,
+				add column if not exists last_crawl_started timestamp default null,
+				add column if not exists last_full_crawl timestamp default null,
+				add column if not exists bulk_import boolean not null default false,
+				add column if not exists changes_since_crawl int not null default 0,
+				add column if not exists changed_crawls_ewma real not null default 0,
+				add column if not exists crawled_seconds_ewma real not null default 0,
+				add column if not exists crawl_priority double precision generated always as (
+					round(file_count/100) + round(subdir_count/100)
+					- extract(epoch from next_crawl)/(60*60)
+				) stored;
+		""")
+
 		if drop_tables:
 			# TODO: Check if this table contains data before dropping
 			cur.execute("drop table if exists hash_control cascade;")
@@ -553,13 +791,14 @@ class DirectoryCrawl:
 			(
 				file_id				int not null,
 				mtime				timestamp,
-				file_size			numeric(18, 6), -- In MBs
+				file_size			bigint, -- In bytes
 				process_assigned_on	timestamp default null,	-- When was this assigned to be crawled?
 				file_missing		boolean default false,  -- If file cannot be found when trying to hash
 				inserted_on 		timestamp not null default now(),
 				primary key(file_id)
 			);
 		""")
+		SQLUtil.migrate_size_to_bytes(cur, 'hash_control', 'file_size')
 
 		if drop_tables:
 			# TODO: Check if this table contains data before dropping
@@ -574,11 +813,23 @@ class DirectoryCrawl:
 				file_count		int default 0,
 				subdir_count	int default 0,	
 				dir_not_found	boolean default false,
+				crawl_started_on	timestamp,
+				mtime			timestamp,	-- The crawled dir's own mtime/ctime
+				ctime			timestamp,
+				full_crawl		boolean default true,	-- false = incremental crawl (only the changed files were staged)
 				inserted_on	timestamp not null default now(),
 				primary key(dir_path)
 			);
 		""")
 
+		cur.execute("""
+			alter table directory_control_process 
+				add column if not exists crawl_started_on timestamp,
+				add column if not exists mtime timestamp,
+				add column if not exists ctime timestamp,
+				add column if not exists full_crawl boolean default true;
+		""")
+
 		if drop_tables:
 			# TODO: Check if this table contains data before dropping
 			cur.execute("drop table if exists db_removal_file_staging cascade;")
@@ -618,11 +869,16 @@ class DirectoryCrawl:
 
 			create index if not exists directory_control_dir_id on directory_control (dir_id);
 			create index if not exists directory_control_dir_path on directory_control (dir_path);
+			drop index if exists directory_control_dir_path_pattern;  -- Replaced by the case-insensitive version
+			create index if not exists directory_control_dir_path_lower
+				on directory_control (lower(dir_path) text_pattern_ops);  -- Case-insensitive path lookups, and subtrees
 			create index if not exists directory_control_next_crawl on directory_control (next_crawl);
 			create index if not exists directory_control_last_crawled on directory_control (last_crawled);
 			create index if not exists directory_control_last_active on directory_control (last_active);
 			create index if not exists directory_control_assigned_process_id on directory_control (assigned_process_id);
 			create index if not exists directory_control_inserted_on on directory_control (inserted_on);
+			create index if not exists directory_control_crawl_priority on directory_control (crawl_priority)
+				where process_assigned_on is null and bulk_import = false;  -- The unclaimed dirs, for get_dirs_to_crawl()
 
 			create index if not exists hash_control_file_size on hash_control (file_size);
 			create index if not exists hash_control_mtime on hash_control (mtime);
@@ -639,33 +895,46 @@ class DirectoryCrawl:
 		with pg.cursor() as cur:
 			# get_dirs_to_crawl
 			cur.execute(""" 
+				drop function if exists get_dirs_to_crawl(int, int);  -- The returned columns have changed over time
 				create or replace function get_dirs_to_crawl
 				(
 					_process_id int,
-					_row_limit int
+					_row_limit int,
+					_include_paths text[] default null,  -- Only crawl the dirs under these paths (null = all dirs)
+					_exclude_paths text[] default null  -- Skip the dirs under these paths
 				) 
 				returns table 
 				(
 					dir_path text, 
 					dir_id int, 
-					last_crawled timestamp
+					last_crawled timestamp,
+					crawled_mtime timestamp,
+					crawled_ctime timestamp,
+					last_crawl_started timestamp,
+					last_full_crawl timestamp
 				)
 				as $$
 				begin
+					-- The dirs are claimed in the order of: the number of hours since it was due to crawl, plus file_count/100,
+					-- plus subdir_count/100 (lowest first). Since now() is the same for every row, that is the order of
+					-- crawl_priority, which leaves out now(), so that it can be stored and read from its partial index
+					-- instead of being computed and sorted for every due dir.
+					-- A due dir's crawl_priority is always above the hours of now() (negated), so the index scan starts there,
+					-- and only skips over the dirs with enough files/subdirs to be ranked among the due ones before they are due.
 					return query
 					with dir_list as (  -- Identify the directories to crawl
 						select d.dir_id
 						from directory_control d
 						where
-							d.next_crawl < now()
+							d.crawl_priority > -extract(epoch from localtimestamp)/(60*60)
+							and d.next_crawl < now()
 							and d.process_assigned_on is null
-						order by
-							(
-								extract(epoch from now() - d.next_crawl)/(60*60) -- Number of hours since it was due to crawl
-								+ round(d.file_count/100)
-								+ round(d.subdir_count/100)
-							)
+							and d.bulk_import = false  -- These get crawled by the bulk import
+							and (_include_paths is null or path_is_under(d.dir_path, _include_paths))
+							and not path_is_under(d.dir_path, _exclude_paths)
+						order by d.crawl_priority
 						limit _row_limit
+						for update skip locked  -- Concurrent claimers skip the dirs being claimed, instead of waiting for them
 					),
 					dc_upd as (  -- Claim the directories for crawling
 						update directory_control dc
@@ -674,11 +943,13 @@ class DirectoryCrawl:
 						from dir_list dl
 						where dc.dir_id=dl.dir_id
 						returning
-							dc.dir_path, dc.dir_id, dc.last_crawled, dc.next_crawl
+							dc.dir_path, dc.dir_id, dc.last_crawled, dc.next_crawl,
+							dc.crawled_mtime, dc.crawled_ctime, dc.last_crawl_started, dc.last_full_crawl
 					)
 					-- Return the list of directories to crawl
 					select 
-						dc.dir_path, dc.dir_id, dc.last_crawled
+						dc.dir_path, dc.dir_id, dc.last_crawled,
+						dc.crawled_mtime, dc.crawled_ctime, dc.last_crawl_started, dc.last_full_crawl
 					from dc_upd dc
 					order by
 						dc.next_crawl asc;
@@ -686,12 +957,65 @@ class DirectoryCrawl:
 				$$ LANGUAGE plpgsql;
 			""")
 
+			# get_dirs_to_watch
+			cur.execute("""
+				create or replace function get_dirs_to_watch
+				(
+					_row_limit int
+				) 
+				returns table 
+				(
+					dir_id int, 
+					dir_path text
+				)
+				as $$
+				begin
+					return query
+					select dc.dir_id, dc.dir_path
+					from directory_control dc
+					where dc.dir_missing is not true
+					order by
+						dc.crawl_frequency asc,  -- The dirs that change the most often have the shortest crawl frequency
+						dc.last_crawled desc nulls last
+					limit _row_limit;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+			# schedule_dirs_crawl_now
+			cur.execute("""
+				create or replace function schedule_dirs_crawl_now
+				(
+					_dir_ids int[]
+				) 
+				returns int
+				as $$
+				declare
+					_row_count int;
+				begin
+					-- Schedule the dirs to be crawled now. get_dirs_to_crawl() orders the dirs that just became due
+					-- first, so these get claimed ahead of the backlog.
+					update directory_control dc
+					set next_crawl = now()
+					where
+						dc.dir_id = any(_dir_ids)
+						and dc.next_crawl > now();  -- Don't push back dirs that are already due
+					
+					get diagnostics _row_count = row_count;
+					return _row_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
 			# get_files_to_hash
 			cur.execute("""
+				drop function if exists get_files_to_hash(int, int);  -- Replaced by the version with the path filters
 				create or replace function get_files_to_hash
 				(
 					_process_id int,
-					_row_limit int
+					_row_limit int,
+					_include_paths text[] default null,  -- Only hash the files under these paths (null = all files)
+					_exclude_paths text[] default null  -- Skip the files under these paths
 				) 
 				returns table 
 				(
@@ -709,6 +1033,32 @@ class DirectoryCrawl:
 							hash_control f
 						where
 							f.process_assigned_on is null
+							and not exists (  -- Skip the files whose inode is already being hashed through one of its other hardlinks
+								select
+								from
+									file fi
+									join file l
+										on (l.dev=fi.dev and l.ino=fi.ino and l.id<>fi.id)
+									join hash_control lhc
+										on (lhc.file_id=l.id)
+								where
+									fi.id = f.file_id
+									and lhc.process_assigned_on is not null
+							)
+							and (
+								(_include_paths is null and _exclude_paths is null)
+								or exists (
+									select
+									from
+										file fi
+										join directory d
+											on (fi.dir_id=d.id)
+									where
+										fi.id = f.file_id
+										and (_include_paths is null or path_is_under(d.dir_path, _include_paths))
+										and not path_is_under(d.dir_path, _exclude_paths)
+								)
+							)
 							-- and f.file_size > 0
 							-- and f.file_size between 0.5 and 2500
 						order by
@@ -717,23 +1067,48 @@ class DirectoryCrawl:
 							-- ,f.mtime asc  -- Get the "most stable" (last changed longest ago) files
 						limit _row_limit
 					),
+					rep as (  -- Hash each inode once: pick one of the hardlinks (paths with the same dev and ino) to be read
+						select distinct on (fi.dev, fi.ino, case when fi.ino is null then fi.id end)
+							fl.file_id, fi.dev, fi.ino, fi.size, fi.mtime
+						from
+							file_list fl
+							join file fi
+								on (fi.id=fl.file_id)
+						order by
+							fi.dev, fi.ino, case when fi.ino is null then fi.id end, fl.file_id
+					),
+					claim as (  -- The files to hash, and the other hardlinks that get their hash in process_staged_hashes
+						-- The other hardlinks with a different size/mtime (eg: their dir was crawled after a change) don't get
+						-- the hash, so they are left unclaimed, to be hashed on their own later.
+						select r.file_id
+						from rep r
+						union
+						select l.id
+						from
+							rep r
+							join file l
+								on (l.dev=r.dev and l.ino=r.ino and l.size=r.size and l.mtime=r.mtime)
+					),
 					upd as (  -- Claim the files to hash
 						update
 							hash_control hc
 						set
 							process_assigned_on = now()
 						from
-							file_list fl
+							claim c
 						where
-							hc.file_id = fl.file_id
+							hc.file_id = c.file_id
+							and hc.process_assigned_on is null
 						returning
 							hc.file_id, hc.mtime
 					)
-					-- Return the list of directories to crawl
+					-- Return the list of files to hash (only one path per inode)
 					select 
 						f.full_path, upd.file_id, upd.mtime
 					from
 						upd 
+						join rep
+							on (upd.file_id=rep.file_id)
 						join vw_file_detail f  -- The list of files
 							on (upd.file_id=f.id);
 				end;
@@ -776,17 +1151,42 @@ class DirectoryCrawl:
 				begin
 					with stage as (
 						delete from hash_stage
-						returning file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time
+						returning  -- The digests are staged as raw bytes
+							file_id, encode(md5_digest, 'hex') as md5_hash, md5_hash_time,
+							encode(sha1_digest, 'hex') as sha1_hash, sha1_hash_time
+					),
+					linked as (  -- Fan the hash out to the other hardlinks of the file that are waiting to be hashed (the inode was read once)
+						select l.id as file_id, s.md5_hash, s.md5_hash_time, s.sha1_hash, s.sha1_hash_time
+						from
+							stage s
+							join file f
+								on (f.id=s.file_id)
+							join file l
+								on (
+									l.dev=f.dev and l.ino=f.ino
+									and l.size=f.size and l.mtime=f.mtime  -- Make sure the links were not changed since the crawl
+									and l.id<>f.id
+								)
+						where
+							exists (select from hash_control hc where hc.file_id=l.id)
+							and not exists (select from stage s2 where s2.file_id=l.id)
+					),
+					hashes as (
+						select file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time
+						from stage
+						union all
+						select distinct on (file_id) file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time
+						from linked
 					),
 					del as (
 						delete from hash_control hc
-						using stage s
-						where hc.file_id=s.file_id
+						using hashes h
+						where hc.file_id=h.file_id
 					)
 					insert into hash
 					(file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time)
 					select file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time
-					from stage
+					from hashes
 					on conflict on constraint hash_file_id_key do nothing;
 
 					return true;
@@ -796,22 +1196,34 @@ class DirectoryCrawl:
 
 			# process_staged_files
 			cur.execute("""
-				create or replace function process_staged_files()
-				returns boolean
+				drop function if exists process_staged_files();  -- Replaced by the chunked version
+				create or replace function process_staged_files(_dir_limit int = 1000)
+				returns table (dir_count int, file_count int)  -- Progress: the number of dirs and files merged
 				as $$
+				declare
+					_scheduled_file_ids int[];
+					_dir_count int;
+					_file_count int;
 				begin
-					-- Move (delete) files from staging and upsert into the file table
+					-- Move (delete) files from staging and upsert into the file table, for up to _dir_limit dirs at a time.
+					-- The dirs are claimed with "skip locked", so that several workers can merge the backlog at once.
 					-- !! IMPORTANT: Add all column names to all 5 sections below: DELETE, INSERT, SELECT, UPDATE, and WHERE
 					with stg_process as (  -- Work with the rows in the staging process table
-						delete from file_stage_process
-						returning dir_id, delete_missing
+						delete from file_stage_process p
+						where p.dir_id in (
+							select c.dir_id
+							from file_stage_process c
+							limit _dir_limit
+							for update skip locked
+						)
+						returning p.dir_id, p.delete_missing
 					),
 					stg as (  -- Move rows out of the staging table
 						delete from file_stage fs
 						using stg_process s
 						where fs.dir_id = s.dir_id
 						returning
-							fs.name, fs.dir_id, fs.size, fs.ctime, fs.mtime, fs.atime
+							fs.name, fs.dir_id, fs.size, fs.ctime, fs.mtime, fs.atime, fs.dev, fs.ino
 					),
 					del as (  -- Delete files that are not in the staging table, meaning they were not found during the scrape.
 						insert into db_removal_file_staging (file_id)  -- This staging table gets processed separately to perform the delete.
@@ -830,12 +1242,40 @@ class DirectoryCrawl:
 							)
 						on conflict on constraint db_removal_file_staging_pkey
 							do nothing
+						returning
+							file_id
+					),
+					chg as (  -- Count the changes that the crawl found in each dir, for its crawl frequency
+						update directory_control dc
+						set changes_since_crawl = dc.changes_since_crawl + c.change_count
+						from (
+							select x.dir_id, count(*) as change_count
+							from (
+								select s.dir_id  -- New files, and files with new contents (an atime alone is not a change)
+								from
+									stg s
+									left join file f
+										on (f.dir_id=s.dir_id and f.name=s.name)
+								where
+									f.id is null
+									or f.size is distinct from s.size
+									or f.mtime is distinct from s.mtime
+								union all
+								select f.dir_id  -- Missing files
+								from
+									del
+									join file f
+										on (f.id=del.file_id)
+							) x
+							group by x.dir_id
+						) c
+						where dc.dir_id=c.dir_id
 					),
 					file_ins as (  -- Insert the rows into main table
 						insert into file as f
-							(name, dir_id, size, ctime, mtime, atime)
+							(name, dir_id, size, ctime, mtime, atime, dev, ino)
 						select
-							s.name, s.dir_id, s.size, s.ctime, s.mtime, s.atime
+							s.name, s.dir_id, s.size, s.ctime, s.mtime, s.atime, s.dev, s.ino
 						from
 							stg s
 						on conflict on constraint file_pkey do
@@ -844,57 +1284,306 @@ class DirectoryCrawl:
 								size = excluded.size,
 								ctime = excluded.ctime,
 								mtime = excluded.mtime,
-								atime = excluded.atime
+								atime = excluded.atime,
+								dev = excluded.dev,
+								ino = excluded.ino
 							where  -- Don't do empty updates
 								f.size <> excluded.size
 								or f.ctime <> excluded.ctime
 								or f.mtime <> excluded.mtime
 								or f.atime <> excluded.atime
+								or f.dev is distinct from excluded.dev
+								or f.ino is distinct from excluded.ino
 						returning
 							f.id, f.mtime, f.size
+					),
+					hc_ins as (  -- Schedule the new file for hashing (same as schedule_files_in_hash_control())
+						insert into hash_control as t
+							(file_id, mtime, file_size)
+						select
+							fi.id, fi.mtime, fi.size
+						from
+							file_ins fi
+						where
+							not exists (
+								select from hash h
+								where
+									h.file_id=fi.id
+							)
+						on conflict on constraint hash_control_pkey do 
+							update set
+								mtime = excluded.mtime
+							where
+								t.mtime <> excluded.mtime
+						returning
+							t.file_id
 					)
-					-- Schedule the new file for hashing (same as schedule_files_in_hash_control())
-					insert into hash_control as t
-						(file_id, mtime, file_size)
 					select
-						fi.id, fi.mtime, fi.size
-					from
-						file_ins fi
-					where
-						not exists (
-							select from hash h
-							where
-								h.file_id=fi.id
+						(select array_agg(file_id) from hc_ins),
+						(select count(*) from stg_process),
+						(select count(*) from stg)
+					into _scheduled_file_ids, _dir_count, _file_count;
+
+					-- The moved/renamed files keep their hash, instead of getting hashed again
+					perform carry_over_hashes(_scheduled_file_ids);
+
+					return query select _dir_count, _file_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
+			# stage_dir_contents
+			cur.execute("""
+				-- Write a batch of crawled dirs into the 5 staging tables, in one call. The rows are passed as column
+				-- arrays (one element per row), and unnest() turns them back into rows.
+				create or replace function stage_dir_contents
+				(
+					-- The subdirs (directory_stage)
+					_subdir_path text[], _subdir_parent_id int[], _subdir_ctime timestamp[], _subdir_mtime timestamp[],
+					_subdir_dev bigint[], _subdir_ino bigint[],
+					-- The files (file_stage)
+					_file_name text[], _file_dir_id int[], _file_size bigint[], _file_ctime timestamp[],
+					_file_mtime timestamp[], _file_atime timestamp[], _file_dev bigint[], _file_ino bigint[],
+					-- The crawled dirs (directory_stage_process, file_stage_process, and directory_control_process)
+					_dir_id int[], _dir_path text[], _delete_missing boolean[], _full_crawl boolean[],
+					_crawled_on timestamp[], _file_count int[], _subdir_count int[], _dir_not_found boolean[],
+					_crawl_started_on timestamp[], _mtime timestamp[], _ctime timestamp[]
+				)
+				returns boolean
+				as $$
+				begin
+					-- Insert the subdirs into the dir staging table
+					insert into directory_stage
+						(dir_path, parent_id, ctime, mtime, dev, ino, inserted_by_process_id)
+					select s.*, 1  -- inserted_by_process_id is unneeded
+					from unnest(_subdir_path, _subdir_parent_id, _subdir_ctime, _subdir_mtime, _subdir_dev, _subdir_ino) s
+					on conflict do nothing;
+
+					-- Queue the staged subdirs up to be processed (the subdirs are not staged on an incremental crawl)
+					insert into directory_stage_process
+						(parent_dir_path, parent_id, delete_missing)
+					select c.dir_path, c.dir_id, c.delete_missing
+					from unnest(_dir_path, _dir_id, _delete_missing, _full_crawl) c (dir_path, dir_id, delete_missing, full_crawl)
+					where c.full_crawl
+					on conflict do nothing;
+
+					-- Insert the files into the file staging table
+					insert into file_stage
+						(name, dir_id, size, ctime, mtime, atime, dev, ino, inserted_by_process_id)
+					select f.*, 1  -- inserted_by_process_id is unneeded
+					from unnest(
+						_file_name, _file_dir_id, _file_size, _file_ctime, _file_mtime, _file_atime, _file_dev, _file_ino
+					) f
+					on conflict do nothing;
+
+					-- Queue the staged files to be processed
+					insert into file_stage_process
+						(dir_id, delete_missing)
+					select c.dir_id, c.delete_missing
+					from unnest(_dir_id, _delete_missing) c (dir_id, delete_missing)
+					on conflict do nothing;
+
+					-- Stage the crawled directory to be marked as crawled
+					insert into directory_control_process
+						(
+							dir_id, dir_path, crawled_on, file_count, subdir_count, dir_not_found,
+							crawl_started_on, mtime, ctime, full_crawl
 						)
-					on conflict on constraint hash_control_pkey do 
-						update set
-							mtime = excluded.mtime
-						where
-							t.mtime <> excluded.mtime;
+					select
+						c.dir_id, c.dir_path, c.crawled_on, c.file_count, c.subdir_count, c.dir_not_found,
+						c.crawl_started_on, c.mtime, c.ctime, c.full_crawl
+					from unnest(
+						_dir_id, _dir_path, _crawled_on, _file_count, _subdir_count, _dir_not_found,
+						_crawl_started_on, _mtime, _ctime, _full_crawl
+					) c (
+						dir_id, dir_path, crawled_on, file_count, subdir_count, dir_not_found,
+						crawl_started_on, mtime, ctime, full_crawl
+					)
+					on conflict do nothing;
 
 					return true;
 				end;
 				$$ LANGUAGE plpgsql;
 			""")
 
+			# process_renamed_dirs
+			cur.execute("""
+				create or replace function process_renamed_dirs()
+				returns int
+				as $$
+				declare
+					_renamed_count int;
+				begin
+					-- Skip the work when no staged dir has the identity (device and inode) of a dir at another path
+					if not exists (
+						select
+						from
+							directory_stage ds
+							join directory prev
+								on (prev.dev=ds.dev and prev.ino=ds.ino)
+						where
+							ds.ino is not null
+							and prev.dir_path <> ds.dir_path
+					) then
+						return 0;
+					end if;
+
+					with candidate as (  -- Match the new dirs to the missing dirs with the same identity
+						select
+							prev.id as dir_id, prev.dir_path as old_path, ds.dir_path as new_path, ds.parent_id as new_parent_id
+						from
+							directory_stage ds
+							join directory prev
+								on (prev.dev=ds.dev and prev.ino=ds.ino)
+						where
+							ds.ino is not null
+							and prev.dir_path <> ds.dir_path
+							-- The new path's parent finished being crawled
+							and exists (
+								select from directory_stage_process p
+								where p.parent_id = ds.parent_id
+							)
+							-- The old path is gone: either its parent was just crawled without it, or it is queued to be removed
+							and (
+								exists (
+									select from directory_stage_process p
+									where
+										p.parent_id = prev.parent_id
+										and p.delete_missing is true
+										and not exists (
+											select from directory_stage ds2
+											where ds2.dir_path = prev.dir_path
+										)
+								)
+								or exists (
+									select from db_removal_directory_staging r
+									where r.dir_id = prev.id
+								)
+							)
+							-- Nothing is in the DB at the new path (or under it) yet
+							and not exists (
+								select from directory d
+								where path_in_subtree(d.dir_path, ds.dir_path)
+							)
+					),
+					renamed as (  -- Only one rename for each dir, and for each new path
+						select c.dir_id, c.old_path, c.new_path, c.new_parent_id
+						from candidate c
+						where
+							not exists (
+								select from candidate c2
+								where
+									(c2.dir_id = c.dir_id and c2.new_path < c.new_path)
+									or (c2.new_path = c.new_path and c2.dir_id < c.dir_id)
+									-- The renamed dirs that were inside of another renamed dir move along with it
+									or (c2.dir_id <> c.dir_id and path_in_subtree(c.old_path, c2.old_path))
+							)
+					),
+					dir_upd as (  -- Move the dirs (and everything under them) to the new paths, keeping their IDs
+						update directory d
+						set
+							updated_on = now(),
+							dir_path = r.new_path || substr(d.dir_path, length(r.old_path) + 1),
+							-- Only the renamed dir moves to a new parent. The dirs under it keep theirs.
+							parent_id = case when d.id = r.dir_id then r.new_parent_id else d.parent_id end
+						from renamed r
+						where path_in_subtree(d.dir_path, r.old_path)
+						returning
+							d.id, d.dir_path
+					),
+					last_ctime_frequency as (  -- The crawl frequency of the dirs that have no change history yet
+						select lcf.dir_id, lcf.new_frequency
+						from crawl_frequency_last_ctime_calculate(
+							30::float, -- _divide_seconds,
+							round(60*60*0.25)::int, -- _min_frequency,
+							round(60*60*24*7)::int, -- _max_frequency,
+							array(
+								select dc.dir_id
+								from
+									dir_upd du
+									join directory_control dc
+										on (dc.dir_id = du.id)
+								where dc.crawled_seconds_ewma = 0
+							)::int[] -- _dir_id
+						) lcf
+					),
+					control_upd as (  -- Keep their change history, and crawl them at the new paths now
+						update directory_control dc
+						set
+							dir_path = du.dir_path,
+							next_crawl = least(dc.next_crawl, now()),
+							dir_missing = false,
+							-- Undo the penalty of the crawls that didn't find them at the old path (see mark_dirs_crawled())
+							crawl_frequency = case
+								when dc.crawled_seconds_ewma > 0 then
+									crawl_frequency_change_rate_calculate(
+										dc.changed_crawls_ewma,
+										dc.crawled_seconds_ewma,
+										0.1::float,  -- _target_staleness: out of date for 10% of the time
+										round(60*60*0.25)::int, -- _min_frequency,
+										round(60*60*24*7)::int -- _max_frequency,
+									)
+								else
+									coalesce(lcf.new_frequency, dc.crawl_frequency)
+							end
+						from
+							dir_upd du
+							left join last_ctime_frequency lcf
+								on (lcf.dir_id = du.id)
+						where dc.dir_id = du.id
+					),
+					removal_del as (  -- They are no longer missing
+						delete from db_removal_directory_staging r
+						using dir_upd du
+						where r.dir_id = du.id
+					),
+					stats_queue as (  -- The old parent dirs lost a subdir (the new parents get refreshed after their crawl)
+						insert into directory_stats_queue (dir_id)
+						select distinct prev.parent_id
+						from
+							renamed r
+							join directory prev
+								on (prev.id = r.dir_id)
+						where prev.parent_id is not null
+						on conflict on constraint directory_stats_queue_pkey do nothing
+					)
+					select count(*) into _renamed_count
+					from renamed;
+
+					return _renamed_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
 			# process_staged_dirs
 			cur.execute("""
-				create or replace function process_staged_dirs()
-				returns boolean
+				drop function if exists process_staged_dirs();  -- Replaced by the chunked version
+				create or replace function process_staged_dirs(_dir_limit int = 1000)
+				returns table (dir_count int, subdir_count int)  -- Progress: the number of crawled dirs and subdirs merged
 				as $$
+				declare
+					_dir_count int;
+					_subdir_count int;
 				begin
-					-- Move (delete) subdirs from staging and upsert into the directory table
+					-- Move (delete) subdirs from staging and upsert into the directory table, for up to _dir_limit crawled
+					-- dirs at a time. The dirs are claimed with "skip locked", so that several workers can run at once.
 					-- !! IMPORTANT: Add all column names to all 5 sections below: DELETE, INSERT, SELECT, UPDATE, and WHERE
 					with stg_process as (  -- Work with the rows in the staging process table
-						delete from directory_stage_process
-						returning parent_dir_path, delete_missing
+						delete from directory_stage_process p
+						where p.parent_dir_path in (
+							select c.parent_dir_path
+							from directory_stage_process c
+							limit _dir_limit
+							for update skip locked
+						)
+						returning p.parent_dir_path, p.parent_id, p.delete_missing
 					),
 					stg as (  -- Move rows out of the staging table
 						delete from directory_stage ds
 						using stg_process s
-						where basepath(ds.dir_path) = s.parent_dir_path
+						where ds.parent_id = s.parent_id
 						returning
-							dir_path, ctime, mtime
+							ds.dir_path, ds.parent_id, ds.ctime, ds.mtime, ds.dev, ds.ino
 					),
 					del as (  -- Delete dirs that are not in the staging table, meaning they were not found during the scrape.
 						insert into db_removal_directory_staging (dir_id, delete_subdirs)  -- This staging table gets processed separately to delete
@@ -902,7 +1591,7 @@ class DirectoryCrawl:
 						from 
 							directory child
 							join stg_process s
-								on (s.parent_dir_path = basepath(child.dir_path))
+								on (s.parent_id = child.parent_id)
 						where 
 							s.delete_missing is true  -- Only delete missing files if required
 							and not exists (  -- Is this dir listed in the staging table?
@@ -914,33 +1603,51 @@ class DirectoryCrawl:
 					),
 					dir_ins as (  -- Insert the rows into main table
 						insert into directory as t 
-							(dir_path, ctime, mtime)
-						select dir_path, ctime, mtime
+							(dir_path, parent_id, ctime, mtime, dev, ino)
+						select dir_path, parent_id, ctime, mtime, dev, ino
 						from stg
 						on conflict on constraint directory_dir_path_key do
 							update set 
 								updated_on = now(),
+								parent_id = excluded.parent_id,
 								ctime = excluded.ctime,
-								mtime = excluded.mtime
+								mtime = excluded.mtime,
+								dev = excluded.dev,
+								ino = excluded.ino
 							where  -- Don't do empty updates 
-								t.ctime <> excluded.ctime
+								t.parent_id is distinct from excluded.parent_id
+								or t.ctime <> excluded.ctime
 								or t.mtime <> excluded.mtime
+								or t.dev is distinct from excluded.dev
+								or t.ino is distinct from excluded.ino
 						returning
-							id, dir_path
+							id, dir_path, parent_id
+					),
+					stats_queue as (  -- The crawled dirs with new or changed subdirs (see mark_dirs_crawled())
+						insert into directory_stats_queue (dir_id)
+						select distinct dir_ins.parent_id
+						from dir_ins
+						where dir_ins.parent_id is not null
+						on conflict on constraint directory_stats_queue_pkey do nothing
+					),
+					control_ins as (  -- Schedule the new directory for crawling (same as schedule_subdirs_in_directory_control())
+						insert into directory_control as t
+							(dir_id, dir_path)
+						select dir_ins.id, dir_ins.dir_path
+						from dir_ins 
+						on conflict on constraint directory_control_pkey do 
+							update set
+								dir_id = excluded.dir_id  -- In case the dir_id has changed for the dir_path
+								-- Don't update/reschedule any existing directories.
+							where  -- Don't do empty updates
+								t.dir_id <> excluded.dir_id
 					)
-					-- Schedule the new directory for crawling (same as schedule_subdirs_in_directory_control())
-					insert into directory_control as t
-						(dir_id, dir_path)
-					select dir_ins.id, dir_ins.dir_path
-					from dir_ins 
-					on conflict on constraint directory_control_pkey do 
-						update set
-							dir_id = excluded.dir_id  -- In case the dir_id has changed for the dir_path
-							-- Don't update/reschedule any existing directories.
-						where  -- Don't do empty updates
-							t.dir_id <> excluded.dir_id;
+					select
+						(select count(*) from stg_process),
+						(select count(*) from stg)
+					into _dir_count, _subdir_count;
 
-					return true;
+					return query select _dir_count, _subdir_count;
 				end;
 				$$ LANGUAGE plpgsql;
 			""")
@@ -951,21 +1658,85 @@ class DirectoryCrawl:
 				returns boolean
 				as $$
 				begin
+					-- Bring the stats of the dirs that are done being merged up to date, for their new crawl frequency.
+					-- Only the dirs that the crawl changed get refreshed: the files that were inserted/changed/deleted are
+					-- counted in changes_since_crawl, and the new/changed/removed subdirs queue the dir for its stats.
+					perform refresh_directory_stats(array(
+						select dcs.dir_id
+						from
+							directory_control_process dcs
+							join directory_control dc
+								on (dc.dir_id=dcs.dir_id)
+						where
+							(
+								dc.changes_since_crawl > 0
+								or exists (
+									select from directory_stats_queue q
+									where q.dir_id=dcs.dir_id
+								)
+								or not exists (  -- First crawl
+									select from directory_stats s
+									where s.dir_id=dcs.dir_id
+								)
+							)
+							and not exists (
+								select from file_stage fs
+								where dcs.dir_id=fs.dir_id
+							)
+							and not exists (
+								select from file_stage_process fsp
+								where dcs.dir_id=fsp.dir_id
+							)
+							and not exists (
+								select from directory_stage ds
+								where dcs.dir_id=ds.parent_id
+							)
+					)::int[]);
+
 					with stg as (  -- Clear out the staging table and get a list of the dirs to work with
 						delete from directory_control_process dcs
 						where
-							-- Make sure there are no outstanding files staged
+							-- Make sure there are no outstanding files staged (and that their changes were counted)
 							not exists (
 								select from file_stage fs
 								where dcs.dir_id=fs.dir_id
 							)
+							and not exists (
+								select from file_stage_process fsp
+								where dcs.dir_id=fsp.dir_id
+							)
 							-- Make sure there are no outstanding subdirs staged
 							and not exists (
 								select from directory_stage ds
-								where dcs.dir_path=basepath(ds.dir_path)
+								where dcs.dir_id=ds.parent_id
 							)
 						returning
-							dcs.dir_id, dcs.dir_path, dcs.crawled_on, dcs.file_count, dcs.subdir_count, dcs.dir_not_found
+							dcs.dir_id, dcs.dir_path, dcs.crawled_on, dcs.file_count, dcs.subdir_count, dcs.dir_not_found,
+							dcs.crawl_started_on, dcs.mtime, dcs.ctime, dcs.full_crawl
+					),
+					dir_upd as (  -- Keep the crawled dir's own metadata up to date
+						update directory d
+						set
+							updated_on = now(),
+							ctime = coalesce(stg.ctime, d.ctime),
+							mtime = stg.mtime
+						from stg
+						where
+							d.id = stg.dir_id
+							and stg.mtime is not null
+							and (d.mtime is distinct from stg.mtime or d.ctime is distinct from coalesce(stg.ctime, d.ctime))
+					),
+					schedule_missing_parent as (  -- Crawl the parent of a missing dir now, to find out if it was renamed or removed
+						update directory_control dc
+						set next_crawl = now()
+						from
+							stg
+							join directory d
+								on (d.id = stg.dir_id)
+						where
+							stg.dir_not_found = true
+							and dc.dir_id = d.parent_id
+							and dc.next_crawl > now()
 					),
 					/*
 					schedule_parent as (  -- Schedule the parent dir of any missing dirs. Missing dir indicates a change in the parent.
@@ -1008,14 +1779,79 @@ class DirectoryCrawl:
 								end
 					),
 					*/
+					moved as (  -- The dirs that were renamed after this crawl missed them keep their schedule
+						-- process_renamed_dirs() already scheduled them to be crawled at the new path
+						update directory_control dc
+						set process_assigned_on = null
+						from stg
+						where
+							dc.dir_id = stg.dir_id
+							and stg.dir_not_found = true
+							and dc.dir_path <> stg.dir_path
+					),
+					hist as (  -- Add this crawl to the dirs' change history
+						select
+							stg.dir_id,
+							case
+								when dc.last_crawled is null or stg.dir_not_found then  -- Nothing to compare with
+									dc.changed_crawls_ewma
+								else
+									dc.changed_crawls_ewma * 0.8
+									+ case
+										when (
+											dc.changes_since_crawl > 0
+											or stg.mtime is distinct from coalesce(dc.crawled_mtime, stg.mtime)  -- Eg: a new subdir
+										) then 1
+										else 0
+									end
+							end as changed_crawls_ewma,
+							case
+								when dc.last_crawled is null or stg.dir_not_found then
+									dc.crawled_seconds_ewma
+								else
+									dc.crawled_seconds_ewma * 0.8
+									+ greatest(extract(epoch from stg.crawled_on - dc.last_crawled), 0)
+							end as crawled_seconds_ewma
+						from
+							stg
+							join directory_control dc
+								on (dc.dir_id=stg.dir_id)
+					),
 					schd as (  -- Get the new crawling frequency for the dirs
-						-- For dirs that exist: 
+						-- For dirs that exist, and have a change history: From the rate that they change at
+						select
+							hist.dir_id,
+							crawl_frequency_change_rate_calculate(
+								hist.changed_crawls_ewma,
+								hist.crawled_seconds_ewma,
+								0.1::float,  -- _target_staleness: out of date for 10% of the time
+								round(60*60*0.25)::int, -- _min_frequency,
+								round(60*60*24*7)::int -- _max_frequency,
+							) as new_frequency
+						from
+							hist
+							join stg
+								on (stg.dir_id=hist.dir_id)
+						where
+							stg.dir_not_found = false
+							and hist.crawled_seconds_ewma > 0
+						-- For dirs that exist, but were only crawled once: From how long ago their contents last changed
+						union all
 						select dir_id, new_frequency
 						from crawl_frequency_last_ctime_calculate(
 							30::float, -- _divide_seconds,
 							round(60*60*0.25)::int, -- _min_frequency,
 							round(60*60*24*7)::int, -- _max_frequency,
-							array(select dir_id from stg where dir_not_found=false)::int[] -- _dir_id
+							array(
+								select stg.dir_id
+								from
+									stg
+									join hist
+										on (hist.dir_id=stg.dir_id)
+								where
+									stg.dir_not_found = false
+									and hist.crawled_seconds_ewma = 0
+							)::int[] -- _dir_id
 						)
 						-- For dirs that don't exist, try again later
 						union all
@@ -1031,13 +1867,23 @@ class DirectoryCrawl:
 						next_crawl = stg.crawled_on + (coalesce(schd.new_frequency, dc.crawl_frequency) || ' seconds')::interval,
 						file_count = stg.file_count,
 						subdir_count = stg.subdir_count,
+						crawled_mtime = stg.mtime,
+						crawled_ctime = stg.ctime,
+						last_crawl_started = stg.crawl_started_on,
+						last_full_crawl = case when stg.full_crawl then stg.crawled_on else dc.last_full_crawl end,
+						changes_since_crawl = 0,
+						changed_crawls_ewma = hist.changed_crawls_ewma,
+						crawled_seconds_ewma = hist.crawled_seconds_ewma,
 						process_assigned_on	= null
 					from 
 						stg
+						join hist
+							on (stg.dir_id=hist.dir_id)
 						left join schd
 							on (stg.dir_id=schd.dir_id)
 					where
-						dc.dir_id=stg.dir_id;
+						dc.dir_id=stg.dir_id
+						and not (stg.dir_not_found = true and dc.dir_path <> stg.dir_path);  -- See moved
 
 					return true;
 				end;
@@ -1062,7 +1908,7 @@ class DirectoryCrawl:
 					from
 						directory
 					where
-						basepath(dir_path) = _dir_path  -- Only select directories whose PARENT is the _dir_path 
+						parent_id = (select id from directory where dir_path = _dir_path)  -- Only select directories whose PARENT is the _dir_path
 					on conflict on constraint directory_control_pkey do 
 						update set
 							dir_id = excluded.dir_id  -- In case the dir_id has changed for the dir_path
@@ -1109,13 +1955,18 @@ class DirectoryCrawl:
 
 			# file_db_removal
 			cur.execute("""
+				drop function if exists db_removal_file(int);  -- Replaced by the version with the hash_archive retention
 				create or replace function db_removal_file
 				(
-					_row_limit int = 10000
+					_row_limit int = 10000,
+					_hash_archive_days int = 30  -- How long to keep the removed files' hashes, in case they were moved
 				)
 				returns table (id int)
 				as $$
 				begin
+					delete from hash_archive
+					where inserted_on < now() - (_hash_archive_days || ' days')::interval;
+
 					return query
 					with f_id as (  -- Determine which files to delete
 						select file_id
@@ -1141,9 +1992,11 @@ class DirectoryCrawl:
 
 			# directory_db_removal
 			cur.execute("""
+				drop function if exists db_removal_directory(int);  -- Replaced by the version with the grace period
 				create or replace function db_removal_directory
 				(
-					_row_limit int = 10000
+					_row_limit int = 10000,
+					_grace_seconds int = 60  -- Wait before removing a missing dir, in case it was moved and shows up at its new path
 				)
 				returns table (id int, "type" text)
 				as $$
@@ -1152,6 +2005,9 @@ class DirectoryCrawl:
 					with d_id as (  -- Determine which dirs to delete
 						select dir_id
 						from db_removal_directory_staging
+						where
+							delete_subdirs = false  -- Not found missing by a crawl (eg: excluded, or the subdir of a removed dir)
+							or inserted_on < now() - (_grace_seconds || ' seconds')::interval
 						order by inserted_on
 						limit _row_limit
 					),
@@ -1,8 +1,13 @@
+from FileDbDAL.SQLUtil import SQLUtil
 import os
 import platform
-import time
 
 class File:
+	__slots__ = (
+		'id', 'name', 'dir_id', 'size', 'ctime', 'mtime', 'atime', 'change_time', 'dev', 'ino', 'inserted_on',
+		'updated_on', 'dir_path', 'parent_dir_last_crawled',
+	)
+
 	def __init__(self, file_name, dir_path='', dir_id=None):
 		self.id 			= 0
 		self.name 			= file_name
@@ -11,6 +16,9 @@ class File:
 		self.ctime			= None
 		self.mtime			= None
 		self.atime 			= None
+		self.change_time	= None  # Epoch seconds of the latest content/metadata change, to detect changes between crawls
+		self.dev			= 0  # Device (file system) ID and inode number: the file's identity, across moves and renames
+		self.ino			= 0
 		self.inserted_on 	= ""
 		self.updated_on		= ""
 
@@ -21,18 +29,25 @@ class File:
 	def full_path(self):
 		return os.path.join(self.dir_path, self.name)
 
+	# Build the File from an os.scandir() entry, reusing the stat data that the directory listing already collected
+	@staticmethod
+	def from_dir_entry(entry: os.DirEntry, dir_path: str, dir_id=None):
+		file = File(entry.name, dir_path, dir_id)
+		try:
+			# On Windows the stat comes for free with the listing. Elsewhere it is a single stat() on the entry
+			file.populate_from_stat(entry.stat())
+		except PermissionError:
+			print("PermissionError:", file.full_path())
+		except FileNotFoundError:
+			print("FileNotFoundError:", file.full_path())
+		except:  # Ugh. Catchall
+			print("Error - cannot scrape ", file.full_path())
+		return file
+
 	# Get the metadata for the directory
 	def scrape_metadata(self):
 		try:
-			stat = os.stat(self.full_path())
-			# Only Windows has the ctime stored for a directory
-			if platform.system() == "Windows":
-				self.ctime = time.ctime(stat.st_ctime)
-
-			self.mtime = time.ctime(stat.st_mtime)
-			self.atime = time.ctime(stat.st_atime)
-			self.size = stat.st_size
-			self.size = round(self.size / (1000 * 1000), 6)  # Convert from bytes to megabytes (windows != 1024)
+			self.populate_from_stat(os.stat(self.full_path()))
 		except PermissionError:
 			print("PermissionError:", self.full_path())
 		except FileNotFoundError:
@@ -40,15 +55,25 @@ class File:
 		except:  # Ugh. Catchall
 			print("Error - cannot scrape ", self.full_path())
 
-	def staging_table_dict(self):
-		return {
-			'name': self.name,
-			'dir_id': self.dir_id,
-			'size': self.size,
-			'ctime': self.ctime,
-			'mtime': self.mtime,
-			'atime': self.atime,
-		}
+	def populate_from_stat(self, stat: os.stat_result):
+		# Only Windows has the ctime stored for a directory
+		if platform.system() == "Windows":
+			self.ctime = stat.st_ctime
+
+		# Keep the native epoch values (full precision). They are cheap to pickle through the queues, and get converted
+		# to datetimes when they are staged (see DirectoryCrawl.iter_content_files())
+		self.mtime = stat.st_mtime
+		self.atime = stat.st_atime
+		self.size = stat.st_size  # In bytes
+		self.dev = stat.st_dev
+		self.ino = stat.st_ino  # 0 on Windows, from a DirEntry's stat
+
+		# On *nix, the ctime is the inode change time, which is updated for any change (and can't be set by a user)
+		self.change_time = stat.st_mtime if platform.system() == "Windows" else max(stat.st_mtime, stat.st_ctime)
+
+	def staging_table_row(self) -> tuple:
+		# Packed row for the crawl payload (the dir_id is the crawled dir's): (name, size, ctime, mtime, atime, dev, ino)
+		return self.name, self.size, self.ctime, self.mtime, self.atime, self.dev, self.ino
 
 	# Insert this object into the database
 	def insert_new_file(self, pg):
@@ -116,15 +141,21 @@ class File:
 			(
 				id 				int generated by default as identity,
 				name			text not null, 		-- eg "calc.exe"
+				extension		text generated always as (extension(name)) stored,  -- eg "exe"
 				dir_id			int not null,		-- ID for the directory table (will contain "C:/windows/system32")
-				size 			numeric(18, 6),		-- In MBs
+				size 			bigint,				-- In bytes
 				ctime			timestamp,
 				mtime			timestamp,
 				atime			timestamp,
+				dev				bigint,				-- Device (file system) ID and inode number, to recognize moved files
+				ino				bigint,
 				inserted_on 	timestamp not null default now(),
 				updated_on		timestamp not null default now(),
 				primary key (name, dir_id)
 			);
+			alter table file add column if not exists dev bigint;
+			alter table file add column if not exists ino bigint;
+			alter table file add column if not exists extension text generated always as (extension(name)) stored;
 		""")
 
 		# Install the table for deleted files
@@ -138,16 +169,20 @@ class File:
 				id 				int,
 				name			text not null, 		-- eg "calc.exe"
 				dir_id			int not null,		-- ID for the directory table (will contain "C:/windows/system32")
-				size 			numeric(18, 6),		-- In MBs
+				size 			bigint,				-- In bytes
 				ctime			timestamp,
 				mtime			timestamp,
 				atime			timestamp,
+				dev				bigint,
+				ino				bigint,
 				original_inserted_on 	timestamp not null,
 				original_updated_on		timestamp not null,
 				deleted_on		timestamp null,		-- Literal deleted timestamp, if known from the file system
 				inserted_on		timestamp not null default now(),
 				primary key (id)
 			);
+			alter table file_archive add column if not exists dev bigint;
+			alter table file_archive add column if not exists ino bigint;
 		""")
 
 		# Install the staging table (note: this is an unlogged table. Speed is needed more than data recovery on restart.)
@@ -160,13 +195,17 @@ class File:
 			(
 				name			text not null, 		-- eg "calc.exe"
 				dir_id			int not null,		-- ID for the directory table
-				size 			numeric(18, 6),		-- In MBs
+				size 			bigint,				-- In bytes
 				ctime			timestamp,
 				mtime			timestamp,
 				atime			timestamp,
+				dev				bigint,
+				ino				bigint,
 				inserted_by_process_id int not null,
 				primary key (name, dir_id)
 			);
+			alter table file_stage add column if not exists dev bigint;
+			alter table file_stage add column if not exists ino bigint;
 		""")
 
 		# Install the staging process table (note: this is an unlogged table)
@@ -174,6 +213,11 @@ class File:
 			# TODO: Check if this table contains data before dropping
 			cur.execute("drop table if exists file_stage_process cascade;")
 
+		# Convert the sizes from MBs to bytes, for tables created before sizes were stored in bytes
+		SQLUtil.migrate_size_to_bytes(cur, 'file', 'size')
+		SQLUtil.migrate_size_to_bytes(cur, 'file_archive', 'size')
+		SQLUtil.migrate_size_to_bytes(cur, 'file_stage', 'size')
+
 		cur.execute("""
 					create unlogged table if not exists file_stage_process
 					(
@@ -213,6 +257,8 @@ class File:
 			create index if not exists file_inserted_on on file (inserted_on);
 			create index if not exists file_updated_on on file (updated_on);
 			create index if not exists file_reverse_name on file (reverse(name));
+			create index if not exists file_extension on file (extension);
+			create index if not exists file_dev_ino on file (dev, ino) where ino is not null;
 			
 			create index if not exists file_archive_name on file_archive (name);
 			create index if not exists file_archive_dir_id on file_archive (dir_id);
@@ -278,6 +324,7 @@ class File:
 						delete from hash t
 						using f
 						where t.file_id=f.file_id
+						returning t.file_id, t.md5_hash, t.md5_hash_time, t.sha1_hash, t.sha1_hash_time
 					),
 					del_hash_schd as (  -- Delete the hash control row
 						delete from hash_control t
@@ -288,13 +335,32 @@ class File:
 						delete from file t
 						using f
 						where t.id=f.file_id
-						returning t.id, t.name, t.dir_id, t.size, t.ctime, t.mtime, t.atime, t.inserted_on, t.updated_on
+						returning
+							t.id, t.name, t.dir_id, t.size, t.ctime, t.mtime, t.atime, t.dev, t.ino, t.inserted_on, t.updated_on
+					),
+					stats_queue as (  -- The dirs' stats changed
+						insert into directory_stats_queue (dir_id)
+						select distinct t.dir_id
+						from del t
+						on conflict on constraint directory_stats_queue_pkey do nothing
 					),
 					archive as (  -- Insert the archive
 						insert into file_archive
-							(id, name, dir_id, size, ctime, mtime, atime, original_inserted_on, original_updated_on)
-						select t.id, t.name, t.dir_id, t.size, t.ctime, t.mtime, t.atime, t.inserted_on, t.updated_on
+							(id, name, dir_id, size, ctime, mtime, atime, dev, ino, original_inserted_on, original_updated_on)
+						select t.id, t.name, t.dir_id, t.size, t.ctime, t.mtime, t.atime, t.dev, t.ino, t.inserted_on, t.updated_on
 						from del t
+					),
+					archive_hash as (  -- Keep the hash, in case the file was moved and shows up at its new path
+						insert into hash_archive
+							(file_id, dev, ino, size, mtime, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time)
+						select
+							t.id, t.dev, t.ino, t.size, t.mtime, h.md5_hash, h.md5_hash_time, h.sha1_hash, h.sha1_hash_time
+						from
+							del t
+							join del_hash h
+								on (t.id=h.file_id)
+						where t.ino is not null
+						on conflict on constraint hash_archive_pkey do nothing
 					)
 					select t.id from del t;
 				end;
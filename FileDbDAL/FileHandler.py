@@ -1,4 +1,5 @@
 from FileHandler import CopyFile
+from FileDbDAL.SQLUtil import SQLUtil
 from datetime import datetime
 
 class FileHandler:
@@ -51,13 +52,14 @@ class FileHandler:
 					overwrite		char(1),		-- Y=Force overwrite | N=Force Skip | W=Warn
 					file_hash		text null,		-- Optional: The source file's hash to verify the file has not been modified
 					hash_type		text null,		-- Optional: The hash type (md5, sha1) for the file_hash
-					file_size		numeric(18, 6),		-- Optional: The source's size to verify the file has not been modified. In MBs. 
+					file_size		bigint,				-- Optional: The source's size to verify the file has not been modified. In bytes. 
 					perform_hash_check boolean default false,
 					assigned_on		timestamp null,
 					inserted_on		timestamp default now(),
 					primary key (id)
 				);
 			""")
+			SQLUtil.migrate_size_to_bytes(cur, 'copy_file', 'file_size')
 
 			# Install the directory copy table
 			if drop_tables:
@@ -105,6 +107,8 @@ class FileHandler:
 		with pg.cursor() as cur:
 			# Install the function to get the list of files to copy
 			cur.execute("""
+				drop function if exists get_files_to_copy(int);  -- The return type changed (file_size used to be in MBs)
+
 				create or replace function get_files_to_copy(_row_limit int) 
 				returns table 
 				(
@@ -115,7 +119,7 @@ class FileHandler:
 					overwrite text,
 					file_hash text,
 					hash_type text,
-					file_size numeric(18, 6),
+					file_size bigint,
 					perform_hash_check boolean
 				)
 				as $$
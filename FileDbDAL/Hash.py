@@ -2,6 +2,12 @@ from FileHandler.HashFile import HashFile
 from datetime import datetime
 
 class Hash:
+	# The hashes are kept as the raw digest bytes (half the size of the hex strings) while they are passed through the
+	# queues and loaded into hash_stage. The hex strings are still available as md5_hash and sha1_hash.
+	__slots__ = (
+		'id', 'file_id', 'md5_digest', 'md5_hash_time', 'sha1_digest', 'sha1_hash_time', 'file_path',
+	)
+
 	def __init__(
 		self,
 		id=None, file_id=None, md5_hash=None, md5_hash_time=None, sha1_hash=None, sha1_hash_time=None,
@@ -16,12 +22,28 @@ class Hash:
 
 		self.file_path = file_path
 
-	def perform_hash(self):
+	@property
+	def md5_hash(self):
+		return self.md5_digest.hex() if self.md5_digest is not None else None
+
+	@md5_hash.setter
+	def md5_hash(self, value):
+		self.md5_digest = bytes.fromhex(value) if value is not None else None
+
+	@property
+	def sha1_hash(self):
+		return self.sha1_digest.hex() if self.sha1_digest is not None else None
+
+	@sha1_hash.setter
+	def sha1_hash(self, value):
+		self.sha1_digest = bytes.fromhex(value) if value is not None else None
+
+	def perform_hash(self, throttle=None):
 		# Attempt to perform the hash
-		if hashes := HashFile.hash_file(self.file_path, ['MD5', 'SHA1']):
+		if hashes := HashFile.hash_file(self.file_path, ['MD5', 'SHA1'], throttle, raw_digest=True):
 			# Populate the hashes within the object
-			self.md5_hash = hashes['MD5']
-			self.sha1_hash = hashes['SHA1']
+			self.md5_digest = hashes['MD5']
+			self.sha1_digest = hashes['SHA1']
 			self.md5_hash_time = datetime.now()
 			self.sha1_hash_time = datetime.now()
 
@@ -40,14 +62,9 @@ class Hash:
 			inserted = cur.fetchone()[0]
 			return inserted
 
-	def staging_table_dict(self):
-		return {
-			'file_id': self.file_id,
-			'md5_hash': self.md5_hash,
-			'md5_hash_time': self.md5_hash_time,
-			'sha1_hash': self.sha1_hash,
-			'sha1_hash_time': self.sha1_hash_time
-		}
+	def staging_table_row(self) -> tuple:
+		# Row for hash_stage: (file_id, md5_digest, md5_hash_time, sha1_digest, sha1_hash_time)
+		return self.file_id, self.md5_digest, self.md5_hash_time, self.sha1_digest, self.sha1_hash_time
 
 	@staticmethod
 	def install_tables(pg, drop_tables):
@@ -80,10 +97,37 @@ class Hash:
 			create unlogged table if not exists hash_stage
 			(
 				file_id			int unique not null, 			-- ID from the file table
+				md5_digest		bytea,							-- The raw digests (hex encoded into the hash table)
+				md5_hash_time 	timestamp default null,
+				sha1_digest		bytea,
+				sha1_hash_time 	timestamp default null,
+				primary key (file_id)
+			);
+			-- The hashes used to be staged as hex strings
+			alter table hash_stage add column if not exists md5_digest bytea;
+			alter table hash_stage add column if not exists sha1_digest bytea;
+			alter table hash_stage drop column if exists md5_hash;
+			alter table hash_stage drop column if exists sha1_hash;
+		""")
+
+		# Install the table of the hashes of removed files, to be carried over to the files that were moved
+		if drop_tables:
+			# TODO: Check if this table contains data before dropping
+			cur.execute("drop table if exists hash_archive cascade;")
+
+		cur.execute("""
+			create table if not exists hash_archive
+			(
+				file_id			int not null, 			-- ID of the removed file (see file_archive)
+				dev				bigint not null,		-- The file's identity: device (file system) ID and inode number
+				ino				bigint not null,
+				size 			bigint,					-- In bytes
+				mtime			timestamp,
 				md5_hash		text,
 				md5_hash_time 	timestamp default null,
 				sha1_hash		text,
 				sha1_hash_time 	timestamp default null,
+				inserted_on		timestamp not null default now(),
 				primary key (file_id)
 			);
 		""")
@@ -100,6 +144,9 @@ class Hash:
 				create index if not exists hash_md5_hash_time on hash (md5_hash_time);
 				create index if not exists hash_sha1_hash on hash (sha1_hash);
 				create index if not exists hash_sha1_hash_time on hash (sha1_hash_time);
+
+				create index if not exists hash_archive_dev_ino on hash_archive (dev, ino);
+				create index if not exists hash_archive_inserted_on on hash_archive (inserted_on);
 			""")
 
 	@staticmethod
@@ -109,6 +156,76 @@ class Hash:
 	@staticmethod
 	def install_pg_functions(pg):
 		with pg.cursor() as cur:
+			# carry_over_hashes
+			cur.execute("""
+				-- Give the files the hash of a file with the same identity (device, inode, size and mtime), instead of
+				-- hashing them again. Eg: the file was moved/renamed, and the old path is either removed (hash_archive) or 
+				-- not yet found to be missing (hash). Returns the number of files that no longer need to be hashed.
+				create or replace function carry_over_hashes
+				(
+					_file_ids int[]
+				) 
+				returns int
+				as $$
+				declare
+					_carried_count int;
+				begin
+					with f as (  -- The files to look for a hash for
+						select f.id, f.dev, f.ino, f.size, f.mtime
+						from file f
+						where
+							f.id = any(_file_ids)
+							and f.ino is not null
+							and not exists (
+								select from hash h
+								where h.file_id=f.id
+							)
+					),
+					carry as (  -- Find the most recent hash with the same identity
+						select f.id as file_id, m.md5_hash, m.md5_hash_time, m.sha1_hash, m.sha1_hash_time
+						from
+							f
+							join lateral (
+								select ha.md5_hash, ha.md5_hash_time, ha.sha1_hash, ha.sha1_hash_time
+								from hash_archive ha
+								where
+									ha.dev=f.dev and ha.ino=f.ino
+									and ha.size=f.size and ha.mtime=f.mtime
+								union all
+								select h.md5_hash, h.md5_hash_time, h.sha1_hash, h.sha1_hash_time
+								from
+									file f2
+									join hash h
+										on (h.file_id=f2.id)
+								where
+									f2.dev=f.dev and f2.ino=f.ino
+									and f2.size=f.size and f2.mtime=f.mtime
+									and f2.id <> f.id
+								order by md5_hash_time desc nulls last
+								limit 1
+							) m on true
+					),
+					ins as (
+						insert into hash
+							(file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time)
+						select file_id, md5_hash, md5_hash_time, sha1_hash, sha1_hash_time
+						from carry
+						on conflict on constraint hash_file_id_key do nothing
+						returning file_id
+					),
+					del as (  -- No need to hash them
+						delete from hash_control hc
+						using ins
+						where hc.file_id=ins.file_id
+					)
+					select count(*) into _carried_count
+					from ins;
+
+					return _carried_count;
+				end;
+				$$ LANGUAGE plpgsql;
+			""")
+
 			cur.execute("""
 				create or replace function upsert_hash 
 				(
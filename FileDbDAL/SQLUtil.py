@@ -1,3 +1,6 @@
+from psycopg2 import sql
+
+
 class SQLUtil:
 	@staticmethod
 	def util_reset_process_tasks(pg):
@@ -5,58 +8,92 @@ class SQLUtil:
 		with pg.cursor() as cur:
 			cur.execute("select * from util_reset_process_tasks();")
 
+	@staticmethod
+	def migrate_size_to_bytes(cur, table_name: str, column_name: str) -> None:
+		# File sizes used to be stored in MBs as numeric(18, 6). Convert an existing column to a whole number of bytes.
+		cur.execute(
+			"select data_type from information_schema.columns where table_name = %s and column_name = %s;",
+			(table_name, column_name)
+		)
+		row = cur.fetchone()
+		if row is None or row[0] != 'numeric':  # New install, or already converted
+			return
+
+		# The views that read the sizes block the type change. They get recreated later in the install.
+		cur.execute("drop view if exists vw_ll, vw_file_detail, dir_detail cascade;")
+		cur.execute(
+			sql.SQL("alter table {table} alter column {column} type bigint using round({column} * 1000000);").format(
+				table=sql.Identifier(table_name),
+				column=sql.Identifier(column_name),
+			)
+		)
+
+	@staticmethod
+	def to_bigint(value: int) -> int:
+		# Postgres has no unsigned 64-bit int, so wrap the large device IDs/inode numbers around to negative numbers
+		if value is not None and value >= 2 ** 63:
+			return value - 2 ** 64
+		return value
+
 	# Install the base functions that any other function, view, FK, index, could use
 	@staticmethod
 	def install_base_functions(pg):
 		cur = pg.cursor()
 
 		# Path and file name parsing functions
+		# These are plain SQL functions (no regex, no plpgsql), so that the planner inlines them into the queries that call
+		# them per row, and they can be used in the generated columns (file.extension, directory.name).
+		# !! Important: The generated columns and the expression indexes store these results, so a change to what these
+		# functions return must be followed by a rewrite of those columns and indexes.
 		cur.execute("""
-			-- Straightforward regex to remove the basename from the path
-			-- https://stackoverflow.com/a/28879164
-			-- Eg: "C:\Windows\calc.exe" -> returns "C:\Windows"
+			-- Position of the last path separator (/ or \\), counted from the end of the path. 0 when there is none.
+			-- Eg: "C:\\Windows\\calc.exe" -> returns 9
+			create or replace function path_separator_rpos(text) returns int
+			as $$
+				select strpos(reverse(translate($1, '\\', '/')), '/');
+			$$ LANGUAGE sql
+			immutable;
+
+			-- Remove the basename from the path (a separator at the start of the path is kept, eg: "/home" -> "/home")
+			-- Eg: "C:\\Windows\\calc.exe" -> returns "C:\\Windows"
 			create or replace function basepath(text) returns text
-			as $path$
-			declare
-			FILE_PATH alias for $1;
-			ret         text;
-			begin
-			ret := regexp_replace(FILE_PATH,'(?<=.)[\\/\\\\][^\\/\\\\]+$', '');
-			ret := ret || case when (right(ret, 1) = ':') then '\\' else '' end; 
-			return ret;
-			end;
-			$path$ LANGUAGE plpgsql
+			as $$
+				select
+					case
+						when path_separator_rpos($1) between 2 and length($1) - 1 then
+							left($1, length($1) - path_separator_rpos($1))
+							|| case when substr($1, length($1) - path_separator_rpos($1), 1) = ':' then '\\' else '' end
+						else
+							$1 || case when right($1, 1) = ':' then '\\' else '' end
+					end;
+			$$ LANGUAGE sql
 			immutable;
 
-			-- Straightforward regex to remove the path from the basename
-			-- https://stackoverflow.com/a/28879164
-			-- Eg: "C:\Windows\calc.exe" -> returns "calc.exe"
+			-- Remove the path from the basename
+			-- Eg: "C:\\Windows\\calc.exe" -> returns "calc.exe"
 			create or replace function basename(text) returns text
-				as $basename$
-				declare
-				FILE_PATH alias for $1;
-				ret         text;
-			begin
-				ret := regexp_replace(FILE_PATH,'^.+[\\/\\\\]', '');
-				return ret;
-			end;
-			$basename$ LANGUAGE plpgsql
+			as $$
+				select
+					case
+						when path_separator_rpos($1) between 1 and length($1) - 1 then right($1, path_separator_rpos($1) - 1)
+						else $1
+					end;
+			$$ LANGUAGE sql
 			immutable;
 
-			-- Straightforward regex to remove the path and file name to return the extension
+			-- Remove the path and file name to return the extension
 			-- Also returns lower case
-			-- https://stackoverflow.com/a/28879164
-			-- Eg: "C:\Windows\calc.eXE" -> returns ".exe"
+			-- Eg: "C:\\Windows\\calc.eXE" -> returns "exe"
 			create or replace function extension(text) returns text
-				as $extension$
-			declare
-				FILE_PATH alias for $1;
-				ret         text;
-			begin
-				ret := lower(regexp_replace(FILE_PATH,'^.+\\.', ''));
-				return ret;
-			end;
-			$extension$ LANGUAGE plpgsql
+			as $$
+				select
+					lower(
+						case
+							when strpos(reverse($1), '.') between 1 and length($1) - 1 then right($1, strpos(reverse($1), '.') - 1)
+							else $1
+						end
+					);
+			$$ LANGUAGE sql
 			immutable;
 		""")
 
@@ -73,14 +110,51 @@ class SQLUtil:
 			immutable;
 		""")
 
+		# Is the path one of the root dirs, or inside of one of them? (Eg: used to split the work by mount point)
+		cur.execute("""
+			create or replace function path_is_under(_path text, _root_paths text[])
+			returns boolean
+			as $$
+				select exists (
+					select from unnest(_root_paths) r(root_path)
+					where
+						_path = r.root_path
+						or starts_with(_path, rtrim(r.root_path, '/\\') || '/')
+						or starts_with(_path, rtrim(r.root_path, '/\\') || '\\')
+				);
+			$$ LANGUAGE sql
+			immutable;
+		""")
+
+		# path_in_subtree: Is the path the root path, or under it? The same as path_is_under() for a single root path,
+		# but written as byte ranges (the ~>=~ and ~<~ operators), so that it gets inlined into the query and uses the
+		# dir_path text_pattern_ops indexes as range scans.
+		cur.execute("""
+			create or replace function path_in_subtree(_path text, _root_path text)
+			returns boolean
+			as $$
+				select
+					_path = _root_path
+					or (  -- '0' is the character after '/'
+						_path ~>=~ (rtrim(_root_path, '/\\') || '/')
+						and _path ~<~ (rtrim(_root_path, '/\\') || '0')
+					)
+					or (  -- ']' is the character after '\\'
+						_path ~>=~ (rtrim(_root_path, '/\\') || '\\')
+						and _path ~<~ (rtrim(_root_path, '/\\') || ']')
+					);
+			$$ LANGUAGE sql
+			immutable;
+		""")
+
 		# size-to-byte converter
-		# Use these functions to convert a number (eg 150 KB) to match the file.size value (stored in bytes/100000)
+		# Use these functions to convert a number (eg 150 KB) to match the file.size value (stored in bytes)
 		cur.execute("""
 			create or replace function kb(_convert_size float)
 			returns float
 			as $$
 			begin
-				return _convert_size / 1000;
+				return _convert_size * 1000;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -89,7 +163,7 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size / 1;
+				return _convert_size * 1000 ^ 2;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -98,7 +172,7 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size / 0.001;
+				return _convert_size * 1000 ^ 3;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -107,20 +181,20 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size / 0.000001;
+				return _convert_size * 1000 ^ 4;
 			end;
 			$$ language plpgsql
 			immutable;
 		""")
 
 		# size-to-readable converter
-		# Use these functions to convert a number (eg 150 KB) to match the file.size value (stored in bytes/100000)
+		# Use these functions to convert the file.size value (stored in bytes) to a readable number (eg 150 KB)
 		cur.execute("""
 			create or replace function to_kb(_convert_size float)
 			returns float
 			as $$
 			begin
-				return _convert_size * 1024 ** -1;
+				return _convert_size / 1000;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -129,7 +203,7 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size * 1024 ** 0;
+				return _convert_size / 1000 ^ 2;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -138,7 +212,7 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size * 1024 ** 1;
+				return _convert_size / 1000 ^ 3;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -147,7 +221,7 @@ class SQLUtil:
 			returns float
 			as $$
 			begin
-				return _convert_size * 1024 ** 2;
+				return _convert_size / 1000 ^ 4;
 			end;
 			$$ language plpgsql
 			immutable;
@@ -238,13 +312,13 @@ class SQLUtil:
 			select
 				'dir' as type,
 				dir.dir_path as full_path,
-				0 as file_id, basename(dir.dir_path) as name, parent.id as dir_id, 0 as size, dir.ctime, dir.mtime, null as atime,
+				0 as file_id, dir.name, parent.id as dir_id, 0 as size, dir.ctime, dir.mtime, null as atime,
 				null as md5_hash, null as sha1_hash,
 				parent.dir_path as dir_path
 			from
 				directory dir
 				join directory parent
-					on (parent.dir_path = basepath(dir.dir_path));
+					on (parent.id = dir.parent_id);
 		""")
 
 		# vw_file_detail: List the file details (full path, file meta data, hashes)
@@ -254,7 +328,7 @@ class SQLUtil:
 			select
 				path_join(dir.dir_path, f.name) as full_path,
 				f.id, f.name, f.dir_id, f.size, f.ctime, f.mtime, f.atime,
-				h.md5_hash, h.sha1_hash, dir.dir_path, fc.category
+				h.md5_hash, h.sha1_hash, dir.dir_path, fc.category, f.extension
 			from
 				directory dir
 				join file f
@@ -262,27 +336,24 @@ class SQLUtil:
 				left join hash h
 					on (f.id=h.file_id)
 				left join file_category fc
-					on (fc.extension=extension(f.name));
+					on (fc.extension=f.extension);
 		""")
 
 		# dir_detail: List the directory details (path, file/subdir count, contents size)
 		cur.execute("""
+			drop view if exists dir_detail;  -- The column types changed, when it switched to reading directory_stats
 			create or replace view dir_detail as
 			select
 				d.id as dir_id, d.dir_path, d.ctime, d.mtime,
-				count(sd.id) as subdirs,
-				count(f.id) as files,
-				sum(coalesce(f.size, 0)) as total_size,
-				min(f.ctime) as first_file_ctime, max(f.ctime) as last_file_ctime,
-				min(f.mtime) as first_file_mtime, max(f.mtime) as last_file_mtime
+				coalesce(s.subdir_count, 0) as subdirs,
+				coalesce(s.file_count, 0) as files,
+				coalesce(s.total_size, 0) as total_size,
+				s.first_file_ctime, s.last_file_ctime,
+				s.first_file_mtime, s.last_file_mtime
 			from
 				directory d
-				left join file f
-					on (f.dir_id=d.id)
-				left join directory sd  -- Subdir
-					on (d.dir_path = basepath(sd.dir_path))
-			group by
-				d.id, d.dir_path, d.ctime, d.mtime
+				left join directory_stats s  -- Kept up to date by the merges (see refresh_directory_stats())
+					on (s.dir_id=d.id)
 		""")
 
 		pg.commit()
@@ -293,12 +364,16 @@ class SQLUtil:
 		with pg.cursor() as cur:
 			# View: vwf_dir_contents: Return the file and subdirs of a given directory array
 			cur.execute("""
+				-- The return type changed (file_size used to be in MBs), so replace the functions
+				drop function if exists vwf_dir_contents(int[]);
+				drop function if exists vwf_dir_contents(int);
+
 				create or replace function vwf_dir_contents
 				(_dir_id int[])
 				returns table 
 				(
 					type text, full_path text, dir_id int, item_id int, name text, 
-					file_size numeric(18, 6), ctime timestamp, mtime timestamp, atime timestamp, 
+					file_size bigint, ctime timestamp, mtime timestamp, atime timestamp, 
 					md5_hash text, md5_hash_time timestamp, sha1_hash text, sha1_hash_time timestamp
 				)
 				as $$
@@ -325,7 +400,7 @@ class SQLUtil:
 					select
 						'dir' as type,
 						dir.dir_path as full_path,
-						parent.id as dir_id, dir.id as item_id, basename(dir.dir_path) as name, 
+						parent.id as dir_id, dir.id as item_id, dir.name, 
 						0 as file_size, dir.ctime, dir.mtime, null as atime,
 						null as md5_hash, null as md5_hash_time, null as sha1_hash, null as sha1_hash_time
 					from
@@ -333,7 +408,7 @@ class SQLUtil:
 						join directory parent
 							on (parent.id=d_id.dir_id)
 						join directory dir
-							on (basepath(dir.dir_path)=parent.dir_path);
+							on (dir.parent_id=parent.id);
 				end;
 				$$ language plpgsql;
 			""")
@@ -345,7 +420,7 @@ class SQLUtil:
 				returns table 
 				(
 					type text, full_path text, dir_id int, item_id int, name text, 
-					file_size numeric(18, 6), ctime timestamp, mtime timestamp, atime timestamp, 
+					file_size bigint, ctime timestamp, mtime timestamp, atime timestamp, 
 					md5_hash text, md5_hash_time timestamp, sha1_hash text, sha1_hash_time timestamp
 				)  
 				as $$
@@ -356,7 +431,7 @@ class SQLUtil:
 				$$ language plpgsql; 
 			""")
 
-			# View: Return the latest ctime of all files and directories
+			# View: Return the earliest/latest ctime and mtime of all files and directories (from directory_stats)
 			cur.execute("""
 				create or replace function vwf_directory_activity 
 				(_dir_id int[])
@@ -372,12 +447,12 @@ class SQLUtil:
 				begin
 					return query
 					select 
-						dc.dir_id, 
-						min(dc.ctime) as first_ctime, min(dc.mtime) as first_mtime,
-						max(dc.ctime) as last_ctime, max(dc.mtime) as last_mtime
+						s.dir_id, 
+						s.first_ctime, s.first_mtime,
+						s.last_ctime, s.last_mtime
 					from 
-						vwf_dir_contents(_dir_id) dc
-					group by dc.dir_id;
+						directory_stats s
+					where s.dir_id = any(_dir_id);
 				end;
 				$$ language plpgsql;
 			""")
@@ -417,6 +492,7 @@ class SQLUtil:
 				delete from directory_control_process;
 				delete from file_stage;
 				delete from file_stage_process;
+				delete from directory_control_bulk_stage;  -- Unfinished bulk imports restart from the beginning
 				
 				
 				-- Release the directory_control rows that were assigned to the process
@@ -562,6 +638,42 @@ class SQLUtil:
 			$$ language plpgsql;
 		""")
 
+		# crawl_frequency_change_rate_calculate
+		cur.execute("""
+			create or replace function crawl_frequency_change_rate_calculate
+			(
+				_changed_crawls float,  -- The dir's change history (directory_control.changed_crawls_ewma)
+				_crawled_seconds float,  -- (directory_control.crawled_seconds_ewma)
+				_target_staleness float,  -- Fraction of the time that the dir's contents can be out of date in the DB
+				_min_frequency int default null,  -- Lowest number of seconds allowed to be returned. null = no limit
+				_max_frequency int default null  -- Highest number of seconds allowed to be returned. null = no limit
+			)
+			returns int
+			as $$
+				/*
+				* Treat the dir's changes as random (Poisson) events, with a rate of _changed_crawls / _crawled_seconds
+				* changes per second. Between two crawls of a dir that is crawled every N seconds, its contents are out of
+				* date for about (rate * N / 2) of the time, so crawl it every (2 * _target_staleness / rate) seconds.
+				* The dirs that change the most get crawled the most, and the dirs that never change back off to the
+				* _max_frequency.
+				* The 0.25 is a prior of a fraction of a change, so that a dir that was never seen changing does not get a
+				* rate of 0, and backs off a few times over with each crawl instead.
+				* Returns null if the dir has no change history yet.
+				*/
+				select
+					case when _crawled_seconds > 0 then
+						least(
+							greatest(
+								2 * _target_staleness * _crawled_seconds / (_changed_crawls + 0.25),
+								_min_frequency
+							),
+							_max_frequency
+						)::int
+					end;
+			$$ language sql
+			immutable;
+		""")
+
 		pg.commit()
 		cur.close()
 
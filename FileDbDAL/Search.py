@@ -82,7 +82,7 @@ class Search:
 					from vw_ll
 					where 
 						name like _name  -- Match the file name
-						or basename(dir_path) like _name;  -- Match the dir name
+						or dir_id in (select id from directory where name like _name);  -- Match the dir name
 				end;
 				$$ language plpgsql;
 			""")
@@ -116,7 +116,7 @@ class Search:
 					return query
 					select *
 					from directory
-					where basename(dir_path) like _name;
+					where name like _name;
 				end;
 				$$ language plpgsql;
 			""")
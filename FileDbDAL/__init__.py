@@ -1,5 +1,10 @@
 from FileDbDAL.Pg import Pg
+from FileDbDAL.CopyWriter import CopyWriter
 from FileDbDAL.DirectoryCrawl import DirectoryCrawl
+from FileDbDAL.CrawlPool import CrawlPool
+from FileDbDAL.BulkImport import BulkImport
+from FileDbDAL.CatalogImport import CatalogImport
+from FileDbDAL.CrawlExclusion import CrawlExclusion
 from FileDbDAL.File import File
 from FileDbDAL.Directory import Directory
 from FileDbDAL.Hash import Hash
@@ -24,19 +29,23 @@ class Install:
 		Directory.install_datatypes(pg)
 		File.install_datatypes(pg)
 
+		# Create the base functions (these are dependencies used throughout other functions, views, and indexes, and in
+		# the tables' generated columns, so they must not depend on any table):
+		print("Installing base functions...")
+		SQLUtil.install_base_functions(pg)
+
 		# Create the tables (do this first, and afterwards create the dependencies like functions, views, and FKs):
 		print("Installing tables...")
 		Directory.install_tables(pg, drop_tables)
 		File.install_tables(pg, drop_tables)
 		Hash.install_tables(pg, drop_tables)
 		DirectoryCrawl.install_tables(pg, drop_tables)
+		BulkImport.install_tables(pg, drop_tables)
+		CatalogImport.install_tables(pg, drop_tables)
+		CrawlExclusion.install_tables(pg, drop_tables)
 		Search.install_tables(pg, drop_tables)
 		FileHandler.install_tables(pg, drop_tables)
 
-		# Create the base functions (these are dependencies used throughout other functions, views, and indexes):
-		print("Installing base functions...")
-		SQLUtil.install_base_functions(pg)
-
 		# Create the indexes
 		# Some index thoughts:
 		# 	tl;dr: Use lots of indexes on file, directory, and hash, and few indexes on the staging and control tables.
@@ -51,6 +60,9 @@ class Install:
 		File.install_indexes(pg)
 		Hash.install_indexes(pg)
 		DirectoryCrawl.install_indexes(pg)
+		BulkImport.install_indexes(pg)
+		CatalogImport.install_indexes(pg)
+		CrawlExclusion.install_indexes(pg)
 		Search.install_indexes(pg)
 		FileHandler.install_indexes(pg)
 
@@ -65,6 +77,9 @@ class Install:
 		File.install_pg_functions(pg)
 		Hash.install_pg_functions(pg)
 		DirectoryCrawl.install_pg_functions(pg)
+		BulkImport.install_pg_functions(pg)
+		CatalogImport.install_pg_functions(pg)
+		CrawlExclusion.install_pg_functions(pg)
 		SQLUtil.install_pg_functions(pg)
 		Search.install_pg_functions(pg)
 		FileHandler.install_pg_functions(pg)
@@ -79,6 +94,9 @@ class Install:
 		File.install_foreign_keys(pg)
 		Hash.install_foreign_keys(pg)
 		DirectoryCrawl.install_foreign_keys(pg)
+		BulkImport.install_foreign_keys(pg)
+		CatalogImport.install_foreign_keys(pg)
+		CrawlExclusion.install_foreign_keys(pg)
 		Search.install_foreign_keys(pg)
 		FileHandler.install_foreign_keys(pg)
 
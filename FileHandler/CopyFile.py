@@ -7,7 +7,7 @@ import shutil
 class CopyFile:
 	def __init__(
 			self, id: int = 0, file_path: str = '', new_path: str = '', move_file: bool = False, overwrite: str = 'N',
-			file_hash: str = None, hash_type: str = None, file_size: float = 0, perform_hash_check: bool = False
+			file_hash: str = None, hash_type: str = None, file_size: int = 0, perform_hash_check: bool = False
 	):
 		self.id = id
 		self.file_path = file_path.strip()
@@ -3,10 +3,14 @@ import hashlib
 
 class HashFile:
 	@staticmethod
-	def hash_file(file_path: str, hash_types: list) -> dict:
+	def hash_file(file_path: str, hash_types: list, throttle=None, raw_digest: bool = False) -> dict:
 		# https://stackoverflow.com/a/22058673/4458445
+		# throttle: Optional function that is passed the number of bytes read, and sleeps to pace the reads
+		# raw_digest: Return the digests as bytes, instead of hex strings (half the size to pass around and store)
 
 		buffer_size = 128 * 64  # https://stackoverflow.com/a/1131238/4458445
+		throttle_size = 1024 * 1024  # Number of bytes to read between calls to throttle()
+		unthrottled_bytes = 0
 		hash_output = {}
 
 		# Build the hash objects
@@ -37,6 +41,15 @@ class HashFile:
 					# Loop through each of the different hash types and update the hash with the new chunk
 					for hash_type, hash in hashes.items():
 						hash.update(data)
+
+					# Stay inside of the I/O budget
+					unthrottled_bytes += len(data)
+					if throttle is not None and unthrottled_bytes >= throttle_size:
+						throttle(unthrottled_bytes)
+						unthrottled_bytes = 0
+
+				if throttle is not None and unthrottled_bytes:
+					throttle(unthrottled_bytes)
 		except (PermissionError, OSError):
 			# TODO: What to do when the hashing fails because the file is inaccessible?
 			pass
@@ -46,6 +59,6 @@ class HashFile:
 
 		# Get the hash to be returned
 		for hash_type, hash in hashes.items():
-			hash_output[hash_type] = hash.hexdigest()
+			hash_output[hash_type] = hash.digest() if raw_digest else hash.hexdigest()
 
 		return hash_output
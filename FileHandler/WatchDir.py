@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import select
+import struct
+
+
+class WatchDir:
+	# Watch directories for changes with Linux's inotify, through libc (no extra dependencies required).
+	# inotify only reports changes to a directory's immediate contents, so each directory needs its own watch.
+
+	# inotify event flags (from <sys/inotify.h>)
+	IN_ATTRIB = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_NONBLOCK = 0x00000800  # Same as O_NONBLOCK
+	IN_CLOEXEC = 0x00080000  # Same as O_CLOEXEC
+
+	# Only the events that change what a crawl would find. Eg: IN_MODIFY is skipped, since it fires for every write(),
+	# and IN_CLOSE_WRITE will follow it.
+	WATCH_MASK = (
+		IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+		| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+	)
+
+	EVENT_HEADER = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len (followed by the name)
+
+	def __init__(self, max_watches: int = 8192):
+		self.max_watches = max_watches
+		self.watch_dirs = {}  # {wd: dir_id}
+		self.watch_descriptors = {}  # {dir_id: wd}
+		self.watch_limit_reached = False
+
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+	@staticmethod
+	def is_supported() -> bool:
+		# inotify is only available on Linux
+		if platform.system() != "Linux":
+			return False
+		libc_name = ctypes.util.find_library('c')
+		return libc_name is not None and hasattr(ctypes.CDLL(libc_name), 'inotify_init1')
+
+	def add_watch(self, dir_id: int, dir_path: str) -> bool:
+		# Is this dir already being watched, or is the budget used up?
+		if dir_id in self.watch_descriptors:
+			return True
+		if len(self.watch_descriptors) >= self.max_watches:
+			return False
+
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.WATCH_MASK)
+		if wd < 0:
+			# The OS's limit (fs.inotify.max_user_watches) was hit
+			if ctypes.get_errno() == errno.ENOSPC and not self.watch_limit_reached:
+				self.watch_limit_reached = True
+				print("Warning: The inotify watch limit was reached. Raise fs.inotify.max_user_watches to watch more dirs")
+			return False  # Missing or unreadable dir
+
+		self.watch_dirs[wd] = dir_id
+		self.watch_descriptors[dir_id] = wd
+		return True
+
+	def remove_watch(self, dir_id: int) -> None:
+		wd = self.watch_descriptors.pop(dir_id, None)
+		if wd is None:
+			return
+		del self.watch_dirs[wd]
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def sync_watches(self, dirs: dict) -> None:
+		# Watch exactly the dirs in the {dir_id: dir_path} dict
+		for dir_id in set(self.watch_descriptors) - set(dirs):
+			self.remove_watch(dir_id)
+		for dir_id, dir_path in dirs.items():
+			self.add_watch(dir_id, dir_path)
+
+	def read_changed_dirs(self, timeout: float = 0.5) -> set:
+		# Wait for events, and return the set of dir_ids that had a change. Multiple events in a dir are coalesced.
+		changed = set()
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return changed
+
+		while True:
+			try:
+				buffer = os.read(self.fd, 64 * 1024)
+			except BlockingIOError:  # All of the queued events are read
+				break
+
+			offset = 0
+			while offset < len(buffer):
+				wd, mask, cookie, name_len = self.EVENT_HEADER.unpack_from(buffer, offset)
+				offset += self.EVENT_HEADER.size + name_len
+
+				# The kernel's event queue overflowed, so events were lost. Treat every watched dir as changed.
+				if mask & self.IN_Q_OVERFLOW:
+					changed.update(self.watch_descriptors)
+					continue
+
+				dir_id = self.watch_dirs.get(wd)
+				if dir_id is None:
+					continue
+
+				# The watch was removed by the kernel (eg: the dir was deleted)
+				if mask & self.IN_IGNORED:
+					del self.watch_dirs[wd]
+					del self.watch_descriptors[dir_id]
+
+				changed.add(dir_id)
+
+		return changed
@@ -37,8 +37,8 @@ class DuplicateFinder:
 							from vw_file_detail
 							where 
 								dir_path like %s
-								and size > 0.010  -- 10 KBs
-								and extension(name) in ('jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'webp')
+								and size > kb(10)
+								and extension in ('jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'webp')
 							group by sha1_hash, size
 						)
 						-- Get the corresponding files for those hashes
@@ -1,6 +1,11 @@
 import multiprocessing as MP
 import FileDbDAL
+from FileHandler.WatchDir import WatchDir
 from Util.Config import Config
+from Util.DeviceGroup import DeviceGroup
+from Util.IOBudget import IOBudget
+import contextlib
+import functools
 import time
 import sys
 import traceback
@@ -26,27 +31,88 @@ class Process:
 			'manage_hash_queue': self.config['SERVER']['THREADS']['manage_hash_queue'],
 			'hash_files': self.config['SERVER']['THREADS']['hash_files'],
 			'load_hashes': self.config['SERVER']['THREADS']['load_hashes'],
+			'bulk_import_dirs': self.config['SERVER']['THREADS']['bulk_import_dirs'],
 		}
 
+		# Set how many threads each process should run. Threads overlap the time spent waiting on the disk/network.
+		self.thread_pool_size = {
+			'crawl_dir': self.config['SERVER']['THREAD_POOLS']['crawl_dir'],
+		}
+
+		# Incremental crawls skip restaging dirs whose listing is unchanged, with a periodic full crawl as a safety net
+		# (number of seconds between full crawls of a dir. 0 = always perform full crawls)
+		self.full_crawl_frequency = self.config['SERVER']['INCREMENTAL_CRAWL']['full_crawl_frequency']
+
+		# New dirs (eg: added in the install) have their whole subtree imported in one pass. Number of entries per batch.
+		self.bulk_import_batch_size = self.config['SERVER']['BULK_IMPORT']['batch_size']
+
+		# The crawl results are written into the staging tables by the "copy" writer (streamed with COPY, in the "text"
+		# or "binary" format), or by the "function" writer (one stage_dir_contents() call per batch, with column arrays)
+		self.staging_writer = self.config['SERVER']['STAGING']['writer']
+		self.staging_copy_format = self.config['SERVER']['STAGING']['copy_format']
+		# The hashes are loaded with binary COPY, in batches of up to this many rows/bytes
+		self.hash_batch_rows = self.config['SERVER']['STAGING']['hash_batch_rows']
+		self.hash_batch_bytes = self.config['SERVER']['STAGING']['hash_batch_bytes']
+		# The staged contents are merged in chunks of up to this many crawled dirs (each chunk is its own transaction)
+		self.merge_dir_limit = self.config['SERVER']['STAGING']['merge_dir_limit']
+
+		# Pipeline mode: each crawl_dir process keeps its own DB connection, and stages its crawled dirs itself (in
+		# batches of up to batch_entries files/subdirs, or batch_seconds old), instead of passing them through the
+		# insert_dir_contents queue and processes. Needs a DB connection per crawl_dir process.
+		self.pipeline_mode = self.config['SERVER']['PIPELINE_MODE']['enabled']
+		self.pipeline_batch_entries = self.config['SERVER']['PIPELINE_MODE']['batch_entries']
+		self.pipeline_batch_seconds = self.config['SERVER']['PIPELINE_MODE']['batch_seconds']
+
+		# Rules for the dirs and files that should not be crawled (eg: /proc, node_modules, other file systems)
+		self.crawl_exclusion = FileDbDAL.CrawlExclusion.from_config(self.config['SERVER']['EXCLUSIONS'], self.config)
+
+		# Split the crawling and hashing by device (mount points), each with its own queues and concurrency limits.
+		# The first group is the default, for everything not under a configured device.
+		self.device_groups = DeviceGroup.from_config(self.config['SERVER'])
+
+		# I/O budgets: bytes/s read while hashing, and stat calls/s while crawling. The global budgets cap everything,
+		# and the devices with their own budgets are also capped by them. (eg: "hash_io", "hash_io:usb_backup")
+		self.io_budgets = {
+			'hash_io': IOBudget.from_config(self.config['SERVER']['IO_BUDGET'], 'hash_bytes_per_second', 'MB', 1000 ** 2),
+			'crawl_io': IOBudget.from_config(self.config['SERVER']['IO_BUDGET'], 'crawl_ops_per_second'),
+		}
+		for group in self.device_groups:
+			if group.io_budget is not None:
+				self.io_budgets[group.queue_key('hash_io')] = IOBudget.from_config(
+					group.io_budget, 'hash_bytes_per_second', 'MB', 1000 ** 2
+				)
+				self.io_budgets[group.queue_key('crawl_io')] = IOBudget.from_config(
+					group.io_budget, 'crawl_ops_per_second'
+				)
+
+		# Optionally watch the most active dirs for changes (Linux inotify), to crawl them as soon as they change
+		self.watch_dirs_config = self.config['SERVER']['WATCH_DIRS']
+
 		# Build the queues that will be available
 		self.queues = {
-			'crawl_dir_queue': MP.Queue(),
 			'insert_dir_contents_queue': MP.Queue(),
-			'hash_files_queue': MP.Queue(),
 			'load_hashes_queue': MP.Queue(),
 		}
+		if self.pipeline_mode:  # The crawl_dir processes stage their results themselves
+			del self.queues['insert_dir_contents_queue']
 
 		# Set the max size of each queue, relative to the number of processes to be spawned
 		self.queue_maximums = {
-			'crawl_dir_queue': self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['crawl_dir_queue'] * self.process_count['crawl_dir'],
 			'insert_dir_contents_queue': self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['insert_dir_contents_queue'] * self.process_count['insert_dir_contents'],
-			'hash_files_queue': self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['hash_files_queue'] * self.process_count['hash_files'],
 			'load_hashes_queue': self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['load_hashes_queue'] * self.process_count['load_hashes'],
 		}
 
+		# Each device group gets its own crawl and hash queues (eg: "crawl_dir_queue:usb_backup")
+		for group in self.device_groups:
+			self.queues[group.queue_key('crawl_dir_queue')] = MP.Queue()
+			self.queues[group.queue_key('hash_files_queue')] = MP.Queue()
+			self.queue_maximums[group.queue_key('crawl_dir_queue')] = self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['crawl_dir_queue'] * group.crawl_dir
+			self.queue_maximums[group.queue_key('hash_files_queue')] = self.config['SERVER']['QUEUE_MAXIMUMS_PER_THREAD']['hash_files_queue'] * group.hash_files
+
 		# Set the max seconds before a queue needs to be cleared
 		self.queue_timers = {
 			'manage_crawl_dirs': 5,
+			'bulk_import_dirs': 5,
 			'insert_dir_contents_timer': 5,
 			'finalize_dir_contents_timer': 5,
 			'process_db_removal_file': 1,
@@ -66,7 +132,10 @@ class Process:
 		processes = []  # List of processes that will run the program
 		try:
 			### Start up the process to get the list of directories to call
-			self.crawl_drives(self.queues['crawl_dir_queue'])
+			self.crawl_drives(self.queues, self.device_groups)
+
+			# Apply the exclusion rules to what is already in the DB
+			self.sync_exclusions()
 
 			### Start up the process to get the list of directories to call
 			# TODO: Make sure that all of these processes get created!
@@ -75,26 +144,58 @@ class Process:
 				MP.Process(
 					target=self.manage_crawl_dirs, args=(
 						self.queue_maximums,
-						self.queues['crawl_dir_queue'],
-						self.queue_timers['manage_crawl_dirs']
+						self.queues,
+						self.device_groups,
+						self.queue_timers['manage_crawl_dirs'],
+						self.full_crawl_frequency,
 					)
 				)
 				for i in range(self.process_count['manage_crawl_dirs'])
 			]
 
-			# Scrape each subdirectory in the queue
+			# Scrape each subdirectory in the queue, with each device's own number of processes and threads
 			processes += [
 				MP.Process(
 					target=self.crawl_dir, args=(
 						self.queue_maximums,
-						self.queues['crawl_dir_queue'],
-						self.queues['insert_dir_contents_queue'],
+						self.queues[group.queue_key('crawl_dir_queue')],
+						self.queues.get('insert_dir_contents_queue'),  # None in pipeline mode
+						group.crawl_dir_pool,
+						self.crawl_exclusion,
+						self.get_io_budgets(group, 'crawl_io'),
 					)
 				)
-				for i in range(self.process_count['crawl_dir'])
+				for group in self.device_groups
+				for i in range(group.crawl_dir)
 			]
 
-			# Insert the contents of the directories (files and subdirs)
+			# Import the subtrees of new directories in one pass
+			processes += [
+				MP.Process(
+					target=self.bulk_import_dirs, args=(
+						self.thread_pool_size['crawl_dir'],
+						self.bulk_import_batch_size,
+						self.queue_timers['bulk_import_dirs'],
+						self.crawl_exclusion,
+						[self.io_budgets['crawl_io']],
+					)
+				)
+				for i in range(self.process_count['bulk_import_dirs'])
+			]
+
+			# Watch the most active directories for changes, and schedule them to be crawled immediately
+			if self.watch_dirs_config['enabled']:
+				processes += [
+					MP.Process(
+						target=self.watch_dirs, args=(
+							self.watch_dirs_config['max_watches'],
+							self.watch_dirs_config['coalesce_seconds'],
+							self.watch_dirs_config['refresh_frequency'],
+						)
+					)
+				]
+
+			# Insert the contents of the directories (files and subdirs). Not needed in pipeline mode.
 			processes += [
 				MP.Process(
 					target=self.insert_dir_contents, args=(
@@ -103,7 +204,7 @@ class Process:
 						self.queue_timers['insert_dir_contents_timer'],
 					)
 				)
-				for i in range(self.process_count['insert_dir_contents'])
+				for i in range(0 if self.pipeline_mode else self.process_count['insert_dir_contents'])
 			]
 
 			# Finalize the directory crawl within the DB
@@ -143,23 +244,26 @@ class Process:
 				MP.Process(
 					target=self.manage_hash_queue, args=(
 						self.queue_maximums,
-						self.queues['hash_files_queue'],
+						self.queues,
+						self.device_groups,
 						self.queue_timers['manage_hash_queue'],
 					)
 				)
 				for i in range(self.process_count['manage_hash_queue'])
 			]
 
-			# Hash each file
+			# Hash each file, with each device's own number of processes
 			processes += [
 				MP.Process(
 					target=self.hash_files, args=(
 						self.queue_maximums,
-						self.queues['hash_files_queue'],
+						self.queues[group.queue_key('hash_files_queue')],
 						self.queues['load_hashes_queue'],
+						self.get_io_budgets(group, 'hash_io'),
 					)
 				)
-				for i in range(self.process_count['hash_files'])
+				for group in self.device_groups
+				for i in range(group.hash_files)
 			]
 
 			# Insert the hashes to the staging table and process them
@@ -179,6 +283,7 @@ class Process:
 				MP.Process(
 					target=self.output_debug, args=(
 						self.queues,
+						self.io_budgets,
 					)
 				)
 				for i in range(1)
@@ -213,41 +318,69 @@ class Process:
 			FileDbDAL.SQLUtil.util_reset_process_tasks(pg)
 			print("Tasks are reset")
 
-	# Populate the initial queue from the drives
-	def crawl_drives(self, crawl_dir_queue):
+	def get_io_budgets(self, group, budget_name: str) -> list:
+		# The budgets that a device group's workers draw from: the device's own (if it has one), and the global one
+		budgets = [self.io_budgets[budget_name]]
+		if group.io_budget is not None:
+			budgets.insert(0, self.io_budgets[group.queue_key(budget_name)])
+		return budgets
+
+	def sync_exclusions(self):
+		with FileDbDAL.Pg(self.config) as pg:
+			print("Syncing the crawl exclusions...")
+			removal_count = self.crawl_exclusion.sync_rules(pg)
+			print(f"Crawl exclusions are synced. {removal_count} excluded dirs/files are queued to be removed")
+
+	# Populate the initial queues from the drives
+	def crawl_drives(self, queues, device_groups):
 		print("Initializing the crawl with the drives")
 		with FileDbDAL.Pg(self.config) as pg:
 			# Get the list of drives
 			drives = FileDbDAL.DirectoryCrawl.get_drives_to_crawl(pg)
 
-			# Put the drives into the queue to be crawled
+			# Put the drives into the queue of their device, to be crawled
 			for drive in drives:
-				crawl_dir_queue.put(drive)
+				group = DeviceGroup.get_group(device_groups, drive.dir_path)
+				queues[group.queue_key('crawl_dir_queue')].put(drive)
 
 	# Manage the directory crawling
-	def manage_crawl_dirs(self, queue_maximums, crawl_dir_queue, empty_queue_sleep: float = 15):
+	def manage_crawl_dirs(
+		self, queue_maximums, queues, device_groups, empty_queue_sleep: float = 15, full_crawl_frequency: int = None
+	):
 		with FileDbDAL.Pg(self.config) as pg:
 			# Populate the queues for the threads
 			while True:
 				# Output debug info
 				try:
-					# If the queue is not below the threshold to be refilled, then snooze
-					if crawl_dir_queue.qsize() >= (queue_maximums['crawl_dir_queue'] * 0.50):
-						continue
-
-					# Get the list of dirs to crawl, and add them to a queue
-					process_id = random.randint(1, 2 ** 16)
-					num_dirs = (queue_maximums['crawl_dir_queue']) - crawl_dir_queue.qsize()
-					# This function retrieves the dirs from the DB and puts them in the queue, then returns rowcount
-					cursor_rowcount = FileDbDAL.DirectoryCrawl.get_dirs_to_crawl(
-						pg,
-						crawl_dir_queue,
-						process_id,
-						num_dirs
-					)
+					refilled = False
+					cursor_rowcount = 0
+
+					# Each device has its own queue, so a slow device's full queue does not hold up the others
+					for group in device_groups:
+						queue_key = group.queue_key('crawl_dir_queue')
+						crawl_dir_queue = queues[queue_key]
+
+						# If the queue is not below the threshold to be refilled, then snooze
+						if crawl_dir_queue.qsize() >= (queue_maximums[queue_key] * 0.50):
+							continue
+
+						# Get the list of dirs to crawl, and add them to a queue
+						process_id = random.randint(1, 2 ** 16)
+						num_dirs = (queue_maximums[queue_key]) - crawl_dir_queue.qsize()
+						# This function retrieves the dirs from the DB and puts them in the queue, then returns rowcount
+						refilled = True
+						cursor_rowcount += FileDbDAL.DirectoryCrawl.get_dirs_to_crawl(
+							pg,
+							crawl_dir_queue,
+							process_id,
+							num_dirs,
+							full_crawl_frequency,
+							group.include_paths,
+							group.exclude_paths,
+						)
 
 					# Check if there are any dirs left to crawl after this batch
-					if cursor_rowcount == 0:
+					if refilled and cursor_rowcount == 0:
 						# Since there are no
 						time.sleep(empty_queue_sleep)
 
@@ -260,39 +393,146 @@ class Process:
 				finally:
 					time.sleep(0.5)
 
-	def crawl_dir(self, queue_maximums, crawl_dir_queue, insert_dir_contents_queue):
-		while True:
-			try:
-				# Make sure the destination queue is not full
-				if insert_dir_contents_queue.qsize() >= queue_maximums['insert_dir_contents_queue']:
-					time.sleep(0.5)
-					continue
+	def crawl_dir(
+		self, queue_maximums, crawl_dir_queue, insert_dir_contents_queue, pool_size: int = 1, exclusion=None,
+		io_budgets: list = None
+	):
+		# insert_dir_contents_queue: None = pipeline mode, where the crawled dirs are staged directly by this process
+		queue_complete = False
+		# Pace the stat calls to stay inside of the I/O budgets
+		throttle = functools.partial(IOBudget.throttle, io_budgets) if io_budgets else None
 
-				# Wait until the queue has data
-				if crawl_dir_queue.empty() is True:
-					time.sleep(0.2)
-					continue
+		# Pipeline mode: the batch of crawled dirs waiting to be staged
+		staging_batch = []
+		staging_batch_entries = 0
+		staging_batch_started = 0
 
-				# Get the current directory (DirectoryCrawl object) to work with
-				dc = crawl_dir_queue.get(True)
+		staging_pg = FileDbDAL.Pg(self.config) if insert_dir_contents_queue is None else contextlib.nullcontext()
 
-				# Is the queue complete?
-				if dc == "-1":
-					print("Done crawl_dir")
-					break
+		# Crawl multiple directories at once within this process, using a pool of threads
+		with FileDbDAL.CrawlPool(pool_size, exclusion=exclusion, throttle=throttle) as crawl_pool, staging_pg as pg:
+			while True:
+				try:
+					# Now that the contents are collected, pass them to the queue to be inserted into the DB
+					for dc in crawl_pool.iter_crawled(timeout=0.2):
+						if pg is None:
+							insert_dir_contents_queue.put(dc)
+						else:
+							staging_batch_started = staging_batch_started or time.time()
+							staging_batch.append(dc)
+							staging_batch_entries += dc.file_count + dc.subdir_count + 1
+
+					# Pipeline mode: stage the batch once it is big or old enough, or once the crawls are caught up
+					if staging_batch and (
+						staging_batch_entries >= self.pipeline_batch_entries
+						or time.time() - staging_batch_started >= self.pipeline_batch_seconds
+						or crawl_pool.dir_count() == 0
+					):
+						FileDbDAL.DirectoryCrawl.stage_crawled_dirs(
+							pg, staging_batch, self.staging_copy_format, self.staging_writer
+						)
+						staging_batch = []
+						staging_batch_entries = 0
+						staging_batch_started = 0
+
+					# Is the queue complete, and all of the crawls finished?
+					if queue_complete:
+						if crawl_pool.dir_count() == 0:
+							print("Done crawl_dir")
+							break
+						continue
 
-				# Scrape the directory's contents and build the objects of metadata
-				dc.scrape_dir_contents(build_objects=True)
+					# Make sure the destination queue is not full
+					if pg is None and insert_dir_contents_queue.qsize() >= queue_maximums['insert_dir_contents_queue']:
+						time.sleep(0.5)
+						continue
 
-				# Now that the contents are collected, pass it to the queue to be inserted into the DB
-				insert_dir_contents_queue.put(dc)
+					# Keep the threads busy, without claiming more directories than they can work on
+					while crawl_pool.dir_count() < pool_size * 2 and crawl_dir_queue.empty() is False:
+						# Get the next directory (DirectoryCrawl object) to work with
+						dc = crawl_dir_queue.get(True)
 
-			except:  # Ugh
-				print("-" * 60)
-				print("Exception occurred in crawl_dir")
-				print(str(sys.exc_info()))
-				traceback.print_exc(file=sys.stdout)
-				print("-" * 60)
+						# Is the queue complete?
+						if dc == "-1":
+							queue_complete = True
+							break
+
+						# Scrape the directory's contents and build the objects of metadata
+						crawl_pool.submit(dc)
+
+				except:  # Ugh
+					print("-" * 60)
+					print("Exception occurred in crawl_dir")
+					print(str(sys.exc_info()))
+					traceback.print_exc(file=sys.stdout)
+					print("-" * 60)
+
+	def bulk_import_dirs(
+		self, pool_size: int, batch_size: int, empty_queue_sleep: float = 5, exclusion=None, io_budgets: list = None
+	) -> None:
+		throttle = functools.partial(IOBudget.throttle, io_budgets) if io_budgets else None
+
+		with FileDbDAL.Pg(self.config) as pg:
+			while True:
+				try:
+					# Claim the next new dir to import
+					dir_to_import = FileDbDAL.BulkImport.get_dir_to_import(pg)
+					if dir_to_import is None:
+						time.sleep(empty_queue_sleep)
+						continue
+
+					# Walk the whole subtree, and load it into the DB
+					dir_id, dir_path = dir_to_import
+					print(f"Bulk importing: {dir_path}")
+					start_time = time.time()
+					bulk_import = FileDbDAL.BulkImport(pg, dir_id, dir_path, pool_size, batch_size, exclusion, throttle)
+					bulk_import.run()
+					print(
+						f"Bulk imported {bulk_import.dir_count} dirs and {bulk_import.file_count} files in "
+						f"{round(time.time() - start_time, 1)}s: {dir_path}"
+					)
+				except:  # Ugh
+					print("-" * 60)
+					print("Exception occurred in bulk_import_dirs")
+					print(str(sys.exc_info()))
+					traceback.print_exc(file=sys.stdout)
+					print("-" * 60)
+					time.sleep(1)
+
+	def watch_dirs(self, max_watches: int, coalesce_seconds: float, refresh_frequency: float) -> None:
+		if not WatchDir.is_supported():
+			print("Watching dirs for changes requires Linux (inotify). Dirs will only be crawled on their schedule.")
+			return
+
+		last_refresh = 0
+		changed_dir_ids = set()
+		first_change = None  # When the oldest unscheduled change was seen
+
+		with FileDbDAL.Pg(self.config) as pg, WatchDir(max_watches) as watcher:
+			while True:
+				try:
+					# Periodically refresh which dirs are watched, as the dirs' crawl frequencies change
+					if time.time() - last_refresh >= refresh_frequency:
+						last_refresh = time.time()
+						watcher.sync_watches(FileDbDAL.DirectoryCrawl.get_dirs_to_watch(pg, max_watches))
+
+					# Collect the changed dirs
+					if new_changes := watcher.read_changed_dirs(timeout=0.5):
+						changed_dir_ids |= new_changes
+						first_change = first_change or time.time()
+
+					# Coalesce bursts of changes (eg: a file being copied in), then schedule the dirs in one call
+					if changed_dir_ids and time.time() - first_change >= coalesce_seconds:
+						FileDbDAL.DirectoryCrawl.schedule_dirs_crawl_now(pg, changed_dir_ids)
+						changed_dir_ids = set()
+						first_change = None
+				except:  # Ugh
+					print("-" * 60)
+					print("Exception occurred in watch_dirs")
+					print(str(sys.exc_info()))
+					traceback.print_exc(file=sys.stdout)
+					print("-" * 60)
+					time.sleep(1)
 
 	def insert_dir_contents(self, queue_maximums, insert_dir_contents_queue, db_dump_interval):
 		# Start the timer
@@ -316,7 +556,9 @@ class Process:
 
 					# Reset the timer
 					last_flush = time.time()
-					FileDbDAL.DirectoryCrawl.stage_dir_contents(pg, insert_dir_contents_queue)
+					FileDbDAL.DirectoryCrawl.stage_dir_contents(
+						pg, insert_dir_contents_queue, self.staging_copy_format, self.staging_writer
+					)
 				except:  # Ugh
 					print("-" * 60)
 					print("Exception occurred in insert_dir_contents")
@@ -338,8 +580,9 @@ class Process:
 
 					# Reset the timer
 					last_flush = time.time()
-					# Server the dir's contents that were staged
-					FileDbDAL.DirectoryCrawl.process_staged_dir_contents(pg)
+					# Merge the dir's contents that were staged, in chunks, until the backlog is empty
+					while FileDbDAL.DirectoryCrawl.process_staged_dir_contents(pg, self.merge_dir_limit):
+						pass
 				except Exception:  # Ugh
 					print("-" * 60)
 					print("Exception occurred in finalize_dir_contents")
@@ -397,28 +640,39 @@ class Process:
 					raise
 
 	# Manage the file hashing queue
-	def manage_hash_queue(self, queue_maximums, hash_files_queue, empty_queue_sleep):
+	def manage_hash_queue(self, queue_maximums, queues, device_groups, empty_queue_sleep):
 		with FileDbDAL.Pg(self.config) as pg:
 			# Populate the queues for the threads
 			while True:
 				# Output debug info
 				try:
-					# If the queue is not below the threshold to be refilled, then snooze
-					if hash_files_queue.qsize() >= (queue_maximums['hash_files_queue'] * 0.50):
-						continue
-
-					# Get the list of files to hash, and add them to a queue
-					process_id = random.randint(1, 2 ** 16)
-					num_hashes = (queue_maximums['hash_files_queue']) - hash_files_queue.qsize()
-					cursor_rowcount = FileDbDAL.DirectoryCrawl.get_files_to_hash(
-						pg,
-						hash_files_queue,
-						process_id,
-						num_hashes,
-					)
+					refilled = False
+					cursor_rowcount = 0
+
+					# Each device has its own queue, so a slow device's full queue does not hold up the others
+					for group in device_groups:
+						queue_key = group.queue_key('hash_files_queue')
+						hash_files_queue = queues[queue_key]
+
+						# If the queue is not below the threshold to be refilled, then snooze
+						if hash_files_queue.qsize() >= (queue_maximums[queue_key] * 0.50):
+							continue
+
+						# Get the list of files to hash, and add them to a queue
+						process_id = random.randint(1, 2 ** 16)
+						num_hashes = (queue_maximums[queue_key]) - hash_files_queue.qsize()
+						refilled = True
+						cursor_rowcount += FileDbDAL.DirectoryCrawl.get_files_to_hash(
+							pg,
+							hash_files_queue,
+							process_id,
+							num_hashes,
+							group.include_paths,
+							group.exclude_paths,
+						)
 
 					# Check if there are any dirs left to crawl after this batch
-					if cursor_rowcount == 0:
+					if refilled and cursor_rowcount == 0:
 						# Since there are no
 						time.sleep(empty_queue_sleep)
 				except:  # Ugh
@@ -433,7 +687,10 @@ class Process:
 			# dir_proc.join()
 			pg.close()
 
-	def hash_files(self, queue_maximums, hash_files_queue, load_hashes_queue):
+	def hash_files(self, queue_maximums, hash_files_queue, load_hashes_queue, io_budgets: list = None):
+		# Pace the reads to stay inside of the I/O budgets
+		throttle = functools.partial(IOBudget.throttle, io_budgets) if io_budgets else None
+
 		while True:
 			try:
 				# Make sure the destination queue is not full
@@ -455,10 +712,10 @@ class Process:
 					break
 
 				# Scrape the directory's contents and build the objects of metadata
-				hash.perform_hash()
+				hash.perform_hash(throttle)
 
 				# Now that the hash are colelcted, pass it to the queue to be inserted into the DB
-				if hash.md5_hash is not None or hash.sha1_hash is not None:  # Make sure it found a hash
+				if hash.md5_digest is not None or hash.sha1_digest is not None:  # Make sure it found a hash
 					load_hashes_queue.put(hash)
 
 			except:  # Ugh
@@ -492,7 +749,9 @@ class Process:
 					last_flush = time.time()
 
 					# If all is ready to flush to the DB, then perform the dump
-					FileDbDAL.DirectoryCrawl.stage_hashes(pg, load_hashes_queue)
+					FileDbDAL.DirectoryCrawl.stage_hashes(
+						pg, load_hashes_queue, self.hash_batch_rows, self.hash_batch_bytes
+					)
 
 					# Finally, process the staged hashes
 					FileDbDAL.DirectoryCrawl.process_staged_hashes(pg)
@@ -504,13 +763,28 @@ class Process:
 					traceback.print_exc(file=sys.stdout)
 					print("-" * 60)
 
-	def output_debug(self, queues):
+	def output_debug(self, queues, io_budgets):
+		last_usage = {budget_name: budget.used.value for budget_name, budget in io_budgets.items()}
+		last_usage_check = time.time()
+		usage_output = []
+
 		while True:
 			time.sleep(0.01)
 			output = []
 			for queue_name, queue in queues.items():
 				output.append(f"[{queue_name.replace('_queue', '')}: {queue.qsize()}]")
-			print(" | ".join(output), end='\r')
+
+			# Report how much of the I/O budgets are being used, averaged over each second
+			if time.time() - last_usage_check >= 1:
+				elapsed = time.time() - last_usage_check
+				last_usage_check = time.time()
+				usage_output = []
+				for budget_name, budget in io_budgets.items():
+					used = budget.used.value
+					usage_output.append(f"[{budget_name}: {budget.usage_text((used - last_usage[budget_name]) / elapsed)}]")
+					last_usage[budget_name] = used
+
+			print(" | ".join(output + usage_output), end='\r')
 
 	# Manage the FileHandler
 	def manage_copy_file_queue(self, queue_maximums, file_copy_list_queue):
@@ -0,0 +1,89 @@
+import os
+
+
+class DeviceGroup:
+	# A set of mount points that share a device (eg: a USB disk, a NAS share, or the NVMe drive), so they get their own
+	# crawl/hash queues and their own concurrency limits. A slow device then can't fill the queues and stall the others.
+	# The dirs that are not under any configured mount point fall into the default group, which uses the THREADS config.
+	# The work is grouped by path (not by stat'ing for st_dev), so a stale network mount can't hang the queue managers.
+
+	DEFAULT_NAME = 'default'
+
+	def __init__(
+			self, name: str, mount_points: list = None, crawl_dir: int = 1, crawl_dir_pool: int = 1, hash_files: int = 1,
+			io_budget: dict = None
+	):
+		self.name = name
+		self.mount_points = [os.path.normpath(mount_point) for mount_point in mount_points or []]
+
+		# Concurrency limits
+		self.crawl_dir = crawl_dir  # Number of crawl_dir processes
+		self.crawl_dir_pool = crawl_dir_pool  # Number of threads in each crawl_dir process
+		self.hash_files = hash_files  # Number of hash_files processes
+		self.io_budget = io_budget  # The device's own I/O budget config (None = only the global budget applies)
+
+		# The paths whose dirs/files belong to this group. None means everything (for the default group).
+		self.include_paths = self.mount_points or None
+		# The paths of the other groups that are nested inside of this group's paths (eg: /mnt/usb inside of /)
+		self.exclude_paths = []
+
+	@staticmethod
+	def from_config(server_config: dict) -> list:
+		# Build the default group from the global settings, followed by the configured devices
+		groups = [
+			DeviceGroup(
+				DeviceGroup.DEFAULT_NAME,
+				crawl_dir=server_config['THREADS']['crawl_dir'],
+				crawl_dir_pool=server_config['THREAD_POOLS']['crawl_dir'],
+				hash_files=server_config['THREADS']['hash_files'],
+			)
+		]
+		for device in server_config['DEVICES']:
+			groups.append(
+				DeviceGroup(
+					device['name'],
+					mount_points=device['mount_points'],
+					crawl_dir=device['crawl_dir'],
+					crawl_dir_pool=device['crawl_dir_pool'],
+					hash_files=device['hash_files'],
+					io_budget=device.get('IO_BUDGET'),
+				)
+			)
+
+		# Each path belongs to the group with the longest (most specific) mount point that contains it
+		for group in groups:
+			for other in groups:
+				if other is group:
+					continue
+				group.exclude_paths += [
+					mount_point for mount_point in other.mount_points
+					if group.include_paths is None or any(
+						DeviceGroup.is_under(mount_point, root) and mount_point != root for root in group.include_paths
+					)
+				]
+		return groups
+
+	@staticmethod
+	def is_under(path: str, root: str) -> bool:
+		# Is the path the root dir, or inside of it?
+		root = root.rstrip('/\\')
+		return path == root or path.startswith(root + '/') or path.startswith(root + '\\')
+
+	def contains(self, path: str) -> bool:
+		if self.include_paths is not None and not any(self.is_under(path, root) for root in self.include_paths):
+			return False
+		return not any(self.is_under(path, root) for root in self.exclude_paths)
+
+	@staticmethod
+	def get_group(groups: list, path: str):
+		# Find the group that the path belongs to (falling back to the default group)
+		for group in groups:
+			if group.contains(path):
+				return group
+		return groups[0]
+
+	def queue_key(self, queue_name: str) -> str:
+		# The default group uses the original queue names
+		if self.name == DeviceGroup.DEFAULT_NAME:
+			return queue_name
+		return f"{queue_name}:{self.name}"
@@ -0,0 +1,91 @@
+import multiprocessing as MP
+import time
+from datetime import datetime
+
+
+class IOBudget:
+	# Token bucket that limits the rate of I/O (eg: bytes read per second while hashing, or stat calls per second while
+	# crawling). The bucket lives in shared memory, so all of the worker processes that draw from it are paced together.
+	# The rate can change with the time of day (eg: a lower budget during business hours). A rate of 0 is unlimited.
+
+	BURST_SECONDS = 1  # How much of the unused budget can be saved up, in seconds of the rate
+
+	def __init__(self, rate: float = 0, profiles: list = None, unit: str = 'ops', unit_size: float = 1):
+		self.rate = rate
+		self.unit = unit  # For reporting. Eg: "MB"
+		self.unit_size = unit_size  # Eg: 1000000 for MB, when the rate is in bytes
+		# List of (start minute, end minute, rate) tuples
+		self.profiles = [
+			(self.parse_time_of_day(start), self.parse_time_of_day(end), profile_rate)
+			for start, end, profile_rate in profiles or []
+		]
+
+		self.lock = MP.Lock()
+		self.tokens = MP.RawValue('d', 0)
+		self.refilled_on = MP.RawValue('d', time.time())
+		self.used = MP.RawValue('d', 0)  # Total amount consumed, for reporting
+
+	@staticmethod
+	def from_config(budget_config: dict, rate_name: str, unit: str = 'ops', unit_size: float = 1):
+		# Eg: rate_name = 'hash_bytes_per_second'. A rate that isn't configured is unlimited, and a profile that doesn't
+		# set the rate keeps the base rate during its time window.
+		rate = budget_config.get(rate_name, 0)
+		return IOBudget(
+			rate,
+			[
+				(profile['start'], profile['end'], profile.get(rate_name, rate))
+				for profile in budget_config.get('PROFILES', [])
+			],
+			unit,
+			unit_size,
+		)
+
+	@staticmethod
+	def parse_time_of_day(time_of_day: str) -> int:
+		# "HH:MM" -> minutes since midnight
+		hours, minutes = time_of_day.split(':')
+		return int(hours) * 60 + int(minutes)
+
+	def current_rate(self) -> float:
+		# Use the first profile that covers the current time (profiles can wrap past midnight, eg: 22:00 to 06:00)
+		now = datetime.now()
+		minute = now.hour * 60 + now.minute
+		for start, end, rate in self.profiles:
+			if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+				return rate
+		return self.rate
+
+	def consume(self, amount: float) -> float:
+		# Take the amount from the budget, and return the number of seconds to wait to stay inside of it.
+		# The budget can go into debt, so one large read is paced out instead of being blocked.
+		rate = self.current_rate()
+		with self.lock:
+			self.used.value += amount
+			if rate <= 0:  # Unlimited
+				return 0
+
+			now = time.time()
+			self.tokens.value = min(
+				self.tokens.value + (now - self.refilled_on.value) * rate,
+				rate * self.BURST_SECONDS
+			)
+			self.refilled_on.value = now
+			self.tokens.value -= amount
+			if self.tokens.value >= 0:
+				return 0
+			return -self.tokens.value / rate
+
+	def usage_text(self, used_rate: float) -> str:
+		# Eg: "12.5/20.0 MB/s" (or "12.5 MB/s" when unlimited)
+		rate = self.current_rate()
+		usage = f"{round(used_rate / self.unit_size, 1)}"
+		if rate > 0:
+			usage += f"/{round(rate / self.unit_size, 1)}"
+		return f"{usage} {self.unit}/s"
+
+	@staticmethod
+	def throttle(budgets: list, amount: float) -> None:
+		# Draw from each of the budgets (eg: the device's and the global), and wait for the most constrained one
+		wait = max([budget.consume(amount) for budget in budgets], default=0)
+		if wait > 0:
+			time.sleep(wait)
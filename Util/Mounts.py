@@ -0,0 +1,37 @@
+import os
+import re
+
+
+class Mounts:
+	# Read the OS's mount table. Only Linux (/proc/self/mountinfo) is supported; other OSes return no mounts.
+
+	MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+	@staticmethod
+	def get_mounts() -> dict:
+		# Returns {mount_point: fs_type}
+		mounts = {}
+		try:
+			with open(Mounts.MOUNTINFO_PATH) as mountinfo:
+				for line in mountinfo:
+					# Format: id parent_id major:minor root mount_point options [optional fields...] - fs_type source ...
+					fields, _, fs_fields = line.partition(' - ')
+					fields = fields.split()
+					fs_fields = fs_fields.split()
+					if len(fields) < 5 or not fs_fields:
+						continue
+					mounts[Mounts.unescape(fields[4])] = fs_fields[0]
+		except OSError:  # Not Linux (or /proc is not mounted)
+			pass
+		return mounts
+
+	@staticmethod
+	def unescape(path: str) -> str:
+		# Spaces, tabs, newlines and backslashes in the paths are escaped as octal. Eg: "\040" is a space
+		return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+	@staticmethod
+	def get_mount_points_under(dir_path: str, mounts: dict) -> list:
+		# Get the mount points nested inside of the dir (not including the dir itself)
+		dir_path = os.path.join(dir_path, '')  # Add the trailing slash
+		return [mount_point for mount_point in mounts if mount_point.startswith(dir_path) and mount_point != dir_path]
@@ -0,0 +1,111 @@
+"""
+Measure the latency of claiming dirs to crawl with get_dirs_to_crawl(), with one or several concurrent claimers, and
+check that no dir gets claimed twice.
+
+Usage:
+	python benchmarks/crawl_claim.py config.json [--rows 1000000] [--due 0.1] [--claimers 4] [--claims 20] [--limit 100]
+
+The directory_control rows are made up, under negative dir IDs (which the identity columns never use), and removed
+when the benchmark is done. Run it against a test DB, with the server stopped, so that the server's own claims don't
+take the made up dirs.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import statistics
+import multiprocessing as mp
+
+# Allow the benchmark to be run from the benchmarks folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileDbDAL.Pg import Pg
+
+ROOT_PATH = '/crawl_claim_benchmark'
+
+
+def insert_rows(pg, row_count: int, due_fraction: float) -> None:
+	# Spread next_crawl over a day before and after now (due_fraction of them in the past), with random dir sizes
+	with pg.cursor() as cur:
+		cur.execute(
+			"""
+			insert into directory_control (dir_path, dir_id, file_count, subdir_count, next_crawl)
+			select
+				%(root_path)s || '/d' || i,
+				-i,
+				(random() * random() * 5000)::int,
+				(random() * random() * 50)::int,
+				now() - (%(due_fraction)s - random()) * interval '1 day'
+			from generate_series(1, %(row_count)s) i;
+			analyze directory_control;
+			""",
+			{'root_path': ROOT_PATH, 'row_count': row_count, 'due_fraction': due_fraction}
+		)
+
+
+def delete_rows(pg) -> None:
+	with pg.cursor() as cur:
+		cur.execute("delete from directory_control where dir_id < 0;")
+
+
+def claim(config: dict, claim_count: int, limit: int, results) -> None:
+	# Run the claims of one claimer, and send back their times and the claimed dir IDs
+	times = []
+	dir_ids = []
+	with Pg(config) as pg:
+		with pg.cursor() as cur:
+			for i in range(claim_count):
+				start_time = time.perf_counter()
+				cur.execute(
+					"select dir_id from get_dirs_to_crawl(%s, %s, %s::text[], null);",
+					(os.getpid(), limit, [ROOT_PATH])
+				)
+				dir_ids += [row['dir_id'] for row in cur]
+				times.append(time.perf_counter() - start_time)
+	results.put((times, dir_ids))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark the latency of claiming the dirs to crawl")
+	parser.add_argument('config', help="Path to the config file (with the test DB's connection)")
+	parser.add_argument('--rows', type=int, default=1000000, help="Number of made up directory_control rows")
+	parser.add_argument('--due', type=float, default=0.1, help="Fraction of the rows that are due to be crawled")
+	parser.add_argument('--claimers', type=int, default=4, help="Number of concurrent claimers")
+	parser.add_argument('--claims', type=int, default=20, help="Number of claims per claimer")
+	parser.add_argument('--limit', type=int, default=100, help="Number of dirs per claim")
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		config = json.load(f)
+
+	with Pg(config) as pg:
+		delete_rows(pg)
+		start_time = time.perf_counter()
+		insert_rows(pg, args.rows, args.due)
+		print(f"Inserted {args.rows} rows in {round(time.perf_counter() - start_time, 1)}s")
+
+		try:
+			# Start the claimers at the same time
+			results = mp.Queue()
+			claimers = [
+				mp.Process(target=claim, args=(config, args.claims, args.limit, results)) for i in range(args.claimers)
+			]
+			for claimer in claimers:
+				claimer.start()
+			claimed = [results.get() for claimer in claimers]
+			for claimer in claimers:
+				claimer.join()
+		finally:
+			delete_rows(pg)
+
+	# Output the claim latency, and check that each dir was only claimed once
+	times = [seconds for claimer_times, dir_ids in claimed for seconds in claimer_times]
+	dir_ids = [dir_id for claimer_times, claimer_dir_ids in claimed for dir_id in claimer_dir_ids]
+	print("-" * 60)
+	print(
+		f"{len(times)} claims of up to {args.limit} dirs, by {args.claimers} claimers: "
+		f"median: {round(statistics.median(times) * 1000, 1)}ms, max: {round(max(times) * 1000, 1)}ms"
+	)
+	print(f"Claimed {len(dir_ids)} dirs, {len(dir_ids) - len(set(dir_ids))} claimed more than once")
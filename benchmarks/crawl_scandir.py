@@ -0,0 +1,98 @@
+"""
+Compare the scandir crawl engine against the previous os.walk() + per-entry stat crawl.
+
+Usage:
+	python benchmarks/crawl_scandir.py /path/to/tree [--repeat 3]
+
+Both engines crawl every directory under the path, one directory at a time, the same way the crawl_dir workers do.
+To compare the syscall counts as well, run each engine under strace, eg:
+	strace -f -c -e trace=%file,getdents64 python benchmarks/crawl_scandir.py /path --engine scandir
+Note: The first run warms the OS's dentry/inode caches. Drop the caches between runs to measure a cold crawl.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Allow the benchmark to be run from the benchmarks folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileDbDAL.DirectoryCrawl import DirectoryCrawl
+from FileDbDAL.Directory import Directory
+from FileDbDAL.File import File
+
+
+def legacy_scrape_dir(dir_path: str) -> list:
+	# Reproduce the previous engine: list the dir with os.walk(), then stat each entry separately
+	try:
+		root, subdir_names, file_names = next(os.walk(dir_path))
+	except StopIteration:
+		return []
+
+	for file_name in file_names:
+		f = File(file_name, dir_path)
+		f.scrape_metadata()
+
+	subdir_paths = []
+	for subdir_name in subdir_names:
+		d = Directory(os.path.join(dir_path, subdir_name))
+		# The previous Directory.scrape_metadata() called os.path.getmtime() (plus getctime() on Windows)
+		try:
+			os.path.getmtime(d.dir_path)
+			if os.name == 'nt':
+				os.path.getctime(d.dir_path)
+		except OSError:
+			pass
+		subdir_paths.append(d.dir_path)
+
+	return subdir_paths
+
+
+def scandir_scrape_dir(dir_path: str) -> list:
+	dc = DirectoryCrawl()
+	dc.dir_path = dir_path
+	dc.scrape_dir_contents(build_objects=True)
+	return [subdir[0] for subdir in dc.iter_content_subdirs()]
+
+
+def crawl_tree(root: str, scrape_dir) -> (int, float):
+	# Crawl the tree breadth-first, one directory at a time
+	start_time = time.perf_counter()
+	dir_count = 0
+	pending = [root]
+	while pending:
+		dir_path = pending.pop()
+		dir_count += 1
+		# Don't descend into symlinked dirs, to avoid looping (eg: /usr/bin/X11 -> .)
+		pending.extend(subdir for subdir in scrape_dir(dir_path) if not os.path.islink(subdir))
+	return dir_count, time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark the directory crawl engines")
+	parser.add_argument('path', help="Directory tree to crawl")
+	parser.add_argument('--repeat', type=int, default=3, help="Number of times to crawl the tree with each engine")
+	parser.add_argument('--engine', choices=['both', 'walk', 'scandir'], default='both')
+	args = parser.parse_args()
+
+	engines = {
+		'walk': legacy_scrape_dir,
+		'scandir': scandir_scrape_dir,
+	}
+	if args.engine != 'both':
+		engines = {args.engine: engines[args.engine]}
+
+	results = {}
+	for i in range(args.repeat):
+		for engine_name, scrape_dir in engines.items():
+			dir_count, seconds = crawl_tree(args.path, scrape_dir)
+			results.setdefault(engine_name, []).append(seconds)
+			print(f"[{engine_name}] run {i + 1}: {dir_count} dirs in {round(seconds, 3)}s")
+
+	# Output the best run of each engine (the best run is the least affected by other activity on the machine)
+	print("-" * 60)
+	for engine_name, times in results.items():
+		print(f"[{engine_name}] best: {round(min(times), 3)}s")
+	if len(results) == 2:
+		print(f"Speedup: {round(min(results['walk']) / min(results['scandir']), 2)}x")
@@ -0,0 +1,124 @@
+"""
+Compare the latency of one staging flush (the crawled dirs written into the 5 staging tables) for each writer:
+the COPY writer (text and binary format), and the stage_dir_contents() function writer (one call with column arrays).
+
+Usage:
+	python benchmarks/stage_flush.py config.json [--dirs 200] [--files 250] [--subdirs 5] [--repeat 5]
+
+The flushes are made of made-up dirs and files, staged under negative dir IDs (which the identity columns never use),
+and removed from the staging tables after each flush. Run it against a test DB, with the server stopped, so that the
+staged rows don't get merged in the middle of the benchmark.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import statistics
+from datetime import datetime
+
+# Allow the benchmark to be run from the benchmarks folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileDbDAL.DirectoryCrawl import DirectoryCrawl
+from FileDbDAL.Pg import Pg
+
+WRITERS = {
+	'copy-text': ('copy', 'text'),
+	'copy-binary': ('copy', 'binary'),
+	'function': ('function', 'text'),
+}
+
+
+def build_crawled_dirs(dir_count: int, file_count: int, subdir_count: int) -> list:
+	# Build the crawled dirs the same way the crawl_dir workers do, with made up contents
+	now = time.time()
+	crawled_dirs = []
+	for d in range(dir_count):
+		dc = DirectoryCrawl()
+		dc.dir_id = -1 - d
+		dc.dir_path = f"/stage_flush_benchmark/d{d}"
+		dc.files = [
+			(f"file{i}.txt", 1000 + i, None, now, now, 2049, d * file_count + i)
+			for i in range(file_count)
+		]
+		dc.subdirs = [(f"sub{i}", None, now, False, 2049, 10 ** 9 + d * subdir_count + i) for i in range(subdir_count)]
+		dc.file_count = file_count
+		dc.subdir_count = subdir_count
+		dc.crawl_started_on = datetime.now()
+		dc.crawled_on = datetime.now()
+		dc.mtime = datetime.now()
+		dc.ctime = None
+		dc.dir_not_found = False
+		dc.delete_missing = True
+		dc.incremental = False
+		crawled_dirs.append(dc)
+	return crawled_dirs
+
+
+def clear_staged_rows(pg) -> None:
+	with pg.cursor() as cur:
+		cur.execute("""
+			delete from directory_stage where parent_id < 0;
+			delete from directory_stage_process where parent_id < 0;
+			delete from file_stage where dir_id < 0;
+			delete from file_stage_process where dir_id < 0;
+			delete from directory_control_process where dir_id < 0;
+		""")
+
+
+def count_staged_rows(pg) -> int:
+	with pg.cursor() as cur:
+		cur.execute("""
+			select
+				(select count(*) from directory_stage where parent_id < 0)
+				+ (select count(*) from directory_stage_process where parent_id < 0)
+				+ (select count(*) from file_stage where dir_id < 0)
+				+ (select count(*) from file_stage_process where dir_id < 0)
+				+ (select count(*) from directory_control_process where dir_id < 0);
+		""")
+		return cur.fetchone()[0]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark the latency of the staging flushes, for each writer")
+	parser.add_argument('config', help="Path to the config file (with the test DB's connection)")
+	parser.add_argument('--dirs', type=int, default=200, help="Number of crawled dirs per flush")
+	parser.add_argument('--files', type=int, default=250, help="Number of files per crawled dir")
+	parser.add_argument('--subdirs', type=int, default=5, help="Number of subdirs per crawled dir")
+	parser.add_argument('--repeat', type=int, default=5, help="Number of flushes with each writer")
+	parser.add_argument('--writer', choices=['all'] + list(WRITERS), default='all')
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		config = json.load(f)
+
+	writers = WRITERS if args.writer == 'all' else {args.writer: WRITERS[args.writer]}
+	crawled_dirs = build_crawled_dirs(args.dirs, args.files, args.subdirs)
+	row_count = args.dirs * (args.files + args.subdirs + 3)  # 3 rows per dir: 2 process tables + directory_control_process
+
+	results = {}
+	with Pg(config) as pg:
+		clear_staged_rows(pg)
+		for i in range(args.repeat):
+			for writer_name, (writer, copy_format) in writers.items():
+				start_time = time.perf_counter()
+				DirectoryCrawl.stage_crawled_dirs(pg, crawled_dirs, copy_format, writer)
+				seconds = time.perf_counter() - start_time
+
+				staged_count = count_staged_rows(pg)
+				clear_staged_rows(pg)
+				if staged_count != row_count:
+					print(f"[{writer_name}] staged {staged_count} rows, expected {row_count}")
+
+				results.setdefault(writer_name, []).append(seconds)
+				print(f"[{writer_name}] flush {i + 1}: {row_count} rows in {round(seconds * 1000, 1)}ms")
+
+	# Output the best and median flush of each writer
+	print("-" * 60)
+	for writer_name, times in results.items():
+		print(
+			f"[{writer_name}] best: {round(min(times) * 1000, 1)}ms, median: {round(statistics.median(times) * 1000, 1)}ms"
+			f" ({int(row_count / min(times))} rows/s)"
+		)
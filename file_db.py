@@ -1,7 +1,7 @@
 from Server import Process
 import sys
 
-from FileDbDAL import Pg
+from FileDbDAL import Pg, CatalogImport
 from CLI import UserInterface
 from Util.Config import Config
 from install import Install
@@ -34,6 +34,20 @@ def install(config_file):
 	Install(config_file)
 
 
+def catalog_import(config_file, listing_file, listing_format):
+	# Load a listing of a tree (see CatalogImport), instead of crawling it
+	config = Config.load_config(config_file)
+	with Pg(config) as pg:
+		catalog = CatalogImport(
+			pg, listing_file, listing_format, config['SERVER']['CATALOG_IMPORT']['batch_size']
+		)
+		catalog.run()
+		print(
+			f"Imported {catalog.dir_count} dirs, {catalog.file_count} files, and {catalog.hash_count} hashes "
+			f"from {listing_file} ({catalog.skipped_count} lines skipped). The dirs are scheduled to be crawled."
+		)
+
+
 if __name__ == '__main__':
 	# https://codeburst.io/building-beautiful-command-line-interfaces-with-python-26c7e1bb54df
 
@@ -56,6 +70,9 @@ if __name__ == '__main__':
 		ui(in_config_file)
 	elif in_program_type.lower() == "install":
 		install(in_config_file)
+	elif in_program_type.lower() == "import":
+		# Eg: file_db.py config.json import listing.txt find
+		catalog_import(in_config_file, sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else 'ndjson')
 	else:
 		ui(in_config_file)  # Default
 
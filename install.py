@@ -1,6 +1,7 @@
 from Util.Config import Config
 from prompt_toolkit import prompt
 from FileDbDAL.Pg import Pg
+from FileDbDAL.BulkImport import BulkImport
 from psycopg2 import OperationalError
 from Server import Process
 
@@ -64,9 +65,6 @@ class Install:
 
 			# If all is good, then load into the DB
 			with Pg(config) as pg:
-				with pg.cursor() as cur:
-					# Load the directory into the table
-					cur.execute("insert into directory (dir_path) values (%s) on conflict do nothing", (new_dir,))
-					# ...And schedule it for crawling
-					cur.execute("select schedule_subdirs_in_directory_control(%s);", (new_dir,))
-					print(f'Added for crawling: {new_dir}')
+				# Load the directory into the table, and schedule its whole subtree to be imported by the server
+				BulkImport.schedule(pg, new_dir)
+				print(f'Added for crawling: {new_dir}')